@@ -0,0 +1,74 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Measures the CPU time the parent process spends per item when handing the download
+# queue to the worker pool. The downloads themselves are replaced with a function that
+# returns immediately, so only the pickling and IPC overhead is left.
+# Needs the fork start method, so the replaced function reaches the workers.
+# Run with `python benchmarks/ipc.py` from the root of the repository.
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redditcurl import manager
+
+ITEMS = 50000
+PROCESSES = 20
+SAVEDIR = "/home/karmanaut/Pictures/reddit/saved images"
+
+
+def fake_download(url, path, file_name=""):
+    return None
+
+
+def make_queue():
+    # Folder strings are rebuilt for each job, like they would be for each praw submission
+    return [manager.Job("id{}".format(i), "https://i.imgur.com/{:07d}.jpg".format(i),
+                        os.path.join(SAVEDIR, "pics"), "a title for the image {}".format(i))
+            for i in range(ITEMS)]
+
+
+def before(pool, queue):
+    """Per-item tasks, returning full Results, like download_submissions used to."""
+    return {result.job.id: result for result in pool.imap_unordered(manager.download_job, queue)}
+
+
+def after(pool, queue):
+    """Chunked tasks with interned folders, returning compact results."""
+    queue = [job._replace(folder=sys.intern(job.folder)) for job in queue]
+    return manager.dispatch(pool, queue, manager.chunk_size(len(queue), PROCESSES))
+
+
+def measure(function):
+    queue = make_queue()
+    with multiprocessing.get_context("fork").Pool(processes=PROCESSES) as pool:
+        start = time.process_time()
+        results = function(pool, queue)
+        elapsed = time.process_time() - start
+    assert len(results) == ITEMS
+    return elapsed
+
+
+if __name__ == "__main__":
+    manager.attempt_download = fake_download
+    for function in (before, after):
+        elapsed = measure(function)
+        print("{:<8} parent CPU {:6.2f} s   {:6.1f} us/item".format(function.__name__, elapsed,
+                                                                   elapsed / ITEMS * 1e6))
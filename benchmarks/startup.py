@@ -0,0 +1,59 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Measures the startup time of the command line interface, and the time it takes for a
+# worker process to start and become ready to download.
+# Run with `python benchmarks/startup.py` from the root of the repository.
+import os
+import sys
+import time
+import statistics
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RUNS = 10
+
+
+def cli_startup():
+    """Return the time it takes to run `python -m redditcurl --help`, in seconds."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "redditcurl", "--help"], stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def worker_init(method):
+    """Return the time it takes a worker process to start and import the manager, in seconds."""
+    from redditcurl import manager
+    context = multiprocessing.get_context(method)
+    start = time.perf_counter()
+    with context.Pool(processes=1) as pool:
+        # Unpickling the function makes the worker import redditcurl.manager
+        pool.apply(manager.read_history, ("doesnt-exist.gz",))
+    return time.perf_counter() - start
+
+
+def report(name, times):
+    print("{:<30} median {:7.1f} ms   min {:7.1f} ms".format(name, statistics.median(times) * 1000,
+                                                          min(times) * 1000))
+
+
+if __name__ == "__main__":
+    report("python -m redditcurl --help", [cli_startup() for _ in range(RUNS)])
+    for method in multiprocessing.get_all_start_methods():
+        report("worker init ({})".format(method), [worker_init(method) for _ in range(RUNS)])
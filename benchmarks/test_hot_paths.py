@@ -0,0 +1,147 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Benchmarks for the work the parent process does on the CPU, besides waiting for the
+# network: filtering the saved listing against the history, building the download queue,
+# picking the downloaders, counting the results, and parsing the pages of the websites.
+# The inputs are synthetic, and the same on every run, so the results can be compared.
+#
+# Needs pytest-benchmark. Run from the root of the repository with
+#     python -m pytest benchmarks --benchmark-autosave
+# which stores the results in .benchmarks, and compare a later version with the stored
+# results, failing if any benchmark got more than 10% slower, with
+#     python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+import random
+import logging
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from tests import test_base
+from redditcurl import manager
+from redditcurl import websites
+from redditcurl import __main__ as main
+from redditcurl.websites import fetch
+from redditcurl.websites import direct
+
+HISTORY_SIZE = 1000000
+SUBMISSIONS = 100000
+SAVEDIR = "/home/karmanaut/Pictures/reddit/saved images"
+
+# Links to each of the websites, and to a page that no downloader supports.
+URL_FORMATS = [
+    "https://i.imgur.com/{:07d}.jpg",
+    "https://imgur.com/{:07d}",
+    "https://imgur.com/a/{:07d}",
+    "https://i.imgur.com/{:07d}.gifv",
+    "https://gfycat.com/SomeGfycat{}",
+    "https://redditbooru.com/gallery/{}",
+    "https://someone.deviantart.com/art/painting-{}",
+    "https://twitter.com/someone/status/{}",
+    "https://example.com/page/{}.html",
+]
+
+# Titles with the characters that can't be used in file names.
+TITLES = ['What is this? A "cat" / dog', "Sunset at the lake [OC] [4000x3000]", "<3 this | so much *wow*",
+          "A perfectly ordinary title", ".hidden: not really"]
+
+
+@pytest.fixture(scope="module")
+def history():
+    return {URL_FORMATS[0].format(i) for i in range(HISTORY_SIZE)}
+
+
+@pytest.fixture(scope="module")
+def history_file(tmp_path_factory, history):
+    path = str(tmp_path_factory.mktemp("history") / ".downloaded.gz")
+    manager.update_new(sorted(history), path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def saved():
+    generator = random.Random(0)
+    # About half of the direct links are in the history already
+    return [test_base.create_saved(generator.choice(URL_FORMATS).format(generator.randrange(2 * HISTORY_SIZE)),
+                                   "{} {}".format(generator.choice(TITLES), i),
+                                   generator.choice(["pics", "aww", "art"]), "id{}".format(i))
+            for i in range(SUBMISSIONS)]
+
+
+@pytest.fixture(scope="module")
+def downloaded(saved):
+    # One in a hundred downloads failed
+    return {sub.id: manager.Result(manager.Job(sub.id, sub.url, SAVEDIR, sub.title), i % 100 != 0)
+            for i, sub in enumerate(saved)}
+
+
+def page(body):
+    """Return an HTML page shaped like the pages of the websites, with a large head and body."""
+    head = "".join('<meta name="description-{0}" content="Some text for meta tag number {0}">'.format(i)
+                   for i in range(40))
+    head += "".join("<script>var value{0} = {{'key': {0}, 'list': [1, 2, 3]}};</script>".format(i) for i in range(20))
+    filler = "".join('<div class="item item-{0}"><a href="/link/{0}">Link {0}</a><span>Text</span></div>'.format(i)
+                     for i in range(2000))
+    return "<!DOCTYPE html><html><head>{}</head><body>{}{}</body></html>".format(head, filler, body).encode("utf-8")
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Serve content for every request, and skip the downloads of the images."""
+    def serve(content):
+        monkeypatch.setattr(fetch, "get", lambda url, **kwargs: test_base.FakeResponse(200, {}, content))
+        monkeypatch.setattr(direct, "download", lambda url, path, file_name="": None)
+    return serve
+
+
+def test_read_history(benchmark, history_file):
+    assert len(benchmark(manager.read_history, history_file)) == HISTORY_SIZE
+
+
+def test_filter_new(benchmark, saved, history):
+    assert 0 < len(benchmark(manager.filter_new, saved, None, history, {})) < SUBMISSIONS
+
+
+def test_process_submissions(benchmark, saved):
+    download_queue, _ = benchmark(manager.process_submissions, saved, SAVEDIR, True, True, [])
+    assert len(download_queue) == SUBMISSIONS
+
+
+def test_find_downloader(benchmark, saved):
+    urls = [sub.url for sub in saved]
+    assert None in benchmark(lambda: [websites.find(url) for url in urls])
+
+
+def test_count_success(benchmark, downloaded, saved):
+    # Leave out the cost of printing the warnings about the failed downloads
+    logging.getLogger("main").disabled = True
+    try:
+        success_count, _, _ = benchmark(main.count_success, downloaded, False, saved)
+    finally:
+        logging.getLogger("main").disabled = False
+    assert success_count == SUBMISSIONS - SUBMISSIONS // 100
+
+
+def test_parse_twitter(benchmark, serve):
+    serve(page("").replace(b"<head>", b'<head><meta property="og:image" '
+                                      b'content="https://pbs.twimg.com/media/AbCdEf.jpg:large">'))
+    benchmark(websites.twitter.download, "https://twitter.com/someone/status/1", "", "")
+
+
+def test_parse_redditbooru_gallery(benchmark, serve):
+    serve(page("".join('<img src="https://cdn.awwni.me/{}.jpg">'.format(i) for i in range(12))))
+    benchmark(websites.redditbooru_gallery.download, "https://redditbooru.com/gallery/1", "", "")
@@ -17,13 +17,23 @@
 """
 import os
 import sys
+import time
+import stat
 import logging
 import argparse
+import tempfile
 import configparser
-import praw
-import requests
+import importlib.util
 from redditcurl import manager
+from redditcurl import catalog
+from redditcurl import concurrency
+from redditcurl import dedup
+from redditcurl import scan
 from redditcurl.websites import shared_config
+from redditcurl.websites import ratelimit
+from redditcurl.websites import formats
+from redditcurl.websites import layout
+from redditcurl.websites import storage
 from redditcurl.exceptions import ConfigError
 
 
@@ -32,15 +42,38 @@ DEFAULTS = {"processes":  "20",
             "subreddits": "",
             "notitles":   "false",
             "prefer-mp4": "false",
+            "format-policy": "preferred",
             "savefile":   ".downloaded.gz",
             "remove":     "false",
             "silent":     "false",
-            "nofilehash":   "false"}
+            "nofilehash":   "false",
+            "nosync":     "false",
+            "watch":      "0",
+            "retry-failed": "false",
+            "scan":       "false",
+            "shard":      "1/1",
+            "queue-worker": "false",
+            "layout":     "flat",
+            "migrate-layout": "false",
+            "storage":    "files",
+            "volume-size": "1024",
+            "dedup-distance": "6",
+            "connect-timeout": "10",
+            "read-timeout": "30",
+            "deadline":   "300",
+            "segments":   "4",
+            "min-processes": "2",
+            "max-processes": "64",
+            "max-rate":   "0",
+            "rate-schedule": ""}
 
 OAUTH_DEFAULTS = {"clientid": "Fp9ci3HipOW1FQ",
                   "redirect": "http://kaangenc.me/static/redditcurl.html"}
 
-OAUTH_SCOPES = {"identity", "history"}
+OAUTH_SCOPES = {"identity", "history", "save"}
+
+# Reddit access tokens expire after an hour, refresh a few minutes early.
+ACCESS_TOKEN_LIFETIME = 55 * 60
 
 
 def setup_parser():
@@ -51,12 +84,17 @@ def setup_parser():
     Returns:
         The argparse.ArgumentParser object.
     """
-    parser = argparse.ArgumentParser(description="Downloads your saved images from Reddit.")
+    parser = argparse.ArgumentParser(description="Downloads your saved images from Reddit.",
+                                     epilog="Use redditcurl catalog --help to look up the downloaded images.")
     parser.add_argument("-d", "--savedir", type=str,
                         help="Directory to save the images.")
-    parser.add_argument("-c", "--processes", type=int,
-                        help="Number of processes to use."
+    parser.add_argument("-c", "--processes", type=str,
+                        help="Number of processes to use, or auto to adjust it while downloading. "
                         "Use 1 to disable multiprocessing.")
+    parser.add_argument("--min-processes", type=int,
+                        help="With --processes auto, the lowest number of downloads to run at once.")
+    parser.add_argument("--max-processes", type=int,
+                        help="With --processes auto, the highest number of downloads to run at once.")
     parser.add_argument("-b", "--subfolders", action="store_true",
                         help="Put the images into subfolders, based on their subreddits.")
     parser.add_argument("-t", "--subreddits", type=str,
@@ -66,18 +104,133 @@ def setup_parser():
                         "use the names of downloaded files instead.")
     parser.add_argument("-m", "--prefer-mp4", action="store_true",
                         help="In gfycat and imgur gifv links, download mp4's instead of webm.")
+    parser.add_argument("--format-policy", type=str, choices=formats.FORMAT_POLICIES,
+                        help="Use smallest to download whichever format of a gfycat or imgur video "
+                        "is the smallest, and imgur gifs as mp4 videos if they are smaller.")
     parser.add_argument("-e", "--nofilehash", action="store_true",
                         help="Don't append the first 10 characters of files md5 hash to the file name."
                         "Older files may get overwritten.")
+    parser.add_argument("--nosync", action="store_true",
+                        help="Don't wait for the downloaded images to be written to the disk before "
+                        "recording them as downloaded. Faster, but a crash may leave damaged images behind.")
     parser.add_argument("-f", "--savefile", type=str,
                         help="The file to keep track of images that have been downloaded.")
     parser.add_argument("-r", "--remove", action="store_true",
                         help="Remove the files that were successfully downloaded from saved.")
     parser.add_argument("-s", "--silent", action="store_true",
                         help="Do not print anything about the scripts actions.")
+    parser.add_argument("--connect-timeout", type=float, metavar="SECONDS",
+                        help="Seconds to wait while connecting to a website.")
+    parser.add_argument("--read-timeout", type=float, metavar="SECONDS",
+                        help="Seconds to wait for a website to send data.")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS",
+                        help="Seconds a single download may take in total. Use 0 to disable.")
+    parser.add_argument("--segments", type=int, metavar="N",
+                        help="Download large files over N connections at once. Use 1 to disable.")
+    parser.add_argument("--max-rate", type=str, metavar="RATE",
+                        help="Limit the download speed of all processes together to RATE bytes per second. "
+                        "Use K, M or G suffixes for larger units, like 2M. Use 0 for no limit.")
+    parser.add_argument("--rate-schedule", type=str, metavar="SCHEDULE",
+                        help="Use different limits at times of the day, like 09:00-18:00=500K,22:00-06:00=0. "
+                        "--max-rate applies outside these times.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Only retry the downloads that failed before, without checking Reddit for new saved images.")
+    parser.add_argument("--scan", action="store_true",
+                        help="Check the images in the save directory for damage, and queue the damaged ones "
+                        "to be downloaded again with --retry-failed.")
+    parser.add_argument("--export-jobs", type=str, metavar="FILE",
+                        help="Write the new saved images to FILE instead of downloading them, "
+                        "so they can be downloaded later with --from-jobs.")
+    parser.add_argument("--from-jobs", type=str, metavar="FILE",
+                        help="Download the images in FILE, written by --export-jobs, without checking Reddit.")
+    parser.add_argument("--shard", type=str, metavar="I/N",
+                        help="With --from-jobs, only download the I'th of N parts of the images, "
+                        "like 2/4. Every image is in exactly one part.")
+    parser.add_argument("--merge-history", type=str, metavar="FILES",
+                        help="Add the images downloaded in other savefiles to the savefile, and exit. "
+                        "Seperate names with commas (,).")
+    parser.add_argument("--queue", type=str, metavar="FILE",
+                        help="Add the new saved images to a work queue in FILE, and download them together "
+                        "with the other redditcurl instances using the same queue.")
+    parser.add_argument("--queue-worker", action="store_true",
+                        help="With --queue, only help download the images already in the queue, "
+                        "without checking Reddit.")
+    parser.add_argument("--layout", type=str, choices=layout.LAYOUTS,
+                        help="Use hashed to spread the images over subfolders like 3f/a2, "
+                        "which keeps very large save directories fast.")
+    parser.add_argument("--migrate-layout", action="store_true",
+                        help="Move the images already in the save directory to --layout, and exit.")
+    parser.add_argument("--storage", type=str, choices=storage.STORAGES,
+                        help="Use tar to add the images to tar files in the save directory, "
+                        "or s3 to upload them to an S3 bucket, instead of saving them as separate files.")
+    parser.add_argument("--volume-size", type=int, metavar="MB",
+                        help="With --storage tar, start a new tar file once one grows past MB megabytes.")
+    parser.add_argument("--s3-bucket", type=str, metavar="BUCKET",
+                        help="With --storage s3, the bucket to upload the images to.")
+    parser.add_argument("--s3-prefix", type=str, metavar="PREFIX",
+                        help="With --storage s3, put PREFIX in front of the names of the images.")
+    parser.add_argument("--s3-endpoint", type=str, metavar="URL",
+                        help="With --storage s3, the url of an S3 compatible store to use instead of Amazon S3.")
+    parser.add_argument("--dedup", type=str, choices=dedup.ACTIONS,
+                        help="After downloading, look for images that were already downloaded at a different "
+                        "size or quality, and log them, replace them with hard links to the first copy, "
+                        "or remove them.")
+    parser.add_argument("--dedup-distance", type=int, metavar="BITS",
+                        help="With --dedup, how many of the 64 bits of the image hashes may differ.")
+    parser.add_argument("-w", "--watch", type=int, metavar="INTERVAL",
+                        help="Keep running, checking for new saved images every INTERVAL seconds.")
+    return parser
+
+
+def setup_catalog_parser():
+    """Setup the argument parser of the catalog subcommand, used like redditcurl catalog query."""
+    parser = argparse.ArgumentParser(prog="redditcurl catalog",
+                                     description="Look up the downloaded images in the catalogue.")
+    parser.add_argument("-d", "--savedir", type=str,
+                        help="The save directory. By default, the one in the configuration file is used.")
+    parser.add_argument("-f", "--savefile", type=str,
+                        help="The file to keep track of images that have been downloaded, "
+                        "which the catalogue is kept next to.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+    query = commands.add_parser("query", help="List the images matching all of the given conditions.")
+    query.add_argument("--subreddit", type=str, help="Only list the images from this subreddit.")
+    query.add_argument("--md5", type=str, help="Only list the images with this md5 hash.")
+    query.add_argument("--url", type=str, help="Only list the images downloaded from this link.")
+    query.add_argument("--id", type=str, dest="submission_id", help="Only list the images of this submission.")
+    query.add_argument("--format", type=str, choices=catalog.FORMATS, default="tsv", dest="output_format")
+    export = commands.add_parser("export", help="Write the whole catalogue to a file.")
+    export.add_argument("--format", type=str, choices=catalog.FORMATS, default="csv", dest="output_format")
+    export.add_argument("-o", "--output", type=str, help="The file to write to, instead of the standard output.")
+    commands.add_parser("stats", help="Count the images and their sizes in each subreddit.")
     return parser
 
 
+def catalog_main(argv):
+    """Run the catalog subcommand, with the arguments following it in argv."""
+    args = setup_catalog_parser().parse_args(argv)
+    conf_r = get_config(argparse.Namespace(savedir=args.savedir, savefile=args.savefile), find_config())["redditcurl"]
+    catalog_path = catalog.catalog_file(os.path.join(conf_r.get("savedir"), conf_r.get("savefile")))
+    if not os.path.isfile(catalog_path):
+        raise ConfigError("There is no catalogue at {}.".format(catalog_path))
+    entries = catalog.Catalog(catalog_path)
+    try:
+        if args.command == "query":
+            catalog.write_entries(entries.query(args.subreddit, args.md5, args.url, args.submission_id), sys.stdout,
+                                  args.output_format)
+        elif args.command == "export":
+            if args.output is None:
+                catalog.write_entries(entries.query(), sys.stdout, args.output_format)
+            else:
+                with open(args.output, "w", encoding="utf-8", newline="") as file:
+                    catalog.write_entries(entries.query(), file, args.output_format)
+        else:
+            for subreddit, files, size in entries.stats():
+                print("{}\t{}\t{}".format(subreddit, files, size))
+    finally:
+        entries.close()
+
+
 def find_config():
     """Find the configuration file."""
     home = os.path.expanduser("~")
@@ -91,8 +244,9 @@ def args2dict(args):
 
     The values that are not set in the command line, meaning the ones that are None
     or False are skipped. All values are turned into strings, so that ConfigParser
-    can read them."""
-    return {k: str(v) for k, v in vars(args).items() if not (v is None or v is False)}
+    can read them. Underscores in the names are turned back into the dashes used on
+    the command line, like prefer_mp4 to prefer-mp4."""
+    return {k.replace("_", "-"): str(v) for k, v in vars(args).items() if not (v is None or v is False)}
 
 
 def get_config(args, config_file):
@@ -125,25 +279,153 @@ def get_config(args, config_file):
     return config
 
 
-def count_success(downloaded, remove, saved):
-    """Count the successful downloads."""
+def unsave(r, fullname):
+    """Unsave the submission with fullname, without needing the praw object for it.
+
+    This sends the same request as praw's Submission.unsave, over OAuth with the save scope.
+    """
+    import praw.decorators
+
+    @praw.decorators.restrict_access(scope="save")
+    def request(r, fullname):
+        return r.request_json(r.config["unsave"], data={"id": fullname, "executed": "unsaved"})
+    request(r, fullname)
+
+
+def count_success(downloaded, remove, saved, r=None):
+    """Count the successful downloads.
+
+    Args:
+        downloaded: A dictionary mapping submission ids to Results, as returned by
+            manager.download_submissions.
+        remove: If True, the successfully downloaded submissions will be unsaved.
+        saved: An iterable containing the manager.Saved records that were downloaded.
+        r: The praw.Reddit session to unsave the submissions with, if remove is True.
+
+    Returns:
+        A tuple of the number of successful downloads, the number of failed downloads
+        and a list of the urls that were successfully downloaded.
+    """
     logger = logging.getLogger("main")
     success_count = 0
     fail_count = 0
     successful_downloads = []
-    for i, submission in enumerate(downloaded):
-        url, successful = submission
-        if not successful:
+    if remove:
+        fullnames = {submission.id: submission.fullname for submission in saved}
+    for result in downloaded.values():
+        if not result.successful:
             fail_count += 1
-            logger.warning("Download failed: {}".format(url))
+            logger.warning("Download failed: {}".format(result.job.url))
         else:  # successful
             success_count += 1
-            successful_downloads.append(url)
+            successful_downloads.append(result.job.url)
             if remove:
-                saved[i].unsave()
+                unsave(r, fullnames[result.job.id])
+    if remove and success_count:
+        # Don't let praw answer the next listing of the saved submissions from its cache
+        r.evict(r.config["saved"])
     return success_count, fail_count, successful_downloads
 
 
+def get_concurrency(conf_r):
+    """Decide on the number of processes to download with.
+
+    Args:
+        conf_r: The redditcurl section of the configuration.
+
+    Returns:
+        A tuple of the number of processes, and a concurrency.Controller if processes
+        is set to auto, otherwise None.
+
+    Raises:
+        ConfigError if processes is neither a number nor auto.
+    """
+    if conf_r.get("processes") == "auto":
+        controller = concurrency.Controller(conf_r.getint("min-processes"), conf_r.getint("max-processes"))
+        return controller.ceiling, controller
+    try:
+        return conf_r.getint("processes"), None
+    except ValueError:
+        raise ConfigError("processes should be a number, or auto.")
+
+
+def get_shard(conf_r):
+    """Decide on the part of the jobs file to download.
+
+    Args:
+        conf_r: The redditcurl section of the configuration.
+
+    Returns:
+        A tuple of the shard to download, starting from 0, and the number of shards.
+
+    Raises:
+        ConfigError if shard isn't like 2/4.
+    """
+    try:
+        shard, shards = (int(part) for part in conf_r.get("shard").split("/"))
+    except ValueError:
+        raise ConfigError("shard should look like 2/4.")
+    if not 1 <= shard <= shards:
+        raise ConfigError("shard should be between 1/{0} and {0}/{0}.".format(shards))
+    return shard - 1, shards
+
+
+def set_rate_limit(conf_r):
+    """Set the bandwidth limit from the configuration.
+
+    Args:
+        conf_r: The redditcurl section of the configuration.
+
+    Raises:
+        ConfigError if max-rate or rate-schedule are invalid.
+    """
+    try:
+        shared_config.MAX_RATE = ratelimit.parse_rate(conf_r.get("max-rate"))
+        shared_config.RATE_SCHEDULE = ratelimit.parse_schedule(conf_r.get("rate-schedule"))
+    except ValueError as err:
+        raise ConfigError(err)
+
+
+def set_s3(conf_r):
+    """Set up uploading the images to S3 from the configuration.
+
+    Raises:
+        ConfigError if the bucket isn't set, or boto3 isn't installed.
+    """
+    if not conf_r.get("s3-bucket"):
+        raise ConfigError("--storage s3 needs a bucket, set with --s3-bucket.")
+    if importlib.util.find_spec("boto3") is None:
+        raise ConfigError("--storage s3 needs boto3, install it with pip install boto3.")
+    shared_config.S3_BUCKET = conf_r.get("s3-bucket")
+    shared_config.S3_PREFIX = conf_r.get("s3-prefix", "")
+    shared_config.S3_ENDPOINT = conf_r.get("s3-endpoint")
+
+
+def check_dedup(conf_r):
+    """Check that the images can be deduplicated as set in the configuration.
+
+    Raises:
+        ConfigError if the action isn't known, the images aren't saved as files,
+        or numpy or Pillow is missing.
+    """
+    if conf_r.get("dedup") not in dedup.ACTIONS:
+        raise ConfigError("dedup should be one of {}.".format(", ".join(dedup.ACTIONS)))
+    if conf_r.get("storage") != "files":
+        raise ConfigError("--dedup only works with --storage files.")
+    if importlib.util.find_spec("numpy") is None or importlib.util.find_spec("PIL") is None:
+        raise ConfigError("--dedup needs numpy and Pillow, install them with pip install redditcurl[dedup].")
+
+
+def deduplicate(conf_r, save_file):
+    """Deal with the near-duplicates among the new images, if --dedup is set."""
+    if "dedup" not in conf_r:
+        return
+    logger = logging.getLogger("main")
+    found = dedup.deduplicate(conf_r.get("savedir"), dedup.index_file(save_file), conf_r.get("dedup"),
+                              conf_r.getint("dedup-distance"))
+    logger.info("Found {} near-duplicate images.".format(found))
+
+
 def is_authenticated(conf):
     """Returns True if the user has OAuth2 tokens set up, False otherwise."""
     return all(("access_token" in conf, "refresh_token" in conf))
@@ -186,13 +468,400 @@ def setup_logger(name, silent):
     return logger
 
 
+def save_tokens(conf, conf_path, access_token, expires, refresh_token=None):
+    """Store the access token and the time it expires in the configuration and the configuration file.
+
+    Only the oauth section of the file is updated, so that the command line options
+    of this run aren't written into it. The refresh token is stored too, if it is given.
+    """
+    tokens = {"oauth": {"access_token": access_token, "access_expires": str(int(expires))}}
+    if refresh_token is not None:
+        tokens["oauth"]["refresh_token"] = refresh_token
+    conf.read_dict(tokens)
+    stored = configparser.ConfigParser()
+    stored.read(conf_path)
+    stored.read_dict(tokens)
+    # Replace the file at once, so that instances starting at the same time never read half of it.
+    # Every instance writes a temporary file of its own, which only the owner can read at first,
+    # since the file holds the refresh token.
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(conf_path) or ".", prefix=".redditcurl")
+    try:
+        with open(descriptor, "w") as conf_file:
+            stored.write(conf_file)
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(conf_path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, conf_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def refresh_token(r, conf, conf_path):
+    """Get a new access token from Reddit, and store it, see save_tokens.
+
+    Returns:
+        The time the new access token expires at.
+    """
+    access_information = r.refresh_access_information(conf["oauth"].get("refresh_token"))
+    expires = time.time() + ACCESS_TOKEN_LIFETIME
+    save_tokens(conf, conf_path, access_information["access_token"], expires)
+    return expires
+
+
+def authenticate(r, conf, conf_path, logger):
+    """Set up OAuth2 access for the Reddit session.
+
+    If the user hasn't authorized redditcurl yet, they will be asked to, and
+    the resulting tokens will be written to the configuration file. The access
+    token in the configuration file is used until it expires, and only then refreshed.
+
+    Args:
+        r: The praw.Reddit session.
+        conf: The configparser.ConfigParser object holding the configuration.
+        conf_path: Path to the configuration file.
+        logger: The logger to report progress with.
+
+    Returns:
+        The time the access token expires at.
+    """
+    conf_o = conf["oauth"]
+    r.set_oauth_app_info(client_id=conf_o.get("clientid"),
+                         redirect_uri=conf_o.get("redirect"),
+                         client_secret="None")
+    if not is_authenticated(conf_o):
+        auth_url = r.get_authorize_url("state", OAUTH_SCOPES, True)
+        print("Please visit {} to authorize access to your account history.".format(auth_url))
+        auth_code = input("Enter the code: ")
+        access_information = r.get_access_information(auth_code)
+        expires = time.time() + ACCESS_TOKEN_LIFETIME
+        save_tokens(conf, conf_path, access_information["access_token"], expires,
+                    access_information["refresh_token"])
+        return expires
+    expires = conf_o.getfloat("access_expires", fallback=0)
+    # An expired token can't look up the user, the user is looked up while refreshing it instead
+    r.set_access_credentials(scope=OAUTH_SCOPES,
+                             access_token=conf_o.get("access_token"),
+                             refresh_token=conf_o.get("refresh_token"),
+                             update_user=time.time() < expires)
+    if time.time() >= expires:
+        logger.info("Refreshing access token.")
+        expires = refresh_token(r, conf, conf_path)
+    return expires
+
+
+class AccessToken:
+    """Keeps the access token of the Reddit session fresh during long downloads, and while watching.
+
+    The token is only refreshed on the main thread, right before the session is used, see
+    check. praw removes the token from the session while refreshing it, so refreshing it
+    in the background would make the requests sent at the same time fail.
+
+    Args:
+        r: The authenticated praw.Reddit session.
+        conf: The configparser.ConfigParser object holding the configuration.
+        conf_path: Path to the configuration file.
+        expires: The time the current access token expires at.
+    """
+    def __init__(self, r, conf, conf_path, expires):
+        self.r = r
+        self.conf = conf
+        self.conf_path = conf_path
+        self.expires = expires
+
+    def check(self):
+        """Refresh the access token if it has expired."""
+        if time.time() >= self.expires:
+            logging.getLogger("main").info("Refreshing access token.")
+            self.expires = refresh_token(self.r, self.conf, self.conf_path)
+
+
+def download_saved(r, conf_r, subreddits, save_file, history, dead_links, seen, pool=None, controller=None,
+                   token=None):
+    """Download the new saved submissions, and add them to the saved files list.
+
+    Only the head of the saved listing is read, up to the first submission in seen.
+
+    Args:
+        r: An authenticated praw.Reddit session.
+        conf_r: The redditcurl section of the configuration.
+        subreddits: A list of subreddits to download from, or an empty list for all subreddits.
+        save_file: Path to the file that keeps track of the downloaded images.
+        history: A set of the urls that have been downloaded, which will be updated.
+        dead_links: A dictionary of the dead links, as returned by manager.read_dead_links,
+            which will be updated.
+        seen: A set of the ids of the submissions that have been listed before. The ids of the
+            listed submissions are added once their downloads are recorded, so that the
+            ones listed by a call that failed partway are listed again by the next one.
+        pool: The worker pool to download with. If None, a pool will be created for this call.
+        controller: A concurrency.Controller, if processes is set to auto.
+        token: An AccessToken, to refresh the access token with before using the session.
+
+    Returns:
+        A tuple of the number of successful and failed downloads.
+    """
+    logger = logging.getLogger("main")
+    if token is not None:
+        token.check()
+    listed = list(manager.slim(manager.take_new(r.user.get_saved(limit=None), seen)))
+    saved = manager.filter_new(listed, save_file, history, dead_links)
+    if len(saved) == 0:
+        seen.update(submission.id for submission in listed)
+        return 0, 0
+    if controller is None:
+        processes = conf_r.getint("processes")
+        logger.info("Starting to download, using {} processes.".format(processes))
+    else:
+        processes = controller.ceiling
+        logger.info("Starting to download, using up to {} processes.".format(processes))
+    downloaded = manager.download_submissions(saved, conf_r.get("savedir"), processes,
+                                              not conf_r.getboolean("notitles"),
+                                              conf_r.getboolean("subfolders"), subreddits, pool=pool,
+                                              controller=controller)
+    logger.info("Processed {} urls.".format(len(downloaded)))
+    remove = conf_r.getboolean("remove")
+    if remove and token is not None:
+        # The downloads may have taken longer than the token lasts
+        token.check()
+    success_count, fail_count, successful_downloads = count_success(downloaded, remove, saved, r)
+    logger.info("Updating saved files list.")
+    manager.sync_files(downloaded.values())
+    manager.update_new(successful_downloads, save_file)
+    history.update(successful_downloads)
+    if manager.update_dead_links(dead_links, downloaded.values()):
+        manager.write_dead_links(dead_links, manager.dead_links_file(save_file))
+    manager.record_failed_jobs(downloaded.values(), manager.failed_jobs_file(save_file))
+    manager.record_files(downloaded.values(), manager.files_file(save_file))
+    record_catalog(save_file, downloaded.values(), saved)
+    seen.update(submission.id for submission in listed)
+    return success_count, fail_count
+
+
+def list_jobs(r, conf_r, subreddits, save_file, history, dead_links):
+    """Returns a list of the Jobs for the new saved submissions.
+
+    The folders of the jobs are relative to the save directory, so that they can be
+    downloaded on another machine.
+    """
+    saved = manager.filter_new(manager.slim(r.user.get_saved(limit=None)), save_file, history, dead_links)
+    record_catalog(save_file, [], saved)
+    download_queue, _ = manager.process_submissions(saved, "", not conf_r.getboolean("notitles"),
+                                                    conf_r.getboolean("subfolders"), subreddits)
+    return download_queue
+
+
+def export_jobs(r, conf_r, subreddits, save_file, history, dead_links, jobs_file):
+    """Write the new saved submissions to jobs_file, instead of downloading them.
+
+    jobs_file can be downloaded later, or on another machine, with download_jobs_file.
+
+    Returns:
+        The number of jobs that were written.
+    """
+    download_queue = list_jobs(r, conf_r, subreddits, save_file, history, dead_links)
+    manager.write_jobs(download_queue, jobs_file)
+    return len(download_queue)
+
+
+def download_work_queue(conf_r, save_file, history, dead_links, work_queue, processes, controller=None):
+    """Download the jobs in a work queue, together with the other instances using it.
+
+    The results are recorded next to save_file like in download_jobs_file.
+
+    Returns:
+        A tuple of the number of successful and failed downloads.
+    """
+    logger = logging.getLogger("main")
+    logger.info("Downloading from the work queue {}.".format(conf_r.get("queue")))
+    downloaded = manager.download_from_queue(work_queue, conf_r.get("savedir"), processes, controller=controller)
+    return record_results(downloaded, save_file, history, dead_links)
+
+
+def download_jobs_file(conf_r, save_file, history, dead_links, processes, controller=None):
+    """Download the jobs in the file written by export_jobs.
+
+    Only the shard of the jobs set in the configuration is downloaded. The history,
+    the dead links and the failed jobs next to save_file are updated like in
+    download_saved, and the histories of the shards can be brought together
+    afterwards with manager.merge_history.
+
+    Returns:
+        A tuple of the number of successful and failed downloads.
+    """
+    logger = logging.getLogger("main")
+    shard, shards = get_shard(conf_r)
+    if not os.path.isfile(conf_r.get("from-jobs")):
+        raise ConfigError("{} doesn't exist.".format(conf_r.get("from-jobs")))
+    download_queue, used_folders = manager.read_jobs(conf_r.get("from-jobs"), conf_r.get("savedir"), shard, shards)
+    now = time.time()
+    download_queue = [job for job in download_queue
+                      if job.url not in history and not manager.is_dead(job.url, dead_links, now)]
+    if len(download_queue) == 0:
+        return 0, 0
+    logger.info("Downloading {} images from {}.".format(len(download_queue), conf_r.get("from-jobs")))
+    downloaded = manager.download_jobs(download_queue, used_folders, processes, controller=controller)
+    return record_results(downloaded, save_file, history, dead_links)
+
+
+def record_results(downloaded, save_file, history, dead_links):
+    """Record the results of downloads that didn't come from the saved listing.
+
+    The history, the dead links and the failed jobs next to save_file are updated.
+
+    Returns:
+        A tuple of the number of successful and failed downloads.
+    """
+    success_count, fail_count, successful_downloads = count_success(downloaded, False, [])
+    manager.sync_files(downloaded.values())
+    manager.update_new(successful_downloads, save_file)
+    history.update(successful_downloads)
+    if manager.update_dead_links(dead_links, downloaded.values()):
+        manager.write_dead_links(dead_links, manager.dead_links_file(save_file))
+    manager.record_failed_jobs(downloaded.values(), manager.failed_jobs_file(save_file))
+    manager.record_files(downloaded.values(), manager.files_file(save_file))
+    record_catalog(save_file, downloaded.values())
+    return success_count, fail_count
+
+
+def record_catalog(save_file, results, submission_list=()):
+    """Add the submissions, and the files written by results, to the catalogue next to save_file."""
+    entries = catalog.Catalog(catalog.catalog_file(save_file))
+    try:
+        entries.add_submissions(submission_list)
+        entries.add_files(results)
+    finally:
+        entries.close()
+
+
+def record_moves(save_file, moves):
+    """Update the paths in the files list and the catalogue next to save_file, after the files were moved.
+
+    Args:
+        save_file: Path to the savefile.
+        moves: A dictionary mapping the old paths of the files to their new paths, see layout.migrate.
+    """
+    manager.move_files(moves, manager.files_file(save_file))
+    catalog_path = catalog.catalog_file(save_file)
+    if os.path.isfile(catalog_path):
+        entries = catalog.Catalog(catalog_path)
+        try:
+            entries.move_files(moves)
+        finally:
+            entries.close()
+
+
+def retry_failed(save_file, history, dead_links, processes, controller=None):
+    """Retry the downloads that failed in the earlier runs.
+
+    The failed downloads are read from the failed jobs file next to save_file, so
+    Reddit isn't contacted at all. Links that are known to be dead are skipped
+    until it is time to check them again.
+
+    Returns:
+        A tuple of the number of successful and failed downloads.
+    """
+    logger = logging.getLogger("main")
+    failed_file = manager.failed_jobs_file(save_file)
+    now = time.time()
+    download_queue = [result.job for result in manager.read_failed_jobs(failed_file).values()
+                      if result.job.url not in history and not manager.is_dead(result.job.url, dead_links, now)]
+    if len(download_queue) == 0:
+        return 0, 0
+    logger.info("Retrying {} failed downloads.".format(len(download_queue)))
+    downloaded = manager.download_jobs(download_queue, {job.folder for job in download_queue}, processes,
+                                       controller=controller)
+    return record_results(downloaded, save_file, history, dead_links)
+
+
+def scan_savedir(conf_r, save_file, history, processes):
+    """Check the files in the save directory, and queue the damaged ones to be downloaded again.
+
+    The damaged files are removed, and the jobs they were downloaded for are added to
+    the failed jobs file, to be downloaded again by retry_failed. Only the files in the
+    files list next to save_file can be queued, the others are only reported.
+
+    Returns:
+        A tuple of the number of damaged files, and the number of jobs that were queued.
+    """
+    logger = logging.getLogger("main")
+    if conf_r.get("storage") != "files":
+        raise ConfigError("--scan only works with --storage files.")
+    recorded = manager.read_files(manager.files_file(save_file))
+    # Images replaced with a link or removed by --dedup are expected to differ from the list
+    resolved = dedup.read_resolved(dedup.index_file(save_file))
+    recorded = {path: entry for path, entry in recorded.items()
+                if os.path.relpath(path, conf_r.get("savedir")) not in resolved}
+    logger.info("Checking the files in {}.".format(conf_r.get("savedir")))
+    damaged = scan.scan(conf_r.get("savedir"), recorded, max(1, processes))
+    jobs = {}
+    for path, problem in sorted(damaged.items()):
+        logger.warning("{}: {}".format(path, problem))
+        if path in recorded:
+            job = recorded[path][1]
+            jobs[job.id] = job
+            if os.path.exists(path):
+                os.remove(path)
+    if jobs:
+        urls = [job.url for job in jobs.values()]
+        manager.forget_history(urls, save_file)
+        history.difference_update(urls)
+        manager.record_failed_jobs([manager.Result(job, False, "DamagedFile") for job in jobs.values()],
+                                   manager.failed_jobs_file(save_file))
+    return len(damaged), len(jobs)
+
+
+def watch(r, conf, subreddits, save_file, history, dead_links, processes, controller=None, token=None):
+    """Keep polling the saved listing, downloading new submissions as they show up.
+
+    The Reddit session, the worker pool and the history are kept between polls.
+    Only returns when interrupted.
+    """
+    import praw
+    import requests
+    logger = logging.getLogger("main")
+    conf_r = conf["redditcurl"]
+    interval = conf_r.getint("watch")
+    seen = set()
+    logger.info("Watching for new saved submissions every {} seconds.".format(interval))
+    pool = manager.create_pool(processes)
+    try:
+        while True:
+            try:
+                success_count, fail_count = download_saved(r, conf_r, subreddits, save_file, history,
+                                                           dead_links, seen, pool, controller, token)
+                if success_count or fail_count:
+                    logger.info("Successful: {} \t Failed: {}".format(success_count, fail_count))
+                if success_count:
+                    deduplicate(conf_r, save_file)
+            except (praw.errors.PRAWException,
+                    requests.exceptions.RequestException) as err:
+                # Keep watching, the next poll may succeed
+                logger.error(err)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            manager.close_pool(pool)
+
+
 def __main__():
+    if sys.argv[1:2] == ["catalog"]:
+        try:
+            catalog_main(sys.argv[2:])
+        except ConfigError as err:
+            logging.error(err)
+        return
+    args = setup_parser().parse_args()
+    # praw and requests are slow to import, so they are imported after the arguments
+    # are parsed to keep --help fast.
+    import praw
+    import requests
     try:
-        args = setup_parser().parse_args()
         conf_path = find_config()
         conf = get_config(args, conf_path)
         conf_r = conf["redditcurl"]
-        conf_o = conf["oauth"]
         logger = setup_logger("main", conf_r.getboolean("silent"))
         if conf_r.get("subreddits") == "":
             subreddits = []
@@ -200,50 +869,103 @@ def __main__():
             subreddits = conf_r.get("subreddits").strip(',').casefold().split(',')
             logger.info("Downloading from {}".format(', '.join(subreddits)))
         if conf_r.getboolean("prefer-mp4"):
-            shared_config.PREFER_WEBM = False
+            shared_config.PREFER_MP4 = True
+        if conf_r.get("format-policy") not in formats.FORMAT_POLICIES:
+            raise ConfigError("format-policy should be one of {}.".format(", ".join(formats.FORMAT_POLICIES)))
+        shared_config.FORMAT_POLICY = conf_r.get("format-policy")
         if not conf_r.getboolean("nofilehash"):
             shared_config.FILENAME_HASH = True
-        logger.info("Connecting to Reddit.")
-        r = praw.Reddit(user_agent="redditcurl")
-        r.set_oauth_app_info(client_id=conf_o.get("clientid"),
-                             redirect_uri=conf_o.get("redirect"),
-                             client_secret="None")
-        if not is_authenticated(conf_o):
-            auth_url = r.get_authorize_url("state", OAUTH_SCOPES, True)
-            print("Please visit {} to authorize access to your account history.".format(auth_url))
-            auth_code = input("Enter the code: ")
-            access_information = r.get_access_information(auth_code)
-            conf.read_dict({"oauth":
-                            {"refresh_token": access_information["refresh_token"],
-                             "access_token": access_information["access_token"]}})
-            with open(conf_path, "w") as conf_file:
-                conf.write(conf_file)
-        else:
-            r.set_access_credentials(scope=OAUTH_SCOPES,
-                                     access_token=conf_o.get("access_token"),
-                                     refresh_token=conf_o.get("refresh_token"))
-            logger.info("Refreshing access token.")
-            r.refresh_access_information(conf_o.get("refresh_token"))
-            # We don't save the new access_token here, since we refresh it every time the program is run
-        logger.info("Getting data...")
+        if conf_r.getboolean("nosync"):
+            shared_config.SYNC = False
+        shared_config.CONNECT_TIMEOUT = conf_r.getfloat("connect-timeout")
+        shared_config.READ_TIMEOUT = conf_r.getfloat("read-timeout")
+        shared_config.DOWNLOAD_DEADLINE = conf_r.getfloat("deadline")
+        shared_config.SEGMENTS = conf_r.getint("segments")
+        set_rate_limit(conf_r)
+        if conf_r.get("layout") not in layout.LAYOUTS:
+            raise ConfigError("layout should be one of {}.".format(", ".join(layout.LAYOUTS)))
+        shared_config.LAYOUT = conf_r.get("layout")
+        if conf_r.get("storage") not in storage.STORAGES:
+            raise ConfigError("storage should be one of {}.".format(", ".join(storage.STORAGES)))
+        shared_config.STORAGE = conf_r.get("storage")
+        shared_config.ARCHIVE_DIR = conf_r.get("savedir")
+        shared_config.VOLUME_SIZE = conf_r.getint("volume-size") * 1024 * 1024
+        if shared_config.STORAGE == "s3":
+            set_s3(conf_r)
+        if "dedup" in conf_r:
+            check_dedup(conf_r)
+        processes, controller = get_concurrency(conf_r)
         try:
             os.makedirs(conf_r.get("savedir"))
         except FileExistsError:
             # If the save directory exists, we don't need to create it
             pass
         save_file = os.path.join(conf_r.get("savedir"), conf_r.get("savefile"))
-        saved = manager.filter_new(r.user.get_saved(limit=None), save_file)
-        logger.info("Starting to download, using {} processes.".format(conf_r.get("processes")))
-        downloaded = manager.download_submissions(saved, conf_r.get("savedir"), conf_r.getint("processes"),
-                                                  not conf_r.getboolean("notitles"),
-                                                  conf_r.getboolean("subfolders"), subreddits)
-        logger.info("Processed {} urls.".format(len(downloaded)))
-        remove = conf_r.getboolean("remove")
-        success_count, fail_count, successful_downloads = count_success(downloaded, remove, saved)
-        logger.info("Updating saved files list.")
-        manager.update_new(successful_downloads, save_file)
-        logger.info("\nDownloading finished.")
-        logger.info("Successful: {} \t Failed: {}".format(success_count, fail_count))
+        history = manager.read_history(save_file)
+        dead_links = manager.read_dead_links(manager.dead_links_file(save_file))
+        if conf_r.getboolean("migrate-layout"):
+            moved = layout.migrate(conf_r.get("savedir"), conf_r.get("layout"))
+            record_moves(save_file, moved)
+            logger.info("Moved {} files to the {} layout.".format(len(moved), conf_r.get("layout")))
+            return
+        if "merge-history" in conf_r:
+            other_files = conf_r.get("merge-history").strip(",").split(",")
+            for other_file in other_files:
+                if not os.path.isfile(other_file):
+                    raise ConfigError("{} doesn't exist.".format(other_file))
+            added = manager.merge_history(save_file, other_files)
+            logger.info("Added {} downloaded images to {}.".format(added, save_file))
+            return
+        if conf_r.getboolean("scan"):
+            damaged, queued = scan_savedir(conf_r, save_file, history, processes)
+            logger.info("Found {} damaged files, queued {} downloads to retry.".format(damaged, queued))
+            if not conf_r.getboolean("retry-failed"):
+                return
+        if "queue" in conf_r:
+            from redditcurl import workqueue
+            work_queue = workqueue.SQLiteQueue(conf_r.get("queue"))
+        else:
+            work_queue = None
+        if conf_r.getboolean("retry-failed") or "from-jobs" in conf_r or conf_r.getboolean("queue-worker"):
+            if conf_r.getboolean("retry-failed"):
+                success_count, fail_count = retry_failed(save_file, history, dead_links, processes, controller)
+            elif "from-jobs" in conf_r:
+                success_count, fail_count = download_jobs_file(conf_r, save_file, history, dead_links,
+                                                               processes, controller)
+            else:
+                if work_queue is None:
+                    raise ConfigError("--queue-worker needs a queue, set with --queue.")
+                success_count, fail_count = download_work_queue(conf_r, save_file, history, dead_links,
+                                                                work_queue, processes, controller)
+            logger.info("\nDownloading finished.")
+            logger.info("Successful: {} \t Failed: {}".format(success_count, fail_count))
+            deduplicate(conf_r, save_file)
+            return
+        logger.info("Connecting to Reddit.")
+        r = praw.Reddit(user_agent="redditcurl")
+        token = AccessToken(r, conf, conf_path, authenticate(r, conf, conf_path, logger))
+        logger.info("Getting data...")
+        if "export-jobs" in conf_r:
+            exported = export_jobs(r, conf_r, subreddits, save_file, history, dead_links, conf_r.get("export-jobs"))
+            logger.info("Wrote {} images to {}.".format(exported, conf_r.get("export-jobs")))
+            return
+        if work_queue is not None:
+            added = work_queue.add(list_jobs(r, conf_r, subreddits, save_file, history, dead_links))
+            logger.info("Added {} images to the work queue.".format(added))
+            success_count, fail_count = download_work_queue(conf_r, save_file, history, dead_links,
+                                                            work_queue, processes, controller)
+            logger.info("\nDownloading finished.")
+            logger.info("Successful: {} \t Failed: {}".format(success_count, fail_count))
+            deduplicate(conf_r, save_file)
+            return
+        if conf_r.getint("watch") > 0:
+            watch(r, conf, subreddits, save_file, history, dead_links, processes, controller, token)
+        else:
+            success_count, fail_count = download_saved(r, conf_r, subreddits, save_file, history, dead_links,
+                                                       set(), controller=controller, token=token)
+            logger.info("\nDownloading finished.")
+            logger.info("Successful: {} \t Failed: {}".format(success_count, fail_count))
+            deduplicate(conf_r, save_file)
     except (praw.errors.PRAWException,
             requests.exceptions.RequestException) as err:
         logger.error(err)
@@ -0,0 +1,180 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# The catalogue of the downloaded files, linking every file to the submission it was
+# downloaded for, kept in an SQLite database next to the savefile.
+import os
+import csv
+import json
+import time
+import sqlite3
+import collections
+from redditcurl import websites
+
+# The formats write_entries can write.
+FORMATS = ("tsv", "csv", "jsonl")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    permalink TEXT NOT NULL,
+    title TEXT,
+    subreddit TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    submission_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    downloader TEXT,
+    downloaded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_subreddit ON submissions (subreddit COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS files_submission ON files (submission_id);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+CREATE INDEX IF NOT EXISTS files_url ON files (url);
+"""
+
+_SELECT = """
+SELECT files.path, files.size, files.md5, files.url, submissions.permalink, files.submission_id,
+       submissions.subreddit, submissions.title, files.downloader, submissions.created, files.downloaded
+FROM files LEFT JOIN submissions ON submissions.id = files.submission_id
+"""
+
+# A file in the catalogue. path is relative to the folder of the catalogue, url is the link
+# of the submission, and permalink is the link to the submission on Reddit. created and
+# downloaded are the times the submission was posted and the file was downloaded.
+# subreddit, title and created are None if the submission wasn't listed by this instance,
+# such as when downloading a jobs file written on another machine.
+Entry = collections.namedtuple("Entry", ["path", "size", "md5", "url", "permalink", "submission_id", "subreddit",
+                                         "title", "downloader", "created", "downloaded"])
+
+
+def catalog_file(downloaded_file):
+    """Returns the path of the catalogue kept next to downloaded_file, like .downloaded.catalog.db."""
+    return os.path.splitext(downloaded_file)[0] + ".catalog.db"
+
+
+def permalink(submission_id):
+    """Returns the link to a submission on Reddit."""
+    return "https://www.reddit.com/comments/{}/".format(submission_id)
+
+
+class Catalog:
+    """The catalogue of the downloaded files, kept in an SQLite database.
+
+    The files can be looked up by subreddit, md5 hash, url or submission, which
+    are all indexed, so lookups stay fast for any number of files.
+
+    Args:
+        path: Path to the database. It will be created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(path) or "."
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(_SCHEMA)
+
+    def add_submissions(self, submission_list):
+        """Add Saved records to the catalogue, replacing the ones already in it."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO submissions (id, url, permalink, title, subreddit, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(sub.id, sub.url, permalink(sub.id), sub.title, sub.subreddit, sub.created)
+                 for sub in submission_list])
+
+    def add_files(self, results):
+        """Add the files written by the successful downloads to the catalogue.
+
+        Args:
+            results: An iterable of manager.Results.
+        """
+        now = time.time()
+        files = []
+        submissions = []
+        for result in results:
+            if not result.successful:
+                continue
+            downloader = websites.find(result.job.url)
+            submissions.append((result.job.id, result.job.url, permalink(result.job.id)))
+            for path, size, content_hash in result.files:
+                files.append((os.path.relpath(path, self.root), size, content_hash, result.job.id, result.job.url,
+                              downloader.name if downloader is not None else None, now))
+        with self.connection:
+            # The submissions are usually added already, while listing the saved submissions
+            self.connection.executemany("INSERT OR IGNORE INTO submissions (id, url, permalink) VALUES (?, ?, ?)",
+                                        submissions)
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", files)
+
+    def move_files(self, moves):
+        """Update the paths of the files that were moved.
+
+        Args:
+            moves: A dictionary mapping the old paths of the files to their new paths.
+        """
+        with self.connection:
+            self.connection.executemany("UPDATE files SET path = ? WHERE path = ?",
+                                        [(os.path.relpath(new, self.root), os.path.relpath(old, self.root))
+                                         for old, new in moves.items()])
+
+    def query(self, subreddit=None, md5=None, url=None, submission_id=None):
+        """Find the files matching all of the given conditions, or all files if none are given.
+
+        subreddit is matched ignoring case.
+
+        Returns:
+            A list of Entries, sorted by their paths.
+        """
+        conditions = [(condition, value) for condition, value in (
+            ("submissions.subreddit = ? COLLATE NOCASE", subreddit), ("files.md5 = ?", md5),
+            ("files.url = ?", url), ("files.submission_id = ?", submission_id)) if value is not None]
+        query = _SELECT
+        if conditions:
+            query += "WHERE " + " AND ".join(condition for condition, _ in conditions)
+        query += " ORDER BY files.path"
+        return [Entry(*row) for row in self.connection.execute(query, [value for _, value in conditions])]
+
+    def stats(self):
+        """Returns a list of (subreddit, files, bytes) tuples, with the most files first.
+
+        The files whose submissions are not known are counted under None.
+        """
+        return self.connection.execute(
+            "SELECT submissions.subreddit, COUNT(*), SUM(files.size) "
+            "FROM files LEFT JOIN submissions ON submissions.id = files.submission_id "
+            "GROUP BY submissions.subreddit COLLATE NOCASE ORDER BY COUNT(*) DESC").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def write_entries(entries, file, output_format="tsv"):
+    """Write Entries to a text file in one of FORMATS.
+
+    tsv and csv have a header row with the names of the fields, and jsonl has a JSON object on each line.
+    """
+    if output_format == "jsonl":
+        for entry in entries:
+            file.write(json.dumps(entry._asdict()) + "\n")
+        return
+    writer = csv.writer(file, dialect="excel-tab" if output_format == "tsv" else "excel", lineterminator="\n")
+    writer.writerow(Entry._fields)
+    writer.writerows(entries)
@@ -0,0 +1,135 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+import logging
+import statistics
+import collections
+
+logger = logging.getLogger("main")
+
+# A window of downloads whose throughput dropped by more than this fraction, after
+# the limit was raised, makes the controller step back.
+THROUGHPUT_DROP = 0.1
+
+# A window of downloads whose median latency grew by more than this fraction, after the
+# limit was raised, makes the controller step back unless the throughput grew as well.
+# Downloads waiting on each other at the website or on the connection take longer
+# without bringing in more bytes, so the extra downloads only add to the queue.
+LATENCY_RISE = 0.5
+
+
+class Controller:
+    """Decides how many downloads may run at once, in total and for each host.
+
+    The limits are adjusted with additive increase, multiplicative decrease (AIMD):
+    after each window of downloads, as many as the current limit, the total limit is
+    raised by one, unless the throughput dropped since the last raise, or the median
+    latency of the downloads rose without the throughput rising. When a website
+    answers with 429 or a 5xx status, the limits for that host and the total limit are
+    halved, at most once per window.
+
+    Args:
+        floor: The lowest total limit, also the limit to start with.
+        ceiling: The highest total limit.
+    """
+    def __init__(self, floor, ceiling):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.limit = self.floor
+        self.host_limits = {}
+        self.running = 0
+        self.host_running = collections.Counter()
+        self.raised = False
+        self.previous_throughput = 0
+        self.previous_latency = None
+        self._new_window()
+
+    def _new_window(self):
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.window_bytes = 0
+        self.window_latencies = []
+        self.window_throttled = False
+
+    def _set_limit(self, limit, reason):
+        limit = min(self.ceiling, max(self.floor, limit))
+        if limit != self.limit:
+            logger.info("Concurrency {} -> {}: {}".format(self.limit, limit, reason))
+        self.raised = limit > self.limit
+        self.limit = limit
+
+    def can_start(self, host):
+        """Return True if another download from host may start now."""
+        return (self.running < self.limit and
+                self.host_running[host] < self.host_limits.get(host, self.limit))
+
+    def has_room(self):
+        """Return True if another download may start now, from any host."""
+        return self.running < self.limit
+
+    def started(self, host):
+        """Record that a download from host has started."""
+        self.running += 1
+        self.host_running[host] += 1
+
+    def finished(self, host, elapsed, nbytes, throttled):
+        """Record that a download from host has finished, and adjust the limits.
+
+        Args:
+            host: The host the download was from.
+            elapsed: The number of seconds the download took.
+            nbytes: The number of bytes that were downloaded.
+            throttled: True if the host answered with 429 or a 5xx status.
+        """
+        self.running -= 1
+        self.host_running[host] -= 1
+        self.window_count += 1
+        self.window_bytes += nbytes
+        self.window_latencies.append(elapsed)
+        if throttled:
+            host_limit = max(1, self.host_limits.get(host, self.limit) // 2)
+            if host_limit != self.host_limits.get(host):
+                logger.info("Concurrency for {} -> {}: throttled".format(host, host_limit))
+            self.host_limits[host] = host_limit
+            if not self.window_throttled:
+                self.window_throttled = True
+                self._set_limit(self.limit // 2, "throttled by {}".format(host))
+        if self.window_count >= self.limit:
+            self._end_window()
+
+    def _end_window(self):
+        elapsed = max(time.monotonic() - self.window_start, 1e-6)
+        throughput = self.window_bytes / elapsed
+        latency = statistics.median(self.window_latencies)
+        if not self.window_throttled:
+            if self.raised and throughput < self.previous_throughput * (1 - THROUGHPUT_DROP):
+                self._set_limit(self.limit - 1, "throughput fell to {:.0f} B/s".format(throughput))
+            elif (self.raised and self.previous_latency is not None and throughput <= self.previous_throughput and
+                  latency > self.previous_latency * (1 + LATENCY_RISE)):
+                self._set_limit(self.limit - 1, "latency rose to {:.2f} s".format(latency))
+            else:
+                reason = "throughput {:.0f} B/s, latency {:.2f} s".format(throughput, latency)
+                self._set_limit(self.limit + 1, reason)
+            # Hosts that haven't throttled for a whole window get some room back
+            for host in list(self.host_limits):
+                self.host_limits[host] += 1
+                if self.host_limits[host] >= self.ceiling:
+                    del self.host_limits[host]
+        self.previous_throughput = throughput
+        self.previous_latency = latency
+        self._new_window()
@@ -0,0 +1,241 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Finds images that were downloaded more than once, such as the same image uploaded
+# again at a different size, by comparing perceptual hashes. Needs numpy and Pillow,
+# which are only imported when used.
+import os
+import gzip
+import json
+import logging
+import multiprocessing
+from redditcurl import manager
+
+logger = logging.getLogger("main")
+
+# What to do with the images that look like an image downloaded before them.
+ACTIONS = ("flag", "link", "remove")
+
+# Images whose hashes differ in at most this many of their 64 bits are considered the same.
+MAX_DISTANCE = 6
+
+# The hashes are made from a HASH_SIZE + 1 by HASH_SIZE pixel thumbnail of the image.
+HASH_SIZE = 8
+
+# The number of hashes HashIndex makes room for at first. It doubles whenever it fills up.
+INITIAL_CAPACITY = 1024
+
+
+def index_file(downloaded_file):
+    """Returns the path of the file keeping the hashes of the images, next to downloaded_file."""
+    return manager.sidecar_file(downloaded_file, "phash")
+
+
+def dhash(path):
+    """Return the difference hash of the image at path.
+
+    The hash has a bit for each pair of neighbouring pixels in a small grayscale
+    thumbnail of the image, telling which of them is brighter. Resizing or
+    recompressing the image changes few, if any, of the bits.
+
+    Returns:
+        The hash as a 64 bit integer, or None if the file isn't an image Pillow can read.
+    """
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            thumbnail = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    pixels = thumbnail.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def _popcount(values):
+    """Return the number of bits set in each element of a numpy array of uint64s."""
+    import numpy
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(values)
+    # numpy before 2.0 can't count bits, so count them a byte at a time
+    table = numpy.array([bin(byte).count("1") for byte in range(256)], dtype=numpy.uint8)
+    return table[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex:
+    """The hashes of the images, searchable by their Hamming distance.
+
+    The hashes are kept in a numpy array, so a search compares the hash with all
+    of them at once. That takes a few milliseconds even with a million images.
+
+    Attributes:
+        paths: The paths of the images, in the order they were added.
+    """
+    def __init__(self):
+        import numpy
+        self._hashes = numpy.zeros(INITIAL_CAPACITY, dtype=numpy.uint64)
+        self.paths = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, value, path):
+        """Add the hash of the image at path to the index."""
+        import numpy
+        if len(self.paths) == len(self._hashes):
+            self._hashes = numpy.concatenate([self._hashes, numpy.zeros_like(self._hashes)])
+        self._hashes[len(self.paths)] = value
+        self.paths.append(path)
+
+    def search(self, value, max_distance=MAX_DISTANCE):
+        """Find the images with a hash at most max_distance bits away from value.
+
+        Returns:
+            A list of (distance, path) tuples, closest first.
+        """
+        import numpy
+        distances = _popcount(self._hashes[:len(self.paths)] ^ numpy.uint64(value))
+        return sorted((int(distances[i]), self.paths[i]) for i in numpy.flatnonzero(distances <= max_distance))
+
+
+def _read_entries(index_path):
+    """Yield the (path, hash, original) entries written by deduplicate, see read_index."""
+    try:
+        with gzip.open(index_path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                # Only the images that were linked or removed have an original
+                yield entry[0], entry[1], entry[2] if len(entry) > 2 else None
+    except FileNotFoundError:
+        pass
+
+
+def read_index(index_path):
+    """Read the hashes written by deduplicate.
+
+    Each line of the file is a JSON list of the path of a file relative to the save
+    directory and its hash, or null if it isn't an image. Images that were replaced
+    with a link or removed also have the path of the image they look like.
+
+    Args:
+        index_path: Path to a .gz file, see index_file. If the file doesn't exist,
+            an empty index is returned.
+
+    Returns:
+        A tuple of a HashIndex of the images, and a set of the paths of all the files
+        that have been hashed, including the ones that aren't images.
+    """
+    index = HashIndex()
+    known = set()
+    for path, value, original in _read_entries(index_path):
+        known.add(path)
+        # Resolved images are the same as their original, which is in the index already
+        if value is not None and original is None:
+            index.add(value, path)
+    return index, known
+
+
+def read_resolved(index_path):
+    """Returns a dictionary mapping the paths of the images that were replaced with a link or
+    removed by deduplicate, relative to the save directory, to the paths of their originals.
+
+    Doesn't need numpy or Pillow.
+    """
+    return {path: original for path, _, original in _read_entries(index_path) if original is not None}
+
+
+def _files(savedir):
+    """Yield the paths of the files in savedir and its subfolders, leaving out the hidden ones."""
+    for folder, folders, files in os.walk(savedir):
+        folders[:] = [name for name in folders if not name.startswith(".")]
+        for name in files:
+            if not name.startswith("."):
+                yield os.path.join(folder, name)
+
+
+def _resolve(path, original, action):
+    """Deal with the image at path, which looks like original, as action says.
+
+    Returns:
+        True if the image was replaced with a link or removed, False if it was left alone.
+    """
+    logger.warning("{} looks like {}.".format(path, original))
+    if action == "remove":
+        os.remove(path)
+        return True
+    elif action == "link":
+        link_path = path + ".link"
+        try:
+            os.link(original, link_path)
+        except OSError as err:
+            logger.warning("Can't link {} to {}: {}".format(path, original, err))
+            return False
+        os.replace(link_path, path)
+        return True
+    return False
+
+
+def deduplicate(savedir, index_path, action="flag", max_distance=MAX_DISTANCE, processes=None):
+    """Hash the files in savedir that weren't hashed before, and deal with the near-duplicates.
+
+    The hashing is done in a pool of its own, with a process for each CPU by default,
+    since it is limited by the CPU rather than the network. Images are compared with
+    the ones that were downloaded before them, so the first copy is always the one kept.
+
+    The images that are replaced or removed are recorded in the index, so that scan
+    doesn't take them for damaged files, see read_resolved.
+
+    Args:
+        savedir: The save directory.
+        index_path: The file keeping the hashes, see index_file. It will be updated.
+        action: One of ACTIONS. "flag" only logs the duplicates, "link" replaces them
+            with hard links to the first copy, and "remove" deletes them.
+        max_distance: See MAX_DISTANCE.
+        processes: The number of processes to hash with, or None for one for each CPU.
+
+    Returns:
+        The number of near-duplicates found.
+    """
+    index, known = read_index(index_path)
+    new_files = [path for path in _files(savedir) if os.path.relpath(path, savedir) not in known]
+    if len(new_files) == 0:
+        return 0
+    new_files.sort(key=os.path.getmtime)
+    logger.info("Hashing {} new files.".format(len(new_files)))
+    with multiprocessing.Pool(processes) as pool:
+        hashes = pool.map(dhash, new_files, chunksize=16)
+    found = 0
+    with gzip.open(index_path, "at", encoding="utf-8") as file:
+        for path, value in zip(new_files, hashes):
+            name = os.path.relpath(path, savedir)
+            entry = [name, value]
+            if value is not None:
+                originals = [match for _, match in index.search(value, max_distance)
+                             if os.path.exists(os.path.join(savedir, match))]
+                if originals:
+                    found += 1
+                    if _resolve(path, os.path.join(savedir, originals[0]), action):
+                        entry.append(originals[0])
+                if len(entry) == 2:
+                    index.add(value, name)
+            file.write(json.dumps(entry) + "\n")
+    return found
@@ -22,6 +22,16 @@ class DownloadError(Exception):
     pass
 
 
+class DownloadTimeout(DownloadError):
+    """The exception which is raised when a download runs past its deadline."""
+    pass
+
+
+class DeadLinkError(DownloadError):
+    """The exception which is raised when an image has been removed from the website for good."""
+    pass
+
+
 class ConfigError(Exception):
     """The exception which is raised when a required configuration was not set."""
     pass
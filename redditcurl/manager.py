@@ -17,13 +17,23 @@
 """
 import os
 import sys
+import time
+import queue
 import multiprocessing
+import multiprocessing.util
 import gzip
 import json
 import logging
+import collections
+import contextlib
+import itertools
+import urllib.parse
+import signal
+import threading
+import zlib
 from redditcurl import websites
-from redditcurl.exceptions import DownloadError
-from requests.exceptions import RequestException
+from redditcurl.websites import shared_config
+from redditcurl.exceptions import DownloadError, DownloadTimeout
 from zipfile import BadZipFile
 
 
@@ -42,13 +52,90 @@ if sys.platform == "win32" or sys.platform == "cygwin":
 else:
     _FILENAME_MAP = {ord("/"): " "}
 
+logger = logging.getLogger("main")
 
-def manage_download(url, path, file_name=""):
+# Upper limit for the number of jobs sent to a worker at once, and how many chunks
+# each worker should get at least. See chunk_size.
+MAX_CHUNKSIZE = 16
+CHUNKS_PER_PROCESS = 4
+
+# Rough sizes of the downloads from each downloader, in bytes, used when scheduling
+# the downloads. Albums and videos take much longer than single images.
+SIZE_ESTIMATES = {"imgur_album": 20 * 1024 * 1024,
+                  "gfycat": 8 * 1024 * 1024,
+                  "imgur_gifv": 8 * 1024 * 1024,
+                  "redditbooru_gallery": 4 * 1024 * 1024}
+DEFAULT_SIZE_ESTIMATE = 1024 * 1024
+
+# Extra seconds the watchdog waits for a result, on top of the download deadlines.
+WATCHDOG_GRACE = 30
+
+# Links that are gone from their websites are skipped until it is time to check them again.
+# The first recheck is a day later, doubling after every check that finds them still gone.
+DEAD_RECHECK_BASE = 24 * 60 * 60
+DEAD_RECHECK_MAX = 180 * 24 * 60 * 60
+
+# Errors of downloads that can't succeed when they are tried again. No downloader
+# supports the links that are Unsupported, so they aren't kept as failed jobs.
+PERMANENT_ERRORS = {"Unsupported"}
+
+
+# A single item in the download queue. id is the id of the submission the job was created from,
+# which is used to match the download results back to the submissions.
+Job = collections.namedtuple("Job", ["id", "url", "folder", "title"])
+
+# A saved submission, holding only what redditcurl needs from the praw.objects.Submission.
+# subreddit is the name of the subreddit, and created is the time it was submitted, in UTC.
+Saved = collections.namedtuple("Saved", ["id", "fullname", "url", "title", "subreddit", "created"])
+
+# The outcome of a download, carrying the job it belongs to. error is the name of the
+# exception that made the download fail, or None. files is a tuple of (path, size, md5)
+# tuples of the files the download wrote, see storage.take_written.
+Result = collections.namedtuple("Result", ["job", "successful", "error", "files"], defaults=(None, ()))
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Raise DownloadTimeout inside the block if it runs for longer than seconds.
+
+    The time spent waiting for the bandwidth limit doesn't count, so that large files
+    can be downloaded under a low --max-rate. Uses SIGALRM, which interrupts the
+    blocking reads of a stalled connection.
+    The deadline is only enforced in the main thread of a process, on platforms
+    that support SIGALRM. Otherwise, or if seconds is 0, the block runs unlimited.
+    """
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    from redditcurl.websites import ratelimit
+    counted = ratelimit.throttled_time()
+
+    def expire(signum, frame):
+        nonlocal counted
+        throttled = ratelimit.throttled_time() - counted
+        if throttled > 0:
+            # Give back the time spent waiting for the bandwidth limit since the timer was set
+            counted += throttled
+            signal.setitimer(signal.ITIMER_REAL, throttled)
+            return
+        raise DownloadTimeout("Download didn't finish in {} seconds.".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def attempt_download(url, path, file_name=""):
     """Decide on the function to download the image and handle errors.
 
     The function should not raise any errors unless it is critical.
     Failure to download the image or find a suitable method will only
-    make the function return False.
+    be reported in the return value.
 
     Args:
         url: A url to an image or images. Depending on the website,
@@ -58,19 +145,240 @@ def manage_download(url, path, file_name=""):
             If file_name is an empty string, name of the downloaded file will be used.
 
     Returns:
-        True if download was completed successfully.
-        Otherwise, False.
+        None if download was completed successfully.
+        Otherwise, the name of the error that made it fail, such as DeadLinkError.
     """
-    logger = logging.getLogger("main")
+    # requests is only imported once there is something to download, to keep the startup fast
+    from requests.exceptions import RequestException
     try:
-        for downloader in websites.downloaders:
-            if downloader.match(url):
+        downloader = websites.find(url)
+        if downloader is None:
+            return "Unsupported"
+        try:
+            with deadline(shared_config.DOWNLOAD_DEADLINE):
                 downloader.download(url, path, file_name)
-                return url, True
-        return url, False
+        except BaseException:
+            # The deadline in particular can stop a download before it removed its temporary files
+            from redditcurl.websites import storage
+            storage.remove_partial()
+            raise
+        return None
     except (OSError, IOError, AttributeError, IndexError, ValueError, DownloadError, RequestException, BadZipFile) as err:
         logger.info("Error while downloading {} : {}".format(url, str(err)))
-        return url, False
+        return type(err).__name__
+
+
+def manage_download(url, path, file_name=""):
+    """Download the image at url, see attempt_download.
+
+    Returns:
+        A tuple of the url, and True if download was completed successfully, otherwise False.
+    """
+    return url, attempt_download(url, path, file_name) is None
+
+
+def download_job(job):
+    """Download a single job from the download queue.
+
+    Args:
+        job: A Job, built by process_submissions.
+
+    Returns:
+        A Result, containing the job, True if the download was successful, otherwise False,
+        the name of the error if it failed, and the files that were written.
+    """
+    from redditcurl.websites import storage
+    storage.take_written()
+    error = attempt_download(job.url, job.folder, job.title)
+    return Result(job, error is None, error, storage.take_written())
+
+
+def download_compact(job):
+    """Download a single job in a worker process.
+
+    Only the id of the job is sent back to the parent process, which already has the job,
+    alongside the feedback used by concurrency.Controller.
+
+    Returns:
+        A tuple of the id of the job, None if the download was successful, otherwise the
+        name of the error, the seconds the download took, the number of bytes downloaded,
+        True if a website answered with 429 or a 5xx status, and the files that were written.
+    """
+    from redditcurl.websites import fetch, storage
+    fetch.take_stats()
+    storage.take_written()
+    start = time.monotonic()
+    error = attempt_download(job.url, job.folder, job.title)
+    nbytes, throttled = fetch.take_stats()
+    return job.id, error, time.monotonic() - start, nbytes, throttled, storage.take_written()
+
+
+def download_chunk(jobs):
+    """Download a chunk of jobs in a worker process, one after the other.
+
+    Returns:
+        A list of the tuples returned by download_compact for the jobs.
+    """
+    return [download_compact(job) for job in jobs]
+
+
+def chunk_size(queue_length, processes):
+    """Pick how many jobs should be sent to a worker process at once.
+
+    Sending jobs in chunks cuts the pickling and IPC overhead for long queues,
+    but a chunk is downloaded sequentially by a single worker. The chunks are
+    kept small enough that every worker gets several of them.
+    """
+    return max(1, min(MAX_CHUNKSIZE, queue_length // (processes * CHUNKS_PER_PROCESS)))
+
+
+def host(url):
+    """Return the domain of url, without subdomains, like imgur.com for i.imgur.com."""
+    hostname = urllib.parse.urlsplit(url).hostname or ""
+    return ".".join(hostname.split(".")[-2:])
+
+
+def estimate_size(url):
+    """Return the expected size of the download of url in bytes, going by its downloader.
+
+    The sizes aren't known before downloading, and asking the websites for them would
+    hold up the start of the downloads, so only the rough estimates in SIZE_ESTIMATES are used.
+    """
+    downloader = websites.find(url)
+    if downloader is None:
+        return 0
+    return SIZE_ESTIMATES.get(downloader.name, DEFAULT_SIZE_ESTIMATE)
+
+
+def schedule(download_queue, chunksize=1):
+    """Reorder the download queue to keep all workers busy, and finish as early as possible.
+
+    Jobs are taken round-robin from each host, so that a long run of jobs from the same
+    host doesn't occupy all workers. The jobs of each host are ordered from the largest
+    to the smallest, so the long downloads start early and small ones fill the gaps at
+    the end. When jobs are sent to workers in chunks, the jobs are dealt across the
+    chunks, so that each chunk gets a mix of large and small jobs.
+
+    Args:
+        download_queue: A list of Jobs.
+        chunksize: Number of jobs that will be sent to a worker at once.
+
+    Returns:
+        A new list, containing the same jobs.
+    """
+    by_host = collections.defaultdict(list)
+    for job in download_queue:
+        by_host[host(job.url)].append((estimate_size(job.url), job))
+    # Hosts with the most work go first
+    queues = sorted(by_host.values(), key=lambda jobs: sum(size for size, job in jobs), reverse=True)
+    for jobs in queues:
+        jobs.sort(key=lambda sized_job: sized_job[0], reverse=True)
+    interleaved = [sized_job[1] for sized_job in itertools.chain.from_iterable(itertools.zip_longest(*queues))
+                   if sized_job is not None]
+    chunks = -(-len(interleaved) // chunksize)  # Rounding up
+    return [job for i in range(chunks) for job in interleaved[i::chunks]]
+
+
+def dispatch(pool, download_queue, chunksize):
+    """Download the jobs in download_queue with the worker pool.
+
+    A watchdog abandons the remaining jobs if no results arrive for longer than
+    a chunk of downloads could take with their deadlines, so a stuck worker can't
+    hold up the whole run. Abandoned jobs are counted as failed.
+
+    Returns:
+        A dictionary, mapping the ids of the jobs to Results.
+    """
+    jobs = {job.id: job for job in download_queue}
+    results = {}
+    if shared_config.DOWNLOAD_DEADLINE > 0:
+        timeout = chunksize * shared_config.DOWNLOAD_DEADLINE + WATCHDOG_GRACE
+    else:
+        timeout = None
+    # The chunks are sent as single tasks, since imap_unordered only returns an
+    # iterator that can wait with a timeout when its chunksize is 1
+    chunks = [download_queue[i:i + chunksize] for i in range(0, len(download_queue), chunksize)]
+    completed = pool.imap_unordered(download_chunk, chunks)
+    while len(results) < len(jobs):
+        try:
+            chunk_results = completed.next(timeout)
+        except multiprocessing.TimeoutError:
+            logger.warning("No downloads finished in {} seconds, abandoning {} downloads.".format(
+                timeout, len(jobs) - len(results)))
+            for job_id, job in jobs.items():
+                if job_id not in results:
+                    results[job_id] = Result(job, False, "DownloadTimeout")
+            break
+        for job_id, error, _, _, _, files in chunk_results:
+            results[job_id] = Result(jobs[job_id], error is None, error, files)
+    return results
+
+
+def dispatch_adaptive(pool, download_queue, controller):
+    """Download the jobs in download_queue with the worker pool, as many at once as controller allows.
+
+    The pool should have as many processes as the ceiling of the controller. Jobs are
+    sent one by one, each host taking turns, skipping the hosts at their limit.
+    Like dispatch, the remaining jobs are abandoned if no results arrive for too long.
+
+    Returns:
+        A dictionary, mapping the ids of the jobs to Results.
+    """
+    jobs = {job.id: job for job in download_queue}
+    results = {}
+    pending = collections.OrderedDict()
+    for job in download_queue:
+        pending.setdefault(host(job.url), collections.deque()).append(job)
+    running = {}
+    finished = queue.Queue()
+    if shared_config.DOWNLOAD_DEADLINE > 0:
+        timeout = shared_config.DOWNLOAD_DEADLINE + WATCHDOG_GRACE
+    else:
+        timeout = None
+    while len(results) < len(jobs):
+        # Start jobs until the limit is reached, or a whole pass over the hosts starts nothing
+        started = True
+        while started and controller.has_room():
+            started = False
+            for job_host in list(pending):
+                if not controller.has_room():
+                    break
+                if controller.can_start(job_host):
+                    job = pending[job_host].popleft()
+                    if not pending[job_host]:
+                        del pending[job_host]
+                    else:
+                        # Send the host to the back of the line
+                        pending.move_to_end(job_host)
+                    controller.started(job_host)
+                    running[job.id] = job_host
+                    pool.apply_async(download_compact, (job,), callback=finished.put,
+                                     error_callback=lambda err, job_id=job.id: finished.put(
+                                         (job_id, type(err).__name__, 0, 0, False, ())))
+                    started = True
+        try:
+            job_id, error, elapsed, nbytes, throttled, files = finished.get(timeout=timeout)
+        except queue.Empty:
+            logger.warning("No downloads finished in {} seconds, abandoning {} downloads.".format(
+                timeout, len(jobs) - len(results)))
+            for job_id, job in jobs.items():
+                if job_id not in results:
+                    results[job_id] = Result(job, False, "DownloadTimeout")
+            break
+        controller.finished(running.pop(job_id), elapsed, nbytes, throttled)
+        results[job_id] = Result(jobs[job_id], error is None, error, files)
+    return results
+
+
+def run_queue(pool, download_queue, chunksize, controller=None):
+    """Schedule the jobs in download_queue, and download them with the worker pool.
+
+    See dispatch and dispatch_adaptive.
+    """
+    download_queue = schedule(download_queue, chunksize)
+    if controller is not None:
+        return dispatch_adaptive(pool, download_queue, controller)
+    return dispatch(pool, download_queue, chunksize)
 
 
 def download_info(submission, path, use_titles, use_folders):
@@ -82,10 +390,12 @@ def download_info(submission, path, use_titles, use_folders):
     else:
         title = ""
     if use_folders:
-        folder = os.path.join(path, submission.subreddit.display_name)
+        folder = os.path.join(path, submission.subreddit)
     else:
         folder = path
-    return folder, title
+    # Interning makes the jobs with the same folder share the string, so it is only
+    # pickled once for each chunk of jobs sent to the workers.
+    return sys.intern(folder), title
 
 
 def process_submissions(submission_list, path, use_titles, use_folders, only_from):
@@ -93,14 +403,61 @@ def process_submissions(submission_list, path, use_titles, use_folders, only_fro
     download_queue = []
     used_folders = set()
     for sub in submission_list:
-        if only_from == [] or sub.subreddit.display_name.casefold() in only_from:
+        if only_from == [] or sub.subreddit.casefold() in only_from:
             folder, title = download_info(sub, path, use_titles, use_folders)
-            download_queue.append((sub.url, folder, title))
+            download_queue.append(Job(sub.id, sub.url, folder, title))
             # Keep track of folders to create missing ones later
             used_folders.add(folder)
     return download_queue, used_folders
 
 
+def write_jobs(download_queue, jobs_file):
+    """Write the jobs in download_queue to jobs_file, one JSON object on each line.
+
+    The folders of the jobs should be relative to the save directory, so that the
+    file can be downloaded on another machine, see read_jobs.
+    """
+    with open(jobs_file, "w", encoding="utf-8") as file:
+        for job in download_queue:
+            file.write(json.dumps(job._asdict()))
+            file.write("\n")
+
+
+def shard_of(url, shards):
+    """Returns the shard url belongs to, between 0 and shards - 1.
+
+    The shard only depends on the url, so every machine picks the same shard for it.
+    """
+    return zlib.crc32(url.encode("utf-8")) % shards
+
+
+def read_jobs(jobs_file, path, shard=0, shards=1):
+    """Read the jobs in a file written by write_jobs.
+
+    Args:
+        jobs_file: Path to the file written by write_jobs.
+        path: Path to the save directory, which the folders of the jobs are relative to.
+        shard: Only the jobs in this shard are read, see shard_of.
+        shards: The number of shards the jobs are split into.
+
+    Returns:
+        A tuple of a list of Jobs, and a set of the folders they use, like process_submissions.
+    """
+    download_queue = []
+    used_folders = set()
+    with open(jobs_file, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if shard_of(record["url"], shards) != shard:
+                continue
+            folder = sys.intern(os.path.join(path, record["folder"]))
+            download_queue.append(Job(record["id"], record["url"], folder, record["title"]))
+            used_folders.add(folder)
+    return download_queue, used_folders
+
+
 def make_folders(used_folders):
     """Create the folders that will be possibly used."""
     for folder in used_folders:
@@ -119,12 +476,67 @@ def cleanup_folders(used_folders):
             pass
 
 
-def download_submissions(submission_list, path, processes, use_titles=True, use_folders=True, only_from=[]):
+def init_worker(settings, bucket):
+    """Set up the state of a worker process, once when the process starts.
+
+    The configuration is passed explicitly rather than relying on the module
+    globals being inherited, so workers behave the same under fork, spawn and
+    forkserver start methods.
+
+    Args:
+        settings: A dictionary from websites.shared_config.snapshot.
+        bucket: The bandwidth limit bucket shared by the workers, from websites.ratelimit.bucket.
+    """
+    shared_config.load(settings)
+    from redditcurl.websites import fetch, ratelimit, storage
+    fetch.reset()
+    storage.reset()
+    # Finish the tar volume of the worker when it exits, see close_pool
+    multiprocessing.util.Finalize(None, storage.close, exitpriority=10)
+    ratelimit.install(bucket)
+
+
+def create_pool(processes):
+    """Create the pool of worker processes used for downloading.
+
+    The configuration in websites.shared_config is passed to the workers when
+    the pool is created, changes made afterwards won't reach the workers.
+
+    Returns:
+        A multiprocessing.Pool, or None if processes is 1 or less, meaning that
+        multiprocessing is disabled.
+    """
+    if processes > 1:
+        from redditcurl.websites import ratelimit
+        return multiprocessing.Pool(processes=processes, initializer=init_worker,
+                                    initargs=(shared_config.snapshot(), ratelimit.bucket()))
+    return None
+
+
+def close_pool(pool):
+    """Shut down a pool from create_pool, letting the workers exit on their own.
+
+    Workers that exit close their storage, so their last tar volume is finished,
+    which pool.terminate would skip. Workers still busy once a download could have
+    finished, like the ones the watchdog gave up on, are terminated.
+    """
+    pool.close()
+    joiner = threading.Thread(target=pool.join, daemon=True)
+    joiner.start()
+    if shared_config.DOWNLOAD_DEADLINE > 0:
+        joiner.join(shared_config.DOWNLOAD_DEADLINE + WATCHDOG_GRACE)
+    else:
+        joiner.join()
+    if joiner.is_alive():
+        pool.terminate()
+
+
+def download_submissions(submission_list, path, processes, use_titles=True, use_folders=True, only_from=[],
+                         pool=None, chunksize=None, controller=None):
     """Download all images in the submission_list to path.
 
     Args:
-        submission_list: An iterable, containing praw.objects.Submission objects,
-            or any other object that has .url and .title attributes.
+        submission_list: An iterable, containing Saved records.
         path: Path to the folder where images should be saved.
         processes: Number of processes to use for searching and downloading.
         use_titles: If set to True, titles of the submissions will be used
@@ -133,48 +545,270 @@ def download_submissions(submission_list, path, processes, use_titles=True, use_
             based on their subreddits.
         only_from: If it is an empty list, then images from all subreddits will be downloaded.
             Otherwise, only images from the subreddits in this list will be downloaded.
+        pool: A worker pool from create_pool, which will be used instead of creating a new one.
+            The pool is left running, so it can be reused between calls.
+        chunksize: Number of jobs to send to a worker process at once. If None,
+            it will be picked based on the length of the download queue.
+        controller: A concurrency.Controller. If given, the number of downloads running at
+            once is adjusted by the controller, and processes is ignored. The pool, if given,
+            should have as many processes as the ceiling of the controller.
 
     Returns:
-        A list of tuples, containing the url of the image and True if the image was successfully downloaded,
-        otherwise False.
+        A dictionary, mapping the ids of the submissions to Results. The results are collected
+        in the order the downloads finish, not in the order of the submission_list.
     """
     download_queue, used_folders = process_submissions(submission_list, path, use_titles, use_folders, only_from)
+    return download_jobs(download_queue, used_folders, processes, pool, chunksize, controller)
+
+
+def download_jobs(download_queue, used_folders, processes, pool=None, chunksize=None, controller=None):
+    """Download the jobs in download_queue, see download_submissions.
+
+    Args:
+        download_queue: A list of Jobs.
+        used_folders: A set of the folders the jobs download into, which will be
+            created before downloading, and removed afterwards if they are left empty.
+
+    Returns:
+        A dictionary, mapping the ids of the jobs to Results.
+    """
     make_folders(used_folders)
-    if processes > 1:
-        with multiprocessing.Pool(processes=processes) as pool:
-            results = pool.starmap(manage_download, download_queue)
+    if controller is not None:
+        processes = controller.ceiling
+        chunksize = 1
+    elif chunksize is None:
+        chunksize = chunk_size(len(download_queue), processes)
+    if pool is not None:
+        results = run_queue(pool, download_queue, chunksize, controller)
+    elif processes > 1:
+        pool = create_pool(processes)
+        try:
+            results = run_queue(pool, download_queue, chunksize, controller)
+        except BaseException:
+            pool.terminate()
+            raise
+        close_pool(pool)
     else:
-        results = [manage_download(*submission) for submission in download_queue]
+        from redditcurl.websites import storage
+        results = {job.id: download_job(job) for job in download_queue}
+        storage.close()
     cleanup_folders(used_folders)
     return results
 
 
-def filter_new(submission_list, downloaded_file):
-    """Returns a list of images, removing the ones already saved.
+def download_from_queue(work_queue, path, processes, pool=None, controller=None):
+    """Download the jobs in a work queue shared with other redditcurl instances, until none are left.
+
+    Jobs are leased from the queue a batch at a time, and their leases are renewed
+    while they are downloading.
+
+    Args:
+        work_queue: A workqueue.SQLiteQueue.
+        path: Path to the save directory, which the folders of the jobs are relative to.
+        processes, pool, controller: See download_submissions.
+
+    Returns:
+        A dictionary, mapping the ids of the jobs downloaded by this instance to Results.
+    """
+    if pool is None and processes > 1:
+        if controller is not None:
+            processes = controller.ceiling
+        pool = create_pool(processes)
+        try:
+            results = download_from_queue(work_queue, path, processes, pool, controller)
+        except BaseException:
+            pool.terminate()
+            raise
+        close_pool(pool)
+        return results
+    batch = max(1, processes) * CHUNKS_PER_PROCESS
+    results = {}
+    with work_queue.heartbeat():
+        while True:
+            leased = work_queue.lease(batch)
+            if not leased:
+                break
+            download_queue = [job._replace(folder=sys.intern(os.path.join(path, job.folder))) for job in leased]
+            finished = download_jobs(download_queue, {job.folder for job in download_queue}, processes, pool,
+                                     controller=controller)
+            work_queue.complete(finished.values())
+            results.update(finished)
+    return results
+
+
+def slim(submission_list):
+    """Yield a Saved record for each link submission in submission_list.
+
+    praw objects are large, and may fetch more data from Reddit when their attributes
+    are read, so the listing is turned into Saved records as it is read, and only the
+    records are kept. Saved comments are skipped, since they don't link to images.
+
+    Args:
+        submission_list: An iterable, containing praw.objects.Submission objects.
+    """
+    for submission in submission_list:
+        if not hasattr(submission, "url"):
+            continue
+        yield Saved(submission.id, submission.fullname, submission.url, submission.title,
+                    submission.subreddit.display_name, submission.created_utc)
+
+
+def take_new(submission_list, seen):
+    """Yield the submissions from the head of the listing that haven't been seen before.
+
+    Saved listings are ordered from the newest to the oldest, so the listing is only read
+    until the first submission that has been seen already. seen isn't changed, the ids
+    should be added to it once the submissions are downloaded and recorded.
 
     Args:
         submission_list: An iterable, containing praw.objects.Submission objects, or
-            any object that has .url attribute.
+            any object that has .id attribute.
+        seen: A set of the ids of the submissions that have been seen before.
+    """
+    for submission in submission_list:
+        if submission.id in seen:
+            return
+        yield submission
+
+
+def read_history(downloaded_file):
+    """Returns a set of the downloaded images.
+
+    Args:
+        downloaded_file: Path to a .gz file, containing a list of downloaded images.
+            If the file doesn't exist, an empty set is returned.
+    """
+    try:
+        with gzip.open(downloaded_file) as file:
+            return set(json.loads(file.read().decode("utf-8")))
+    except FileNotFoundError:
+        return set()
+
+
+def filter_new(submission_list, downloaded_file, history=None, dead_links=None):
+    """Returns a list of images, removing the ones already saved.
+
+    Args:
+        submission_list: An iterable, containing Saved records.
         downloaded_file: Path to a .gz file, containing a list of downloaded pictures.
             If the file doesn't exist, it will be created.
+        history: A set of the downloaded images, as returned by read_history.
+            If None, the history will be read from downloaded_file.
+        dead_links: A dictionary of the dead links, as returned by read_dead_links.
+            Dead links will be removed until it is time to check them again.
 
     Returns:
-        A list of praw.objects.Submission, containing only the submissions that
+        A list of Saved records, containing only the submissions that
         haven't been downloaded yet.
     """
-    try:
-        with gzip.open(downloaded_file) as file:
-            downloaded = set(json.loads(file.read().decode("utf-8")))
-    except FileNotFoundError:
-        downloaded = []
-    # Filter to allow only new link posts
+    if history is None:
+        history = read_history(downloaded_file)
+    if dead_links is None:
+        dead_links = {}
+    now = time.time()
+    # Filter to allow only new posts
     filtered = [submission for submission in submission_list
-                if hasattr(submission, "url") and submission.url not in downloaded]
+                if submission.url not in history and not is_dead(submission.url, dead_links, now)]
     return filtered
 
 
+def sidecar_file(downloaded_file, kind):
+    """Returns the path of a file kept next to downloaded_file, like .downloaded.dead.gz for dead links."""
+    root, extension = os.path.splitext(downloaded_file)
+    return "{}.{}{}".format(root, kind, extension)
+
+
+def dead_links_file(downloaded_file):
+    """Returns the path of the file keeping track of the dead links, next to downloaded_file."""
+    return sidecar_file(downloaded_file, "dead")
+
+
+def failed_jobs_file(downloaded_file):
+    """Returns the path of the file keeping track of the failed downloads, next to downloaded_file."""
+    return sidecar_file(downloaded_file, "failed")
+
+
+def files_file(downloaded_file):
+    """Returns the path of the file listing the downloaded files and their sizes, next to downloaded_file."""
+    return sidecar_file(downloaded_file, "files")
+
+
+def read_dead_links(dead_file):
+    """Returns a dictionary of the dead links.
+
+    The dictionary maps the links to a list of the number of times they were found
+    dead, and the time when they should be checked again.
+
+    Args:
+        dead_file: Path to a .gz file, see dead_links_file.
+            If the file doesn't exist, an empty dictionary is returned.
+    """
+    try:
+        with gzip.open(dead_file) as file:
+            return json.loads(file.read().decode("utf-8"))
+    except FileNotFoundError:
+        return {}
+
+
+def is_dead(url, dead_links, now):
+    """Returns True if url is a dead link that shouldn't be checked again yet."""
+    entry = dead_links.get(url)
+    return entry is not None and entry[1] > now
+
+
+def update_dead_links(dead_links, results, now=None):
+    """Record the links found dead, and forget the ones that were downloaded.
+
+    Every time a link is found dead, the time until it is checked again doubles,
+    starting from DEAD_RECHECK_BASE up to DEAD_RECHECK_MAX.
+
+    Args:
+        dead_links: A dictionary of the dead links, as returned by read_dead_links.
+        results: An iterable of Results.
+        now: The current time, as returned by time.time.
+
+    Returns:
+        True if dead_links was changed.
+    """
+    if now is None:
+        now = time.time()
+    changed = False
+    for result in results:
+        url = result.job.url
+        if result.error == "DeadLinkError":
+            failures = dead_links.get(url, (0, 0))[0] + 1
+            recheck = min(DEAD_RECHECK_MAX, DEAD_RECHECK_BASE * 2 ** (failures - 1))
+            dead_links[url] = [failures, now + recheck]
+            changed = True
+        elif result.successful and url in dead_links:
+            del dead_links[url]
+            changed = True
+    return changed
+
+
+def write_dead_links(dead_links, dead_file):
+    """Save the dead links to dead_file, see read_dead_links."""
+    with gzip.open(dead_file, "wb") as file:
+        file.write(json.dumps(dead_links).encode("utf-8"))
+
+
+def sync_files(results):
+    """Flush the files written by the successful downloads to the disk, see storage.sync.
+
+    Called before the downloads are added to the history, unless shared_config.SYNC is False.
+    The files in tar volumes and S3 aren't on the disk under their paths, so they are skipped.
+
+    Args:
+        results: An iterable of Results.
+    """
+    if not shared_config.SYNC or shared_config.STORAGE != "files":
+        return
+    from redditcurl.websites import storage
+    storage.sync(path for result in results if result.successful for path, _, _ in result.files)
+
+
 def update_new(saved_list, downloaded_file):
-    """Adds the list of images to saved images file.
+    """Adds the list of images to saved images file, see write_history.
 
     Args:
         submission_list: An iterable, containing urls of saved images.
@@ -186,5 +820,177 @@ def update_new(saved_list, downloaded_file):
             old_list = json.loads(file.read().decode("utf-8"))
     except FileNotFoundError:
         old_list = []
-    with gzip.open(downloaded_file, "wb") as file:
-        file.write(json.dumps(old_list + saved_list).encode("utf-8"))
+    write_history(old_list + saved_list, downloaded_file)
+
+
+def write_history(saved_list, downloaded_file):
+    """Replace the list of downloaded images in downloaded_file with saved_list.
+
+    The file is written under a temporary name and renamed over the old one, so a crash
+    while writing it doesn't lose the history. Unless shared_config.SYNC is False, the
+    file and then its folder are flushed to the disk, so the new history is kept as well.
+    """
+    from redditcurl.websites import storage
+    temp_file = downloaded_file + ".tmp"
+    with open(temp_file, "wb") as raw_file:
+        with gzip.open(raw_file, "wb") as file:
+            file.write(json.dumps(saved_list).encode("utf-8"))
+        if shared_config.SYNC:
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+    os.replace(temp_file, downloaded_file)
+    if shared_config.SYNC and os.name == "posix":
+        storage.fsync(os.path.dirname(downloaded_file) or ".")
+
+
+def read_failed_jobs(failed_file):
+    """Returns a dictionary of the downloads that failed, mapping the ids of the jobs to Results.
+
+    Args:
+        failed_file: Path to a .gz file, see failed_jobs_file.
+            If the file doesn't exist, an empty dictionary is returned.
+    """
+    try:
+        with gzip.open(failed_file) as file:
+            records = json.loads(file.read().decode("utf-8"))
+    except FileNotFoundError:
+        return {}
+    return {job_id: Result(Job(job_id, url, folder, title), False, error)
+            for job_id, url, folder, title, error in records}
+
+
+def record_failed_jobs(results, failed_file):
+    """Add the failed downloads to failed_file, and remove the ones that succeeded.
+
+    Downloads that failed with one of PERMANENT_ERRORS are removed as well, since
+    retrying them can't help.
+
+    Args:
+        results: An iterable of Results.
+        failed_file: Path to a .gz file, see failed_jobs_file.
+            If the file doesn't exist, it will be created.
+
+    Returns:
+        The dictionary of the failed downloads, like read_failed_jobs.
+    """
+    failed = read_failed_jobs(failed_file)
+    changed = False
+    for result in results:
+        if not result.successful and result.error not in PERMANENT_ERRORS:
+            failed[result.job.id] = result
+            changed = True
+        elif failed.pop(result.job.id, None) is not None:
+            changed = True
+    if changed:
+        with gzip.open(failed_file, "wb") as file:
+            file.write(json.dumps([list(result.job) + [result.error] for result in failed.values()])
+                       .encode("utf-8"))
+    return failed
+
+
+def record_files(results, files_file):
+    """Add the files written by the successful downloads to files_file.
+
+    Each line of files_file is a JSON object with the path of a file and the folder of its
+    job, both relative to the folder files_file is in, the size and the md5 hash of the
+    file, and the job it was downloaded for, so that the file can be checked and
+    downloaded again later.
+
+    Args:
+        results: An iterable of Results.
+        files_file: Path to a .gz file, see files_file. If the file doesn't exist, it will be created.
+    """
+    root = os.path.dirname(files_file) or "."
+    lines = []
+    for result in results:
+        if not result.successful:
+            continue
+        job = result.job._replace(folder=os.path.relpath(result.job.folder or ".", root))
+        for path, size, content_hash in result.files:
+            lines.append(json.dumps({"path": os.path.relpath(path, root), "size": size, "md5": content_hash,
+                                     "job": job._asdict()}))
+    if lines:
+        with gzip.open(files_file, "at", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+
+def move_files(moves, files_file):
+    """Update the paths in files_file after the files were moved, see layout.migrate.
+
+    Args:
+        moves: A dictionary mapping the old paths of the files to their new paths.
+        files_file: Path to a .gz file, see record_files. If the file doesn't exist, nothing is done.
+    """
+    root = os.path.dirname(files_file) or "."
+    moves = {os.path.relpath(old, root): os.path.relpath(new, root) for old, new in moves.items()}
+    try:
+        with gzip.open(files_file, "rt", encoding="utf-8") as file:
+            entries = [json.loads(line) for line in file]
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        entry["path"] = moves.get(os.path.normpath(entry["path"]), entry["path"])
+    temp_file = files_file + ".tmp"
+    with gzip.open(temp_file, "wt", encoding="utf-8") as file:
+        file.writelines(json.dumps(entry) + "\n" for entry in entries)
+    os.replace(temp_file, files_file)
+
+
+def read_files(files_file):
+    """Returns a dictionary mapping the paths of the downloaded files to (size, Job) tuples.
+
+    Args:
+        files_file: Path to a .gz file, see record_files. If the file doesn't exist,
+            an empty dictionary is returned.
+    """
+    root = os.path.dirname(files_file) or "."
+    files = {}
+    try:
+        with gzip.open(files_file, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                job = Job(**entry["job"])
+                job = job._replace(folder=os.path.normpath(os.path.join(root, job.folder)))
+                # A file that was downloaded again replaces the earlier entry
+                files[os.path.normpath(os.path.join(root, entry["path"]))] = entry["size"], job
+    except FileNotFoundError:
+        pass
+    return files
+
+
+def forget_history(urls, downloaded_file):
+    """Remove urls from downloaded_file, so that they are downloaded again.
+
+    Returns:
+        The number of urls that were removed.
+    """
+    history = read_history(downloaded_file)
+    forgotten = history & set(urls)
+    if forgotten:
+        write_history(list(history - forgotten), downloaded_file)
+    return len(forgotten)
+
+
+def merge_history(downloaded_file, other_files):
+    """Add the images downloaded in other_files to downloaded_file.
+
+    This is used to bring together the history files of several machines that
+    downloaded the shards of the same jobs file.
+
+    Args:
+        downloaded_file: Path to a .gz file, containing a list of downloaded images.
+            If the file doesn't exist, it will be created.
+        other_files: Paths to the other history files.
+
+    Returns:
+        The number of images that were added.
+    """
+    history = read_history(downloaded_file)
+    added = []
+    for other_file in other_files:
+        for url in read_history(other_file):
+            if url not in history:
+                history.add(url)
+                added.append(url)
+    update_new(added, downloaded_file)
+    return len(added)
@@ -0,0 +1,207 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Finds the files in the save directory that are damaged, such as the ones cut short
+# by a full disk or a crash, by looking at their structure rather than decoding them.
+import os
+import struct
+import multiprocessing
+
+# The file types that can be checked, by the extensions redditcurl gives them.
+EXTENSIONS = {".jpg": "jpeg", ".jpeg": "jpeg", ".jpe": "jpeg", ".png": "png", ".gif": "gif",
+              ".mp4": "mp4", ".m4v": "mp4", ".webm": "webm", ".mkv": "webm"}
+
+# Number of bytes read from the end of the images to find their end markers.
+TAIL_SIZE = 64
+
+# EBML element ids used by WebM.
+_EBML_ID = 0x1A45DFA3
+_SEGMENT_ID = 0x18538067
+
+
+def file_type(head):
+    """Return the type of a file from its first 16 bytes, or None if it isn't one that can be checked."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "webm"
+    return None
+
+
+def _tail(file, size):
+    file.seek(max(0, size - TAIL_SIZE))
+    return file.read()
+
+
+def _check_jpeg(file, size):
+    # Some programs pad the images after the end marker
+    if not _tail(file, size).rstrip(b"\x00").endswith(b"\xff\xd9"):
+        return "JPEG has no end marker"
+    return None
+
+
+def _check_png(file, size):
+    if not _tail(file, size).endswith(b"IEND\xaeB`\x82"):
+        return "PNG has no IEND chunk"
+    return None
+
+
+def _check_gif(file, size):
+    if not _tail(file, size).rstrip(b"\x00").endswith(b"\x3b"):
+        return "GIF has no trailer"
+    return None
+
+
+def _check_mp4(file, size):
+    # The top level boxes should cover the whole file, and one of them should be the moov box,
+    # which has the information needed to play the video
+    offset = 0
+    found_moov = False
+    while offset < size:
+        file.seek(offset)
+        header = file.read(16)
+        if len(header) < 8:
+            return "MP4 is cut short"
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            if len(header) < 16:
+                return "MP4 is cut short"
+            box_size = struct.unpack(">Q", header[8:])[0]
+        elif box_size == 0:
+            # The last box may extend to the end of the file
+            box_size = size - offset
+        if box_size < 8:
+            return "MP4 has a damaged box"
+        found_moov = found_moov or box_type == b"moov"
+        offset += box_size
+    if offset != size:
+        return "MP4 is cut short"
+    if not found_moov:
+        return "MP4 has no moov box"
+    return None
+
+
+def _read_vint(file, keep_marker=False):
+    """Read an EBML variable size integer.
+
+    Returns:
+        A tuple of the value, and True if all of its bits are set, which means an
+        unknown size. None if the file ends before the integer does.
+    """
+    first = file.read(1)
+    if not first or first[0] == 0:
+        return None
+    length = 9 - first[0].bit_length()
+    rest = file.read(length - 1)
+    if len(rest) < length - 1:
+        return None
+    value = first[0] if keep_marker else first[0] & ((1 << (8 - length)) - 1)
+    for byte in rest:
+        value = value << 8 | byte
+    return value, value == (1 << (7 * length)) - 1
+
+
+def _check_webm(file, size):
+    # The EBML header is followed by the segment, whose size should fit the file
+    file.seek(0)
+    for element_id in (_EBML_ID, _SEGMENT_ID):
+        read_id = _read_vint(file, keep_marker=True)
+        element_size = _read_vint(file)
+        if read_id is None or element_size is None:
+            return "WebM is cut short"
+        if read_id[0] != element_id:
+            return "WebM has a damaged header"
+        if element_id == _EBML_ID:
+            file.seek(element_size[0], os.SEEK_CUR)
+    segment_size, unknown = element_size
+    if not unknown and file.tell() + segment_size > size:
+        return "WebM is cut short"
+    return None
+
+
+_CHECKS = {"jpeg": _check_jpeg, "png": _check_png, "gif": _check_gif, "mp4": _check_mp4, "webm": _check_webm}
+
+
+def check_file(path, size=None):
+    """Check that the file at path is whole, without decoding it.
+
+    The type of the file is found from its first bytes, and the end markers of images,
+    or the boxes of MP4 and the segment of WebM videos are checked. Files of other
+    types only have their size checked.
+
+    Args:
+        path: Path to the file.
+        size: The size the file had when it was downloaded, or None if it isn't known.
+
+    Returns:
+        None if the file looks whole, otherwise a description of the problem.
+    """
+    try:
+        actual_size = os.path.getsize(path)
+        if size is not None and actual_size != size:
+            return "size is {} bytes instead of {}".format(actual_size, size)
+        if actual_size == 0:
+            return "file is empty"
+        with open(path, "rb") as file:
+            kind = file_type(file.read(16))
+            expected = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+            if kind is None:
+                # Often an error page that was saved instead of the image
+                return "not a {} file".format(expected.upper()) if expected is not None else None
+            return _CHECKS[kind](file, actual_size)
+    except FileNotFoundError:
+        return "file is missing"
+    except OSError as err:
+        return str(err)
+
+
+def _check(item):
+    return check_file(*item)
+
+
+def _files(savedir):
+    """Yield the paths of the files in savedir and its subfolders, leaving out the hidden ones."""
+    for folder, folders, files in os.walk(savedir):
+        folders[:] = [name for name in folders if not name.startswith(".")]
+        for name in files:
+            if not name.startswith("."):
+                yield os.path.normpath(os.path.join(folder, name))
+
+
+def scan(savedir, recorded, processes=None):
+    """Check the files in savedir, and the recorded files, in parallel.
+
+    Args:
+        savedir: The save directory.
+        recorded: A dictionary mapping the paths of the downloaded files to (size, Job) tuples,
+            see manager.read_files. Recorded files that are missing count as damaged.
+        processes: The number of processes to check with, or None for one for each CPU.
+
+    Returns:
+        A dictionary mapping the paths of the damaged files to a description of the problem.
+    """
+    paths = sorted(set(_files(savedir)) | set(recorded))
+    items = [(path, recorded[path][0] if path in recorded else None) for path in paths]
+    with multiprocessing.Pool(processes) as pool:
+        problems = pool.map(_check, items, chunksize=64)
+    return {path: problem for path, problem in zip(paths, problems) if problem is not None}
@@ -15,6 +15,55 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-from redditcurl.websites import direct, gfycat, imgur_album, imgur_gifv, imgur_link, redditbooru_gallery, deviantart, twitter
-# Order is important to ensure the correct downloader gets picked
-downloaders = [direct, gfycat, imgur_album, imgur_gifv, imgur_link, redditbooru_gallery, deviantart, twitter]
+import re
+import importlib
+
+# The names of the downloader modules, alongside the urls they can download.
+# Order is important to ensure the correct downloader gets picked.
+PATTERNS = [
+    ("direct", r"^https?://\S+[.]\S+/\S+[.](bmp|dib|eps|ps|gif|im|jpg|jpe|jpeg|pcd|pcx|png|pbm|pgm|ppm|psd|tif|tiff|xbm|xpm|rgb|rast|svg)(#\S*)?$"),
+    ("gfycat", r"^https?://(www[.])?gfycat.com/[a-zA-Z]+[?#]*$"),
+    ("imgur_album", r"imgur.com/a/"),
+    ("imgur_gifv", r"imgur.com/[\S]+[.]gifv"),
+    ("imgur_link", r"imgur.com/[\S]+"),
+    ("redditbooru_gallery", r"redditbooru.com/gallery/"),
+    ("deviantart", r"^https?://([0-9a-zA-Z\-_]+[.])?deviantart.com/art/[0-9a-zA-Z\-]+[?#]*$"),
+    ("twitter", r"^https?://twitter.com/[0-9a-zA-Z_]+/status/[0-9]+$"),
+]
+
+
+def pattern(name):
+    """Return the url pattern of the downloader module called name."""
+    return dict(PATTERNS)[name]
+
+
+class LazyDownloader:
+    """A downloader that imports its module only once a url is routed to it.
+
+    Matching urls doesn't need the module, so downloaders that are never used
+    are never imported, along with their dependencies.
+    """
+    def __init__(self, name, url_pattern):
+        self.name = name
+        self.match = re.compile(url_pattern).search
+
+    def download(self, url, path, file_name=""):
+        return importlib.import_module("redditcurl.websites." + self.name).download(url, path, file_name)
+
+
+downloaders = [LazyDownloader(name, url_pattern) for name, url_pattern in PATTERNS]
+
+
+def find(url):
+    """Return the downloader that can download url, or None if there isn't one."""
+    for downloader in downloaders:
+        if downloader.match(url):
+            return downloader
+    return None
+
+
+def __getattr__(name):
+    # Allow accessing the downloader modules as attributes of the package, importing them on first access.
+    if name in dict(PATTERNS):
+        return importlib.import_module("redditcurl.websites." + name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
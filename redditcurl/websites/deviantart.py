@@ -15,17 +15,17 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import requests
 import re
+from redditcurl import websites
+from redditcurl.websites import fetch
 from redditcurl.websites import direct
-from redditcurl.exceptions import DownloadError
 
 _DEVIANTART_API_URL = "https://backend.deviantart.com/oembed?url={}"
 
 _URL_ESCAPE = {ord(":"): "%3A", ord("/"): "%2F"}
 
 
-match = re.compile("^https?://([0-9a-zA-Z\-_]+[.])?deviantart.com/art/[0-9a-zA-Z\-]+[?#]*$").search
+match = re.compile(websites.pattern("deviantart")).search
 
 
 def download(url, path, file_name=""):
@@ -41,7 +41,6 @@ def download(url, path, file_name=""):
             file_name is an empty string, then name of the downloaded file will be used.
     """
     escaped_url = url.translate(_URL_ESCAPE)
-    request = requests.get(_DEVIANTART_API_URL.format(escaped_url))
-    if not request.ok:
-        raise DownloadError("Failed while getting data from deviantart API for {}".format(url))
+    request = fetch.get(_DEVIANTART_API_URL.format(escaped_url))
+    fetch.check(request, "Failed while getting data from deviantart API for {}".format(url))
     direct.download(request.json()["url"], path, file_name)
@@ -16,13 +16,15 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import re
-from redditcurl.exceptions import DownloadError
+from redditcurl import websites
+from redditcurl.websites import fetch
+from redditcurl.websites import layout
+from redditcurl.websites import storage
+from redditcurl.websites import segmented
 from redditcurl.websites import shared_config
-import hashlib
-import requests
 
 
-match = re.compile(r"^https?://\S+[.]\S+/\S+[.](bmp|dib|eps|ps|gif|im|jpg|jpe|jpeg|pcd|pcx|png|pbm|pgm|ppm|psd|tif|tiff|xbm|xpm|rgb|rast|svg)(#\S*)?$").search
+match = re.compile(websites.pattern("direct")).search
 
 
 def download(url, path, file_name=""):
@@ -37,21 +39,49 @@ def download(url, path, file_name=""):
         file_name: The file name to use when saving the file.
             file_name is an empty string, then name of the downloaded file will be used.
     """
-    response = requests.get(url)
-    if not response.ok:
-        raise DownloadError("Download of {} failed.".format(url))
+    response = fetch.get(url, stream=True)
+    fetch.check(response, "Download of {} failed.".format(url))
     if file_name == "":
         base_name = url.split('/')[-1].split('.')[0]
     else:
         base_name = file_name
 
-    if shared_config.FILENAME_HASH:
-        file_hash = ".{}".format(hashlib.md5(response.content).hexdigest()[:10])
-    else:
-        file_hash = ""
-
     if path == "":
         path = "."
     extension = response.headers["Content-Type"].split('/')[-1]
-    with open("{}/{}{}.{}".format(path, base_name, file_hash, extension), mode="wb") as file:
-        file.write(response.content)
+
+    if segmented.supported(response):
+        # Large files are downloaded over several connections into a temporary file,
+        # which is renamed once the hash of the whole file is known.
+        response.close()
+        with storage.temporary_file(path) as file:
+            temp_path = file.name
+        try:
+            content_hash = segmented.download(url, temp_path, int(response.headers["Content-Length"]),
+                                              shared_config.SEGMENTS)
+            storage.storage().store(_file_path(path, base_name, content_hash, extension), temp_path,
+                                    content_hash.hexdigest())
+        except BaseException:
+            storage.remove_temporary(temp_path)
+            raise
+    else:
+        storage.storage().stream(path, fetch.iter_body(response),
+                                 lambda content_hash: _file_path(path, base_name, content_hash, extension),
+                                 _content_length(response))
+
+
+def _content_length(response):
+    """Return the length of the body of the response from its headers, or None if it isn't given."""
+    try:
+        return int(response.headers.get("Content-Length", ""))
+    except ValueError:
+        return None
+
+
+def _file_path(path, base_name, content_hash, extension):
+    """Return the path to save a file at, appending the hash to the name if required."""
+    if shared_config.FILENAME_HASH:
+        file_hash = ".{}".format(content_hash.hexdigest()[:10])
+    else:
+        file_hash = ""
+    return layout.locate(path, "{}{}.{}".format(base_name, file_hash, extension))
@@ -0,0 +1,123 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# The HTTP session shared by the downloaders in this process. Reusing a session keeps
+# the connections to the servers open between downloads.
+import requests
+from redditcurl.websites import shared_config
+from redditcurl.websites import ratelimit
+from redditcurl.exceptions import DownloadError, DeadLinkError
+
+# Size of the chunks read from the responses.
+CHUNK_SIZE = 64 * 1024
+
+# Statuses meaning that the requested file is gone, and retrying won't help.
+DEAD_STATUSES = {404, 410}
+
+_session = None
+
+# Statistics about the responses received by this process, see take_stats.
+_stats = {"bytes": 0, "throttled": False}
+
+
+def session():
+    """Return the HTTP session of this process, creating it if needed."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def reset():
+    """Replace the HTTP session of this process with a new one.
+
+    Worker processes call this when they start, since connections
+    can't be shared with the parent process.
+    """
+    global _session
+    _session = requests.Session()
+
+
+def get(url, **kwargs):
+    """Send a GET request using the session of this process.
+
+    Accepts the same arguments as requests.get. Unless a timeout is given,
+    the timeouts from shared_config are used.
+    """
+    kwargs.setdefault("timeout", (shared_config.CONNECT_TIMEOUT, shared_config.READ_TIMEOUT))
+    response = session().get(url, **kwargs)
+    if response.status_code == 429 or response.status_code >= 500:
+        _stats["throttled"] = True
+    elif response.ok:
+        _stats["bytes"] += int(response.headers.get("Content-Length", 0) or 0)
+    return response
+
+
+def head(url, **kwargs):
+    """Send a HEAD request using the session of this process.
+
+    Used to learn about a file, like its size, without downloading it.
+    Accepts the same arguments as requests.head, with the timeouts from shared_config.
+    """
+    kwargs.setdefault("timeout", (shared_config.CONNECT_TIMEOUT, shared_config.READ_TIMEOUT))
+    return session().head(url, **kwargs)
+
+
+def check(response, message):
+    """Raise an error if the request failed.
+
+    Args:
+        response: The response to check.
+        message: The message of the error.
+
+    Raises:
+        DeadLinkError if the file was not found, or is gone.
+        DownloadError for other failures, which may be temporary.
+    """
+    if response.status_code in DEAD_STATUSES:
+        raise DeadLinkError(message)
+    if not response.ok:
+        raise DownloadError(message)
+
+
+def iter_body(response):
+    """Yield the body of a response sent with stream=True in chunks, keeping to the bandwidth limit.
+
+    Used for downloading the media itself. Small requests, like the ones to APIs,
+    can read response.content directly to skip the bandwidth limit.
+    """
+    for chunk in response.iter_content(CHUNK_SIZE):
+        ratelimit.consume(len(chunk))
+        yield chunk
+
+
+def read_body(response):
+    """Return the body of a response sent with stream=True, keeping to the bandwidth limit."""
+    return b"".join(iter_body(response))
+
+
+def take_stats():
+    """Return the statistics collected since the last call, and start collecting again.
+
+    Returns:
+        A tuple of the number of bytes the received responses announced, and True if
+        any server answered with 429 or a 5xx status, meaning it is overloaded.
+    """
+    stats = _stats["bytes"], _stats["throttled"]
+    _stats["bytes"] = 0
+    _stats["throttled"] = False
+    return stats
@@ -0,0 +1,75 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Picks which format of a file to download, for the sites that offer the same
+# video or animation in several formats.
+from redditcurl.websites import shared_config
+
+FORMAT_POLICIES = ("preferred", "smallest")
+
+
+def video_formats():
+    """Return the video file extensions in the order the user prefers them."""
+    if shared_config.PREFER_MP4:
+        return ["mp4", "webm"]
+    return ["webm", "mp4"]
+
+
+def size(url):
+    """Return the size of the file at url in bytes, without downloading it.
+
+    Returns:
+        The size from the Content-Length header, or None if the file is
+        not available, or the server doesn't tell its size.
+    """
+    # requests is imported here, so that the command line can check FORMAT_POLICIES without it
+    import requests
+    from redditcurl.websites import fetch
+    try:
+        response = fetch.head(url)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200 or "Content-Length" not in response.headers:
+        return None
+    return int(response.headers["Content-Length"])
+
+
+def choose(candidates):
+    """Pick the url to download from the formats a file is available in.
+
+    With the "preferred" FORMAT_POLICY, the first candidate is picked. With "smallest",
+    the smallest available one is, checking the sizes that are not known with
+    HEAD requests. If no size can be found, the first candidate is picked.
+
+    Args:
+        candidates: A list of (url, size) tuples, in the order of preference.
+            size may be None if it is not known.
+    Returns:
+        The url of the picked candidate.
+    """
+    if shared_config.FORMAT_POLICY != "smallest":
+        return candidates[0][0]
+    available = []
+    for url, known_size in candidates:
+        if known_size is None:
+            known_size = size(url)
+        if known_size is not None:
+            available.append((known_size, url))
+    if not available:
+        return candidates[0][0]
+    # min keeps the first of the equally small ones, which is the preferred one
+    return min(available, key=lambda candidate: candidate[0])[1]
@@ -15,15 +15,16 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import requests
 import json
 import re
+from redditcurl import websites
+from redditcurl.websites import fetch
 from redditcurl.websites import direct
-from redditcurl.websites import shared_config
+from redditcurl.websites import formats
 
 _GFYCAT_API_URL = "https://gfycat.com/cajax/get/{}"
 
-match = re.compile("^https?://(www[.])?gfycat.com/[a-zA-Z]+[?#]*$").search
+match = re.compile(websites.pattern("gfycat")).search
 
 
 def download(url, path, file_name=""):
@@ -39,10 +40,11 @@ def download(url, path, file_name=""):
             file_name is an empty string, then name of the downloaded file will be used.
     """
     image_name = url.split("/")[-1]
-    api_request = requests.get(_GFYCAT_API_URL.format(image_name))
+    api_request = fetch.get(_GFYCAT_API_URL.format(image_name))
+    fetch.check(api_request, "Failed while getting data from gfycat API for {}".format(url))
     api_data = json.loads(api_request.content.decode("utf-8"))
-    if shared_config.PREFER_MP4:
-        file_type = "mp4Url"
-    else:
-        file_type = "webmUrl"
-    direct.download(api_data["gfyItem"][file_type], path, file_name)
+    gfy_item = api_data["gfyItem"]
+    # The API tells the sizes of the formats, so they don't have to be checked separately
+    candidates = [(gfy_item[extension + "Url"], gfy_item.get(extension + "Size"))
+                  for extension in formats.video_formats()]
+    direct.download(formats.choose(candidates), path, file_name)
@@ -15,17 +15,18 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import requests
-import tempfile
+import io
 from zipfile import ZipFile
-import shutil
 import re
 import os
 import hashlib
+from redditcurl import websites
+from redditcurl.websites import fetch
+from redditcurl.websites import layout
+from redditcurl.websites import storage
 from redditcurl.websites import shared_config
-from redditcurl.exceptions import DownloadError
 
-match = re.compile("imgur.com/a/").search
+match = re.compile(websites.pattern("imgur_album")).search
 
 
 def download(url, path, file_name=""):
@@ -46,30 +47,27 @@ def download(url, path, file_name=""):
     url = url.split('#')[0]
     if path == "":
         path = "."
-    response = requests.get("{}/zip".format(url))
-    if not response.ok:
-        raise DownloadError("Failed downloading imgur album {}".format(url))
-    with tempfile.TemporaryFile(mode="w+b") as file:
-        file.write(response.content)
-        file.seek(0)
-        zipfile = ZipFile(file)
-
+    response = fetch.get("{}/zip".format(url), stream=True)
+    fetch.check(response, "Failed downloading imgur album {}".format(url))
+    content = fetch.read_body(response)
+    with ZipFile(io.BytesIO(content)) as zipfile:
         # There can't be files with the same name within the zip, so
         # we append the hash of the zip file to all files.
         if shared_config.FILENAME_HASH:
-            file_hash = ".{}".format(hashlib.md5(response.content).hexdigest()[:10])
+            file_hash = ".{}".format(hashlib.md5(content).hexdigest()[:10])
         else:
             file_hash = ""
 
-        tempdir = tempfile.mkdtemp()
-        zipfile.extractall(tempdir)
-        for i, image in enumerate(os.listdir(tempdir)):
-            base_name, extension = os.path.splitext(image)
+        # The images are read from the zip one by one and written to the storage, so
+        # nothing is extracted to a temporary folder first
+        images = [name for name in zipfile.namelist() if not name.endswith("/")]
+        for i, image in enumerate(images):
+            base_name, extension = os.path.splitext(os.path.basename(image))
 
             if file_name == "":
                 new_name = base_name
             else:
                 new_name = "{}.{}".format(file_name, i + 1)
 
-            shutil.copyfile("{}/{}".format(tempdir, image),
-                            "{}/{}{}{}".format(path, new_name, file_hash, extension))
+            storage.storage().write(layout.locate(path, "{}{}{}".format(new_name, file_hash, extension)),
+                                    zipfile.read(image))
@@ -16,10 +16,11 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import re
+from redditcurl import websites
 from redditcurl.websites import direct
-from redditcurl.websites import shared_config
+from redditcurl.websites import formats
 
-match = re.compile("imgur.com/[\S]+[.]gifv").search
+match = re.compile(websites.pattern("imgur_gifv")).search
 
 
 def download(url, path, file_name=""):
@@ -34,8 +35,6 @@ def download(url, path, file_name=""):
     # From an url "http://i.imgur.com/abcdef.gifv", first extract "abcdef.gifv" then
     # delete the extension to get "abcdef"
     download_name = url.split('/')[-1][:-5]
-    if shared_config.PREFER_MP4:
-        extension = "mp4"
-    else:
-        extension = "webm"
-    direct.download("https://i.imgur.com/{}.{}".format(download_name, extension), path, file_name)
+    candidates = [("https://i.imgur.com/{}.{}".format(download_name, extension), None)
+                  for extension in formats.video_formats()]
+    direct.download(formats.choose(candidates), path, file_name)
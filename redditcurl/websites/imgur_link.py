@@ -15,10 +15,14 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+from redditcurl import websites
 from redditcurl.websites import direct
+from redditcurl.websites import fetch
+from redditcurl.websites import formats
+from redditcurl.websites import shared_config
 import re
 
-match = re.compile("imgur.com/[\S]+").search
+match = re.compile(websites.pattern("imgur_link")).search
 
 
 def download(url, path, file_name=""):
@@ -34,4 +38,12 @@ def download(url, path, file_name=""):
     # The file extension doesn't have to be a .jpg,
     # Imgur returns the image as long as it is requested with a known file extension.
     # download function will correct the extension based on the headers.
-    direct.download("https://i.imgur.com/{}.jpg".format(download_name), path, file_name)
+    image_url = "https://i.imgur.com/{}.jpg".format(download_name)
+    if shared_config.FORMAT_POLICY == "smallest":
+        image = fetch.head(image_url)
+        if image.status_code == 200 and image.headers.get("Content-Type") == "image/gif":
+            # Imgur also serves animated images as mp4 videos, which are usually much smaller
+            size = image.headers.get("Content-Length")
+            image_url = formats.choose([("https://i.imgur.com/{}.mp4".format(download_name), None),
+                                        (image_url, int(size) if size else None)])
+    direct.download(image_url, path, file_name)
@@ -0,0 +1,125 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Decides where the downloaded files are placed inside their folders.
+# With the flat layout, files are placed directly in their folder. With the hashed
+# layout, they are spread over two levels of subfolders named after the md5 hash of
+# the file name, like folder/3f/a2/name.jpg, so no single folder gets too large.
+# The path of a file only depends on its name, so no index needs to be kept.
+import os
+import hashlib
+import logging
+from redditcurl.websites import shared_config
+
+logger = logging.getLogger("main")
+
+LAYOUTS = ("flat", "hashed")
+
+
+def fan_out(name):
+    """Return the subfolders a file called name is placed in with the hashed layout, like 3f/a2."""
+    name_hash = hashlib.md5(name.encode("utf-8")).hexdigest()
+    return os.path.join(name_hash[0:2], name_hash[2:4])
+
+
+def locate(folder, name, layout=None):
+    """Return the path of the file called name in folder.
+
+    Args:
+        folder: The folder the file belongs to, like the save directory or a subreddit folder.
+        name: The name of the file.
+        layout: One of LAYOUTS. If None, shared_config.LAYOUT is used.
+    """
+    if layout is None:
+        layout = shared_config.LAYOUT
+    if layout == "hashed":
+        return os.path.join(folder, fan_out(name), name)
+    return os.path.join(folder, name)
+
+
+def _is_fan_out(name):
+    return len(name) == 2 and all(char in "0123456789abcdef" for char in name)
+
+
+def migrate(savedir, layout):
+    """Move the files in savedir, and in the subreddit folders in it, to layout.
+
+    Hidden files, such as the savefile, are left alone. Files that would overwrite
+    another file are left in place.
+
+    Returns:
+        A dictionary mapping the old paths of the moved files to their new paths, so that
+        the records of the files can be updated.
+    """
+    # Subreddits like r/de have folders named like the hashed layout subfolders, so every
+    # folder is looked into. The files of the layout are told apart by their names, see _files.
+    folders = [savedir] + [entry.path for entry in os.scandir(savedir)
+                           if entry.is_dir() and not entry.name.startswith(".")]
+    moved = {}
+    for folder in folders:
+        if not os.path.isdir(folder):
+            # A hashed layout subfolder of savedir, that was emptied and removed
+            continue
+        for file_path in list(_files(folder)):
+            name = os.path.basename(file_path)
+            new_path = locate(folder, name, layout)
+            if new_path == file_path:
+                continue
+            if os.path.exists(new_path):
+                logger.warning("Not moving {}, {} already exists.".format(file_path, new_path))
+                continue
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(file_path, new_path)
+            moved[file_path] = new_path
+        _remove_empty(folder)
+    return moved
+
+
+def _files(folder):
+    """Yield the paths of the files in folder, including the ones in the hashed layout subfolders.
+
+    Files in subfolders are only counted when they are in the subfolders the hashed layout
+    puts them in, so the files of subreddit folders named like them are left out.
+    """
+    for entry in os.scandir(folder):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_file():
+            yield entry.path
+        elif entry.is_dir() and _is_fan_out(entry.name):
+            for sub_entry in os.scandir(entry.path):
+                if sub_entry.is_dir() and _is_fan_out(sub_entry.name):
+                    for file_entry in os.scandir(sub_entry.path):
+                        if (file_entry.is_file() and not file_entry.name.startswith(".")
+                                and fan_out(file_entry.name) == os.path.join(entry.name, sub_entry.name)):
+                            yield file_entry.path
+
+
+def _remove_empty(folder):
+    """Remove the hashed layout subfolders of folder that are left empty."""
+    for entry in os.scandir(folder):
+        if entry.is_dir() and _is_fan_out(entry.name):
+            for sub_entry in os.scandir(entry.path):
+                if sub_entry.is_dir() and _is_fan_out(sub_entry.name):
+                    try:
+                        os.rmdir(sub_entry.path)
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(entry.path)
+            except OSError:
+                pass
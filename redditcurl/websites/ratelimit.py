@@ -0,0 +1,133 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Limits the bandwidth used for downloading media, shared between all worker processes.
+# The limit is enforced with a token bucket kept in shared memory. Small requests, like
+# the ones to the APIs of the websites, don't go through the bucket.
+import re
+import time
+import datetime
+import multiprocessing
+from redditcurl.websites import shared_config
+
+# How many seconds worth of bytes can be downloaded in a burst, after being idle.
+BURST = 1
+
+_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+_RATE_MATCH = re.compile(r"^\s*([0-9]+(?:[.][0-9]+)?)\s*([kmg]?)\s*$", re.IGNORECASE).match
+_WINDOW_MATCH = re.compile(r"^\s*([0-9]{1,2}):([0-9]{2})\s*-\s*([0-9]{1,2}):([0-9]{2})\s*=(.*)$").match
+
+# The bucket, an array holding the number of tokens and when it was last updated.
+_bucket = None
+
+# Seconds this process has slept waiting for the bucket, see throttled_time.
+_throttled = 0.0
+
+
+def parse_rate(text):
+    """Parse a rate in bytes per second, like 500K or 2M. 0 means unlimited.
+
+    Raises:
+        ValueError if the text isn't a valid rate.
+    """
+    match = _RATE_MATCH(text)
+    if not match:
+        raise ValueError("Invalid rate {!r}, should be a number optionally followed by K, M or G.".format(text))
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def parse_schedule(text):
+    """Parse a list of rates for times of the day, like 09:00-18:00=500K,18:00-23:00=2M.
+
+    Windows may cross midnight, like 22:00-06:00=5M. Outside the windows,
+    shared_config.MAX_RATE applies.
+
+    Returns:
+        A list of (start, end, rate) tuples, where start and end are minutes since midnight.
+
+    Raises:
+        ValueError if the text isn't a valid schedule.
+    """
+    schedule = []
+    for window in filter(None, (part.strip() for part in text.split(","))):
+        match = _WINDOW_MATCH(window)
+        if not match:
+            raise ValueError("Invalid rate schedule {!r}, should look like 09:00-18:00=500K.".format(window))
+        start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+        schedule.append((int(start_hour) * 60 + int(start_minute), int(end_hour) * 60 + int(end_minute),
+                         parse_rate(rate)))
+    return schedule
+
+
+def current_rate(now=None):
+    """Return the bandwidth limit in bytes per second for the time now, 0 meaning unlimited."""
+    if now is None:
+        now = datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end, rate in shared_config.RATE_SCHEDULE:
+        if start <= minute < end or (end < start and (minute >= start or minute < end)):
+            return rate
+    return shared_config.MAX_RATE
+
+
+def bucket():
+    """Return the bucket of this process, creating it if needed.
+
+    The bucket should be created before starting the worker processes, and passed to them
+    through install, so that they all share it.
+    """
+    global _bucket
+    if _bucket is None:
+        # Updated long ago, so the bucket starts out full.
+        _bucket = multiprocessing.Array("d", [0.0, 0.0])
+    return _bucket
+
+
+def install(shared_bucket):
+    """Use shared_bucket, created by the bucket function of another process."""
+    global _bucket
+    _bucket = shared_bucket
+
+
+def throttled_time():
+    """Return the number of seconds this process has slept waiting for the bandwidth limit.
+
+    The sleeps of threads downloading at the same time are added up.
+    """
+    return _throttled
+
+
+def consume(nbytes):
+    """Take nbytes from the bucket, sleeping until the bandwidth limit allows it.
+
+    Every caller reserves its bytes, so the bucket can go into debt. A caller sleeps
+    until the debt up to and including its own bytes is paid off at the current rate.
+    """
+    rate = current_rate()
+    if rate <= 0:
+        return
+    shared_bucket = bucket()
+    with shared_bucket.get_lock():
+        now = time.monotonic()
+        tokens = min(rate * BURST, shared_bucket[0] + (now - shared_bucket[1]) * rate) - nbytes
+        shared_bucket[0] = tokens
+        shared_bucket[1] = now
+    if tokens < 0:
+        global _throttled
+        # Counted before sleeping, so that a deadline expiring during the sleep sees it
+        _throttled += -tokens / rate
+        time.sleep(-tokens / rate)
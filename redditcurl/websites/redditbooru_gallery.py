@@ -15,13 +15,14 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import requests
 from bs4 import BeautifulSoup
+from redditcurl import websites
+from redditcurl.websites import fetch
 from redditcurl.websites import direct
 from redditcurl.exceptions import DownloadError
 import re
 
-match = re.compile("redditbooru.com/gallery/").search
+match = re.compile(websites.pattern("redditbooru_gallery")).search
 
 
 def download(url, path, file_name=""):
@@ -36,9 +37,8 @@ def download(url, path, file_name=""):
             If file_name is an empty string, the files will keep
             the names they have on the server.
     """
-    response = requests.get(url)
-    if not response.ok:
-        raise DownloadError("Unable to download redditbooru gallery {}".format(url))
+    response = fetch.get(url)
+    fetch.check(response, "Unable to download redditbooru gallery {}".format(url))
     soup = BeautifulSoup(response.content, "html.parser")
     images = soup.find_all("img")
     if len(images) < 1:
@@ -0,0 +1,114 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Downloads large files over several connections at once. The file is split into
+# byte ranges, which are fetched in parallel and written in place into a file that
+# has been allocated to its full size beforehand, see storage.preallocate.
+import hashlib
+import threading
+import concurrent.futures
+from redditcurl.websites import fetch
+from redditcurl.websites import shared_config
+from redditcurl.websites import storage
+from redditcurl.exceptions import DownloadError
+
+# Size of the chunks used while hashing the file.
+CHUNK_SIZE = 64 * 1024
+
+
+def supported(response):
+    """Return True if the body of the response should be downloaded in segments.
+
+    The server must accept byte ranges, and the file must be at least
+    shared_config.SEGMENT_THRESHOLD bytes long.
+    """
+    try:
+        size = int(response.headers.get("Content-Length", ""))
+    except ValueError:
+        return False
+    return (shared_config.SEGMENTS > 1
+            and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+            and size >= shared_config.SEGMENT_THRESHOLD)
+
+
+def ranges(size, segments):
+    """Split size bytes into segments byte ranges of about equal length.
+
+    Returns:
+        A list of (start, end) tuples, where both start and end are inclusive.
+    """
+    length = -(-size // segments)  # Rounding up
+    return [(start, min(start + length, size) - 1) for start in range(0, size, length)]
+
+
+def download_range(url, file_path, start, end, stop=None):
+    """Download the bytes from start to end of url, writing them at the same offset in file_path.
+
+    If stop, a threading.Event, is set, the download is abandoned before the next chunk is written.
+    """
+    response = fetch.get(url, headers={"Range": "bytes={}-{}".format(start, end)}, stream=True)
+    if response.status_code != 206:
+        raise DownloadError("Range request for {} failed.".format(url))
+    written = 0
+    with open(file_path, "r+b") as file:
+        file.seek(start)
+        for chunk in fetch.iter_body(response):
+            if stop is not None and stop.is_set():
+                raise DownloadError("Range {}-{} of {} was stopped.".format(start, end, url))
+            file.write(chunk)
+            written += len(chunk)
+    if written != end - start + 1:
+        raise DownloadError("Range {}-{} of {} is incomplete.".format(start, end, url))
+
+
+def download(url, file_path, size, segments):
+    """Download url into file_path over segments connections.
+
+    Args:
+        url: A url to the file, which accepts byte ranges.
+        file_path: Path to the file to write. It will be created or truncated.
+        size: The length of the file in bytes, as given in Content-Length header.
+        segments: Number of byte ranges to download in parallel.
+
+    Returns:
+        A hashlib md5 object, holding the hash of the whole file.
+    """
+    with open(file_path, "wb") as file:
+        file.truncate(size)
+        storage.preallocate(file, size)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=segments)
+    stop = threading.Event()
+    futures = []
+    try:
+        for start, end in ranges(size, segments):
+            futures.append(executor.submit(download_range, url, file_path, start, end, stop))
+        for future in futures:
+            future.result()
+    except BaseException:
+        # Don't wait for the remaining ranges, the download has failed already. The ranges
+        # that are running stop before writing again, since the file is about to be removed.
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+    file_hash = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash
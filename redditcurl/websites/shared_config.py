@@ -23,7 +23,63 @@ PREFER_MP4 = False
 # Used by gfycat and imgur_gifv, which by default downloaders will prefer WEBM.
 # If PREFER_MP4 is set to True, they will prefer downloading MP4s instead.
 
+FORMAT_POLICY = "preferred"
+# Either "preferred" to download the format picked by PREFER_MP4, or "smallest" to
+# download whichever available format is the smallest, see websites.formats.
+
+SYNC = True
+# Should the downloaded files be flushed to the disk before the history records them?
+# Without this, a crash or a power loss may leave damaged files that are counted as downloaded.
+
 FILENAME_HASH = False
 # Should the file names be appended with the first 10 characters of
 # md5 hash of the file? Required to avoid name collisions, otherwise
 # downloaders may overwrite existing files.
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# Seconds to wait for connecting to a server, and for the server to send data.
+# Used for all requests sent by the downloaders.
+
+SEGMENTS = 4
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+# Files of at least SEGMENT_THRESHOLD bytes are downloaded over SEGMENTS connections
+# at once, if the server accepts byte ranges. Setting SEGMENTS to 1 disables this.
+
+MAX_RATE = 0
+RATE_SCHEDULE = []
+# The bandwidth limit for downloading media, in bytes per second, shared by all
+# worker processes. 0 means unlimited. RATE_SCHEDULE may hold (start, end, rate)
+# tuples overriding it at times of the day, see ratelimit.parse_schedule.
+
+LAYOUT = "flat"
+# Either "flat" to save the files directly in their folders, or "hashed" to spread
+# them over subfolders, see websites.layout.
+
+STORAGE = "files"
+ARCHIVE_DIR = "."
+VOLUME_SIZE = 1024 * 1024 * 1024
+S3_BUCKET = ""
+S3_PREFIX = ""
+S3_ENDPOINT = None
+# Either "files" to save the downloads as separate files, "tar" to append them to
+# tar volumes of about VOLUME_SIZE bytes in ARCHIVE_DIR, or "s3" to upload them to
+# S3_BUCKET, at the endpoint S3_ENDPOINT, or Amazon S3 if it is None. See websites.storage.
+
+DOWNLOAD_DEADLINE = 300
+# Seconds a single url may take to download in total, including all the requests
+# it needs. Downloads running longer than this will fail. 0 disables the deadline.
+
+
+def snapshot():
+    """Return the current configuration as a dictionary.
+
+    The dictionary can be passed to load in another process, so that worker
+    processes use the same configuration regardless of how they were started.
+    """
+    return {name: value for name, value in globals().items() if name.isupper()}
+
+
+def load(settings):
+    """Set the configuration from a dictionary created by snapshot."""
+    globals().update(settings)
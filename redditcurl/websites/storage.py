@@ -0,0 +1,500 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# Stores the downloaded files. The downloaders hand the files to the storage of
+# their process, which either writes them as separate files, appends them to
+# rolling tar volumes, which is much faster on file systems where creating files is slow,
+# or uploads them to an S3 compatible object store.
+#
+# Files are written under a temporary name and renamed once complete, without waiting for
+# the disk. The main process syncs all the files of a batch of downloads at once before
+# the history records them, see sync, so that a crash can't leave a damaged file that is
+# counted as downloaded, without paying for a sync after every small image.
+import io
+import os
+import errno
+import json
+import uuid
+import socket
+import tarfile
+import tempfile
+import hashlib
+import time
+import contextlib
+import concurrent.futures
+from redditcurl.websites import shared_config
+from redditcurl.exceptions import DownloadError
+
+STORAGES = ("files", "tar", "s3")
+
+# Size of the chunks read from files while storing them.
+CHUNK_SIZE = 64 * 1024
+
+# Number of files synced at once. Syncing many files together lets the file system
+# commit them to the disk in a few large writes.
+SYNC_THREADS = 16
+
+_storage = None
+
+# The permissions of the stored files, see _file_mode.
+_mode = None
+
+# (path, size, md5) tuples of the files stored in this process since the last take_written.
+_written = []
+
+# Paths of the temporary files of the downloads in progress, see temporary_file.
+_partial = set()
+
+
+class Storage:
+    """The methods shared by the storages."""
+    def stream(self, folder, chunks, file_path_for, size=None):
+        """Store a file arriving in chunks, whose path depends on its content.
+
+        Args:
+            folder: The folder the file goes to. A temporary file may be created in it.
+            chunks: An iterable of bytes objects.
+            file_path_for: A function taking the hashlib.md5 object of the content,
+                and returning the path to store the file at.
+            size: The expected size of the file in bytes, if it is known, so that the
+                space can be allocated beforehand. The file may turn out smaller or larger.
+        """
+        content_hash = hashlib.md5()
+        with temporary_file(folder) as file:
+            temp_path = file.name
+            try:
+                preallocate(file, size)
+                for chunk in chunks:
+                    content_hash.update(chunk)
+                    file.write(chunk)
+                # Drop the allocated space that wasn't used
+                file.truncate()
+            except BaseException:
+                file.close()
+                remove_temporary(temp_path)
+                raise
+        self.store(file_path_for(content_hash), temp_path, content_hash.hexdigest())
+
+    def close(self):
+        pass
+
+
+class Files(Storage):
+    """Stores the downloads as separate files, creating the folders they need."""
+    def write(self, file_path, content):
+        """Store content, a bytes object, at file_path."""
+        folder = os.path.dirname(file_path) or "."
+        os.makedirs(folder, exist_ok=True)
+        with temporary_file(folder) as file:
+            try:
+                file.write(content)
+            except BaseException:
+                file.close()
+                remove_temporary(file.name)
+                raise
+        os.chmod(file.name, _file_mode())
+        os.replace(file.name, file_path)
+        _partial.discard(file.name)
+        _written.append((file_path, len(content), hashlib.md5(content).hexdigest()))
+
+    def store(self, file_path, source_path, content_hash=None):
+        """Store the file at source_path at file_path. The file at source_path is moved or removed.
+
+        content_hash is the hex md5 hash of the file, if it is already known.
+        """
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        size = os.path.getsize(source_path)
+        if content_hash is None:
+            with open(source_path, "rb") as file:
+                content_hash = _md5(file)
+        # Temporary files are only readable by their owner, give the file the permissions of a new one
+        os.chmod(source_path, _file_mode())
+        os.replace(source_path, file_path)
+        _partial.discard(source_path)
+        _written.append((file_path, size, content_hash))
+
+
+class TarVolumes(Storage):
+    """Appends the downloads to tar volumes in directory, starting a new volume once one grows past volume_size.
+
+    Every process writes its own volumes, named like redditcurl-host-1234-00001.tar. Next to
+    each volume, an index file with the .idx extension has a JSON object on each line, with
+    the name of an entry, and the offset and size of its data in the volume, so a single
+    file can be read without unpacking the volume, see read_entry.
+
+    The entries are named after their path relative to directory.
+
+    Like with the other storages, the paths, sizes and md5 hashes of the files are
+    recorded, see take_written, with the paths the files would have had outside the volumes.
+    """
+    def __init__(self, directory, volume_size):
+        self.directory = directory
+        self.volume_size = volume_size
+        self.prefix = "redditcurl-{}-{}".format(socket.gethostname(), os.getpid())
+        self.number = 0
+        self.tar = None
+        self.index = None
+
+    def _open_volume(self):
+        self.number += 1
+        while True:
+            volume_path = os.path.join(self.directory, "{}-{:05}.tar".format(self.prefix, self.number))
+            if not os.path.exists(volume_path):
+                break
+            # A process with the same id left volumes behind in an earlier run
+            self.number += 1
+        self.tar = tarfile.open(volume_path, "w", format=tarfile.PAX_FORMAT)
+        self.index = open(volume_path + ".idx", "w", encoding="utf-8")
+
+    def _add(self, file_path, file, size):
+        if self.tar is None:
+            self._open_volume()
+        info = tarfile.TarInfo(os.path.relpath(file_path, self.directory).replace(os.sep, "/"))
+        info.size = size
+        info.mtime = int(time.time())
+        start = self.tar.offset
+        try:
+            self.tar.addfile(info, file)
+        except BaseException:
+            # Cut off the entry that was partly written, so the next one follows the last whole entry
+            self.tar.fileobj.seek(start)
+            self.tar.fileobj.truncate()
+            self.tar.offset = start
+            raise
+        # The data ends at the current offset, padded to a whole block
+        blocks = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+        offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+        self.index.write(json.dumps({"name": info.name, "offset": offset, "size": size}) + "\n")
+        # Flush after every entry, since worker processes may be stopped without closing their volumes
+        self.tar.fileobj.flush()
+        self.index.flush()
+        if self.tar.offset >= self.volume_size:
+            self.close()
+
+    def write(self, file_path, content):
+        """Store content, a bytes object, at file_path."""
+        self._add(file_path, io.BytesIO(content), len(content))
+        _written.append((file_path, len(content), hashlib.md5(content).hexdigest()))
+
+    def store(self, file_path, source_path, content_hash=None):
+        """Store the file at source_path at file_path. The file at source_path is removed.
+
+        content_hash is the hex md5 hash of the file, if it is already known.
+        """
+        size = os.path.getsize(source_path)
+        with open(source_path, "rb") as file:
+            if content_hash is None:
+                content_hash = _md5(file)
+                file.seek(0)
+            self._add(file_path, file, size)
+        remove_temporary(source_path)
+        _written.append((file_path, size, content_hash))
+
+    def close(self):
+        """Finish the current volume. The next download starts a new one."""
+        if self.tar is not None:
+            self.tar.close()
+            self.index.close()
+            self.tar = None
+            self.index = None
+
+
+class S3(Storage):
+    """Uploads the downloads to a bucket in an S3 compatible object store.
+
+    Files are uploaded in parts of PART_SIZE bytes while they download, so only one
+    part is held in memory at a time. Since the names of the files depend on their
+    content, they are uploaded under a temporary key first, and copied to their
+    final key inside the store once the download is finished.
+
+    The keys are the paths of the files relative to directory, after prefix. The
+    paths, sizes and md5 hashes of the files are recorded, see take_written.
+
+    Args:
+        bucket: The name of the bucket.
+        prefix: The prefix to put in front of the keys, like "reddit/".
+        directory: The save directory, which the paths are relative to.
+        endpoint: The url of the store, if it isn't Amazon S3.
+        client: An S3 client. If None, one is created with boto3, which needs to be installed.
+        errors: A tuple of the exceptions the client raises when a request fails. By default,
+            the ones of botocore. They are raised as DownloadError instead.
+    """
+    # S3 needs the parts of a multipart upload, other than the last one, to be at least 5MiB.
+    PART_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, bucket, prefix="", directory=".", endpoint=None, client=None, errors=None):
+        if client is None:
+            # boto3 is optional, and only needed for this storage
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint)
+        if errors is None:
+            errors = _client_errors()
+        self.client = client
+        self.errors = errors
+        self.bucket = bucket
+        self.prefix = prefix
+        self.directory = directory
+
+    def key(self, file_path):
+        """Return the key to store the file at file_path under."""
+        return self.prefix + os.path.relpath(file_path, self.directory).replace(os.sep, "/")
+
+    @contextlib.contextmanager
+    def _requests(self, file_path):
+        """Raise the errors of the requests sent inside as DownloadError, so that only the download fails."""
+        try:
+            yield
+        except self.errors as error:
+            raise DownloadError("Storing {} in S3 failed: {}".format(file_path, error)) from error
+
+    def _upload(self, key, chunks):
+        """Upload the chunks under key, in parts if they add up to more than PART_SIZE."""
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= self.PART_SIZE:
+                    if upload_id is None:
+                        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)["UploadId"]
+                    parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+                    buffer.clear()
+            if upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return
+            if buffer:
+                parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def _upload_part(self, key, upload_id, number, body):
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                           PartNumber=number, Body=body)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def write(self, file_path, content):
+        """Store content, a bytes object, at file_path."""
+        with self._requests(file_path):
+            self.client.put_object(Bucket=self.bucket, Key=self.key(file_path), Body=content)
+        _written.append((file_path, len(content), hashlib.md5(content).hexdigest()))
+
+    def store(self, file_path, source_path, content_hash=None):
+        """Store the file at source_path at file_path. The file at source_path is removed.
+
+        content_hash is the hex md5 hash of the file, if it is already known.
+        """
+        size = os.path.getsize(source_path)
+        with open(source_path, "rb") as file, self._requests(file_path):
+            if content_hash is None:
+                content_hash = _md5(file)
+                file.seek(0)
+            self._upload(self.key(file_path), iter(lambda: file.read(CHUNK_SIZE), b""))
+        remove_temporary(source_path)
+        _written.append((file_path, size, content_hash))
+
+    def stream(self, folder, chunks, file_path_for, size=None):
+        """Upload a file arriving in chunks, whose path depends on its content, see Storage.stream."""
+        content_hash = hashlib.md5()
+        size = 0
+
+        def hashed(chunks):
+            nonlocal size
+            for chunk in chunks:
+                content_hash.update(chunk)
+                size += len(chunk)
+                yield chunk
+        temp_key = "{}.incoming/{}".format(self.prefix, uuid.uuid4().hex)
+        with self._requests(folder):
+            self._upload(temp_key, hashed(chunks))
+            try:
+                # A single copy is limited to 5GB, far above the size of the images and videos on Reddit
+                file_path = file_path_for(content_hash)
+                self.client.copy_object(Bucket=self.bucket, Key=self.key(file_path),
+                                        CopySource={"Bucket": self.bucket, "Key": temp_key})
+            finally:
+                self.client.delete_object(Bucket=self.bucket, Key=temp_key)
+        _written.append((file_path, size, content_hash.hexdigest()))
+
+
+def _client_errors():
+    """Return the exceptions raised by boto3 clients when a request fails, or () if botocore isn't installed."""
+    try:
+        from botocore.exceptions import BotoCoreError, ClientError
+    except ImportError:
+        return ()
+    # EndpointConnectionError and the credential errors are BotoCoreErrors
+    return BotoCoreError, ClientError
+
+
+def _file_mode():
+    """Return the permissions new files get, which are the ones the umask leaves of 0666."""
+    global _mode
+    if _mode is None:
+        # The umask can only be read by replacing it, so it is read once
+        umask = os.umask(0)
+        os.umask(umask)
+        _mode = 0o666 & ~umask
+    return _mode
+
+
+def _md5(file):
+    """Return the hex md5 hash of the content of a file object."""
+    content_hash = hashlib.md5()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def preallocate(file, size):
+    """Allocate size bytes on the disk for file, an open file object, if the system supports it.
+
+    This keeps the file from being fragmented while it is written, and fails early if
+    the disk is full. The file is extended to size bytes if it is shorter.
+    """
+    if not size or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError as error:
+        # Some file systems, like the ones over the network, can't allocate space beforehand
+        if error.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+
+
+def fsync(path):
+    """Flush the file or the folder at path to the disk. Folders can't be synced on Windows."""
+    # Folders can only be opened for reading, and Windows only syncs files opened for writing
+    descriptor = os.open(path, os.O_RDONLY if os.name == "posix" else os.O_RDWR)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync(paths):
+    """Flush the files at paths, and the folders they were renamed in, to the disk.
+
+    The files are synced at once by SYNC_THREADS threads, then their folders, so that
+    the new names are kept as well. Files that no longer exist are skipped.
+    """
+    paths = set(paths)
+    folders = {os.path.dirname(path) or "." for path in paths}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_THREADS) as executor:
+        for batch in (paths, folders if os.name == "posix" else ()):
+            for future in [executor.submit(fsync, path) for path in batch]:
+                try:
+                    future.result()
+                except FileNotFoundError:
+                    pass
+
+
+def read_entry(volume_path, name):
+    """Read the file called name from a tar volume, using its index.
+
+    Returns:
+        The content of the file as bytes.
+
+    Raises:
+        KeyError if the volume doesn't contain the file.
+    """
+    with open(volume_path + ".idx", encoding="utf-8") as index:
+        for line in index:
+            entry = json.loads(line)
+            if entry["name"] == name:
+                with open(volume_path, "rb") as volume:
+                    volume.seek(entry["offset"])
+                    return volume.read(entry["size"])
+    raise KeyError(name)
+
+
+def temporary_file(folder):
+    """Create a temporary file in folder for a download, and return it open for writing.
+
+    The file is kept track of until it is stored, or removed with remove_temporary,
+    so that remove_partial can clean it up if the download is interrupted.
+    """
+    file = tempfile.NamedTemporaryFile(dir=folder, prefix=".", suffix=".part", delete=False)
+    _partial.add(file.name)
+    return file
+
+
+def remove_temporary(path):
+    """Remove the file at path, and stop keeping track of it if it is a temporary file."""
+    os.remove(path)
+    _partial.discard(path)
+
+
+def remove_partial():
+    """Remove the temporary files of the downloads that were interrupted, see temporary_file.
+
+    A download that runs past its deadline is stopped wherever it is, possibly
+    before it could remove its temporary files itself.
+    """
+    for path in _partial:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    _partial.clear()
+
+
+def take_written():
+    """Return a tuple of (path, size, md5) tuples of the files written since the last call, and start again.
+
+    They are kept alongside the history, so that damaged files can be found later, see scan,
+    and in the catalogue.
+    """
+    written = tuple(_written)
+    _written.clear()
+    return written
+
+
+def storage():
+    """Return the storage of this process, creating it from shared_config if needed."""
+    global _storage
+    if _storage is None:
+        if shared_config.STORAGE == "tar":
+            _storage = TarVolumes(shared_config.ARCHIVE_DIR, shared_config.VOLUME_SIZE)
+        elif shared_config.STORAGE == "s3":
+            _storage = S3(shared_config.S3_BUCKET, shared_config.S3_PREFIX, shared_config.ARCHIVE_DIR,
+                          shared_config.S3_ENDPOINT)
+        else:
+            _storage = Files()
+    return _storage
+
+
+def reset():
+    """Forget the storage of this process, without closing it.
+
+    Worker processes call this when they start, so that they don't write into the
+    volumes of the parent process.
+    """
+    global _storage
+    _storage = None
+
+
+def close():
+    """Close the storage of this process, if it was used."""
+    global _storage
+    if _storage is not None:
+        _storage.close()
+        _storage = None
@@ -16,8 +16,9 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from bs4 import BeautifulSoup
-import requests
 import re
+from redditcurl import websites
+from redditcurl.websites import fetch
 from redditcurl.websites import direct
 from redditcurl.exceptions import DownloadError
 
@@ -25,7 +26,7 @@ _TWITTER_SEARCH_PROPERTY = "og:image"
 _TWITTER_IMAGE_MATCH = re.compile("https?://pbs.twimg.com/media/").match
 
 
-match = re.compile("^https?://twitter.com/[0-9a-zA-Z_]+/status/[0-9]+$").match
+match = re.compile(websites.pattern("twitter")).search
 
 
 def download(url, path, file_name=""):
@@ -40,9 +41,8 @@ def download(url, path, file_name=""):
         file_name: The file name to use when saving the file.
             file_name is an empty string, then name of the downloaded file will be used.
     """
-    request = requests.get(url)
-    if not request.ok:
-        raise DownloadError("Failed while getting data from Twitter for {}".format(url))
+    request = fetch.get(url)
+    fetch.check(request, "Failed while getting data from Twitter for {}".format(url))
     soup = BeautifulSoup(request.content, "html.parser")
     # Twitter stores image link in meta property.
     image = soup.head.find("meta", property=_TWITTER_SEARCH_PROPERTY)["content"]
@@ -0,0 +1,174 @@
+"""
+    redditcurl, download the images you saved on Reddit.
+    Copyright (C) 2015  Kaan Genç
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+import contextlib
+from redditcurl.manager import Job
+
+logger = logging.getLogger("main")
+
+# Seconds a leased job stays with the instance that leased it, unless the lease is renewed.
+# If an instance stops renewing its leases, such as when it crashes, its jobs go back
+# to the other instances once their leases run out.
+LEASE_TIME = 300
+
+# A job whose lease ran out this many times is marked as failed, rather than being
+# leased again, so a job that crashes every instance can't go around forever.
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    title TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+)
+"""
+
+
+class SQLiteQueue:
+    """A queue of download jobs shared by several redditcurl instances, kept in an SQLite database.
+
+    Instances lease jobs from the queue, renew their leases while downloading, and
+    mark the jobs as done or failed when they finish. A job is only leased by one
+    instance at a time. The database can be on a shared file system, as long as the
+    file system supports the locks SQLite uses.
+
+    The folders of the jobs should be relative to the save directory, like the
+    jobs file written by manager.write_jobs.
+
+    Args:
+        path: Path to the database. It will be created if it doesn't exist.
+        lease_time: Seconds a lease lasts, see LEASE_TIME.
+        owner: A name for this instance, unique between the instances using the queue.
+            If None, one is made up from the host name and the process id.
+    """
+    def __init__(self, path, lease_time=LEASE_TIME, owner=None):
+        self.path = path
+        self.lease_time = lease_time
+        if owner is None:
+            owner = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.owner = owner
+        self.connection = self._connect()
+        self.connection.execute(_SCHEMA)
+
+    def _connect(self):
+        # Transactions are started explicitly, so the jobs can be locked while leasing them
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+
+    def add(self, download_queue):
+        """Add the jobs in download_queue, skipping the ones already in the queue.
+
+        Returns:
+            The number of jobs that were added.
+        """
+        with self._transaction() as cursor:
+            cursor.executemany("INSERT OR IGNORE INTO jobs (id, url, folder, title) VALUES (?, ?, ?, ?)",
+                               download_queue)
+            return cursor.rowcount
+
+    def lease(self, count):
+        """Lease up to count jobs that are waiting, or whose leases ran out.
+
+        Returns:
+            A list of Jobs. If it is empty, there are no jobs left to lease, although
+            jobs leased by other instances may still come back if their leases run out.
+        """
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET state = 'failed', error = 'LeaseExpired' "
+                           "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, MAX_ATTEMPTS))
+            rows = cursor.execute("SELECT id, url, folder, title FROM jobs "
+                                  "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                                  "ORDER BY rowid LIMIT ?", (now, count)).fetchall()
+            cursor.executemany("UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?, "
+                               "attempts = attempts + 1 WHERE id = ?",
+                               [(self.owner, now + self.lease_time, row[0]) for row in rows])
+        return [Job(*row) for row in rows]
+
+    def renew(self, connection=None):
+        """Extend the leases of the jobs this instance is downloading."""
+        connection = connection or self.connection
+        connection.execute("UPDATE jobs SET lease_until = ? WHERE state = 'leased' AND owner = ?",
+                           (time.time() + self.lease_time, self.owner))
+
+    def complete(self, results):
+        """Mark the jobs of results as done or failed.
+
+        Jobs whose leases were lost to another instance are left alone.
+
+        Args:
+            results: An iterable of manager.Results.
+        """
+        with self._transaction() as cursor:
+            cursor.executemany("UPDATE jobs SET state = ?, error = ? "
+                               "WHERE id = ? AND owner = ? AND state = 'leased'",
+                               [("done" if result.successful else "failed", result.error, result.job.id, self.owner)
+                                for result in results])
+
+    def counts(self):
+        """Returns a dictionary of the number of jobs in each state."""
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    @contextlib.contextmanager
+    def heartbeat(self):
+        """Keep renewing the leases of this instance in a background thread, while in the block."""
+        stop = threading.Event()
+
+        def beat():
+            connection = self._connect()
+            try:
+                while not stop.wait(self.lease_time / 3):
+                    try:
+                        self.renew(connection)
+                    except sqlite3.Error as err:
+                        # Keep trying, the lease may still be renewed before it runs out
+                        logger.warning("Renewing the leases failed: {}".format(err))
+            finally:
+                connection.close()
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
@@ -11,6 +11,8 @@ setup(
     url="https://github.com/SeriousBug/redditcurl",
     download_url="https://github.com/SeriousBug/redditcurl/releases",
     install_requires=["praw", "requests", "beautifulsoup4"],
+    extras_require={"s3": ["boto3"], "dedup": ["numpy", "Pillow"]},
+    python_requires=">=3.7",
     keywords=["reddit", "images", "download"],
     packages=["redditcurl", "redditcurl/websites"],
     entry_points={
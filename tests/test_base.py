@@ -3,6 +3,7 @@ import tempfile
 import unittest
 import shutil
 from unittest.mock import MagicMock
+from redditcurl.manager import Job, Result, Saved, slim
 
 
 test_links = {
@@ -49,17 +50,26 @@ access_token = accesstoken
 """
 
 
-def create_submission(url="", title="", subreddit=""):
+def create_submission(url="", title="", subreddit="", id=""):
     submission = MagicMock()
+    submission.id = id
     submission.url = url
     submission.title = title
     submission.subreddit.display_name = subreddit
+    submission.fullname = "t3_" + id
+    submission.created_utc = 0.0
     return submission
 
 
-test_submissions = [create_submission(url, title, "testsubreddit") for title, url in test_links.items()]
-test_downloaded = [(url, (lambda x: x != "fail")(title)) for title, url in test_links.items()]
-# Creates a downloaded items list, with all test links as successfully downloaded except "fail" link.
+def create_saved(url="", title="", subreddit="", id=""):
+    return Saved(id, "t3_" + id, url, title, subreddit, 0.0)
+
+
+# The submissions as they come from praw, and the manager.Saved records made from them.
+test_submissions = [create_submission(url, title, "testsubreddit", title) for title, url in test_links.items()]
+test_saved = list(slim(test_submissions))
+test_downloaded = {sub.id: Result(Job(sub.id, sub.url, "", sub.title), sub.id != "fail") for sub in test_submissions}
+# Creates a downloaded items dictionary, with all test links as successfully downloaded except "fail" link.
 
 
 class EnterTemp(unittest.TestCase):
@@ -75,3 +85,38 @@ class EnterTemp(unittest.TestCase):
 
     def tearDown(self):
         shutil.rmtree(os.getcwd(), ignore_errors=True)
+
+
+class FakeResponse:
+    """Stands in for a requests.Response."""
+    def __init__(self, status_code=200, headers=None, content=b""):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self.content = content
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def fake_server(content, content_type="video/mp4", accept_ranges=True):
+    """Return a function to replace websites.fetch.get, serving content for any url.
+
+    Requests with a Range header get the requested bytes, if accept_ranges is True.
+    The requests that were made are recorded in the requests attribute of the function.
+    """
+    def get(url, headers=None, **kwargs):
+        get.requests.append((url, headers))
+        if accept_ranges and headers and "Range" in headers:
+            start, end = (int(n) for n in headers["Range"][len("bytes="):].split("-"))
+            return FakeResponse(206, {"Content-Type": content_type}, content[start:end + 1])
+        response_headers = {"Content-Type": content_type, "Content-Length": str(len(content))}
+        if accept_ranges:
+            response_headers["Accept-Ranges"] = "bytes"
+        return FakeResponse(200, response_headers, content)
+    get.requests = []
+    return get
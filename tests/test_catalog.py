@@ -0,0 +1,72 @@
+import io
+import os
+import json
+from tests import test_base
+from redditcurl import catalog
+from redditcurl.manager import Job, Result
+
+
+test_links = test_base.test_links
+
+
+class TestCatalog(test_base.EnterTemp):
+    def setUp(self):
+        super().setUp()
+        self.catalog = catalog.Catalog(os.path.join("sub", ".downloaded.catalog.db"))
+        self.saved = [test_base.create_saved(test_links["direct"], "First", "Pics", "first"),
+                      test_base.create_saved(test_links["imgur_album"], "Second", "wallpapers", "second")]
+        self.catalog.add_submissions(self.saved)
+        self.catalog.add_files([
+            Result(Job("first", test_links["direct"], "sub", "First"), True, None,
+                   ((os.path.join("sub", "First.jpeg"), 10, "aaaa"),)),
+            Result(Job("second", test_links["imgur_album"], "sub", "Second"), True, None,
+                   ((os.path.join("sub", "Second.1.jpg"), 20, "bbbb"),
+                    (os.path.join("sub", "Second.2.jpg"), 30, "aaaa"))),
+            Result(Job("failed", test_links["fail"], "sub", "Failed"), False, "DownloadError"),
+            # Submissions that weren't listed by this instance, like the ones in a jobs file
+            Result(Job("third", test_links["gfycat"], "sub", "Third"), True, None,
+                   ((os.path.join("sub", "Third.webm"), 40, "cccc"),)),
+        ])
+
+    def tearDown(self):
+        self.catalog.close()
+        super().tearDown()
+
+    def test_query(self):
+        self.assertEqual([entry.path for entry in self.catalog.query()],
+                         ["First.jpeg", "Second.1.jpg", "Second.2.jpg", "Third.webm"])
+        first = self.catalog.query(subreddit="pics")[0]
+        self.assertEqual((first.path, first.size, first.subreddit, first.title, first.downloader),
+                         ("First.jpeg", 10, "Pics", "First", "direct"))
+        self.assertEqual(first.permalink, "https://www.reddit.com/comments/first/")
+        self.assertEqual([entry.path for entry in self.catalog.query(md5="aaaa")], ["First.jpeg", "Second.2.jpg"])
+        self.assertEqual([entry.path for entry in self.catalog.query(url=test_links["imgur_album"], md5="aaaa")],
+                         ["Second.2.jpg"])
+        third = self.catalog.query(submission_id="third")[0]
+        self.assertEqual((third.url, third.subreddit, third.downloader), (test_links["gfycat"], None, "gfycat"))
+
+    def test_indexes(self):
+        for column in ("submissions.subreddit", "files.md5", "files.url"):
+            plan = self.catalog.connection.execute(
+                "EXPLAIN QUERY PLAN " + catalog._SELECT + "WHERE {} = ?".format(column) +
+                (" COLLATE NOCASE" if column == "submissions.subreddit" else ""), ("x",)).fetchall()
+            self.assertIn("USING INDEX", " ".join(str(row[-1]) for row in plan), column)
+
+    def test_move_files(self):
+        self.catalog.move_files({os.path.join("sub", "First.jpeg"): os.path.join("sub", "ab", "cd", "First.jpeg")})
+        self.assertEqual([entry.path for entry in self.catalog.query(submission_id="first")],
+                         [os.path.join("ab", "cd", "First.jpeg")])
+
+    def test_stats(self):
+        self.assertEqual(self.catalog.stats()[0], ("wallpapers", 2, 50))
+        self.assertEqual(len(self.catalog.stats()), 3)
+
+    def test_write_entries(self):
+        output = io.StringIO()
+        catalog.write_entries(self.catalog.query(md5="bbbb"), output, "jsonl")
+        self.assertEqual(json.loads(output.getvalue())["path"], "Second.1.jpg")
+        output = io.StringIO()
+        catalog.write_entries(self.catalog.query(md5="bbbb"), output, "tsv")
+        header, row = output.getvalue().splitlines()
+        self.assertEqual(header.split("\t")[:3], ["path", "size", "md5"])
+        self.assertEqual(row.split("\t")[:3], ["Second.1.jpg", "20", "bbbb"])
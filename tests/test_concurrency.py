@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+from redditcurl import concurrency
+
+
+class TestController(unittest.TestCase):
+    def finish_window(self, controller, host="imgur.com", nbytes=1000, throttled=False, elapsed=1):
+        for _ in range(controller.limit):
+            controller.started(host)
+        for _ in range(controller.limit):
+            controller.finished(host, elapsed, nbytes, throttled)
+
+    def test_start_at_floor(self):
+        controller = concurrency.Controller(2, 10)
+        self.assertEqual(controller.limit, 2)
+        controller.started("imgur.com")
+        controller.started("gfycat.com")
+        self.assertFalse(controller.has_room())
+        self.assertFalse(controller.can_start("imgur.com"))
+
+    def test_additive_increase(self):
+        controller = concurrency.Controller(2, 10)
+        self.finish_window(controller)
+        self.assertEqual(controller.limit, 3)
+        self.finish_window(controller, nbytes=2000)
+        self.assertEqual(controller.limit, 4)
+
+    def test_ceiling(self):
+        controller = concurrency.Controller(2, 3)
+        for _ in range(5):
+            self.finish_window(controller)
+        self.assertEqual(controller.limit, 3)
+
+    @mock.patch("time.monotonic")
+    def test_throughput_drop(self, mocked_time):
+        mocked_time.return_value = 0
+        controller = concurrency.Controller(2, 10)
+        mocked_time.return_value = 1
+        self.finish_window(controller, nbytes=1000)
+        self.assertEqual(controller.limit, 3)
+        # Raising the limit made the throughput worse, so the controller should step back
+        mocked_time.return_value = 2
+        self.finish_window(controller, nbytes=100)
+        self.assertEqual(controller.limit, 2)
+
+    @mock.patch("time.monotonic")
+    def test_latency_rise(self, mocked_time):
+        mocked_time.return_value = 0
+        controller = concurrency.Controller(2, 10)
+        mocked_time.return_value = 1
+        self.finish_window(controller, nbytes=1000)
+        self.assertEqual(controller.limit, 3)
+        # The downloads take twice as long with about the same throughput, so the controller should step back
+        mocked_time.return_value = 2
+        self.finish_window(controller, nbytes=650, elapsed=2)
+        self.assertEqual(controller.limit, 2)
+        # Slower downloads that bring in more bytes are worth it
+        mocked_time.return_value = 3
+        self.finish_window(controller, nbytes=1000, elapsed=1)
+        self.assertEqual(controller.limit, 3)
+        mocked_time.return_value = 4
+        self.finish_window(controller, nbytes=1000, elapsed=2)
+        self.assertEqual(controller.limit, 4)
+
+    def test_throttled(self):
+        controller = concurrency.Controller(1, 16)
+        controller.limit = 8
+        controller.started("imgur.com")
+        controller.started("imgur.com")
+        controller.finished("imgur.com", 1, 0, True)
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.host_limits["imgur.com"], 4)
+        # Only halve once for each window
+        controller.finished("imgur.com", 1, 0, True)
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.host_limits["imgur.com"], 2)
+
+    def test_host_limit(self):
+        controller = concurrency.Controller(4, 16)
+        controller.host_limits["imgur.com"] = 1
+        controller.started("imgur.com")
+        self.assertFalse(controller.can_start("imgur.com"))
+        self.assertTrue(controller.can_start("gfycat.com"))
+
+    def test_floor(self):
+        controller = concurrency.Controller(2, 16)
+        controller.started("imgur.com")
+        controller.finished("imgur.com", 1, 0, True)
+        self.assertEqual(controller.limit, 2)
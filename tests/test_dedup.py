@@ -0,0 +1,108 @@
+import os
+import random
+import unittest
+import importlib.util
+from unittest import mock
+from tests import test_base
+from redditcurl import dedup
+from redditcurl import manager
+from redditcurl import __main__ as main
+
+has_imaging = importlib.util.find_spec("numpy") is not None and importlib.util.find_spec("PIL") is not None
+
+
+def save_image(path, seed, size=(180, 160), mtime=0):
+    """Save an image of random gray blocks, the same for the same seed, scaled to size."""
+    from PIL import Image
+    generator = random.Random(seed)
+    image = Image.new("L", (9, 8))
+    image.putdata([generator.randrange(256) for _ in range(9 * 8)])
+    image.resize(size, Image.NEAREST).convert("RGB").save(path)
+    os.utime(path, (mtime, mtime))
+
+
+@unittest.skipUnless(has_imaging, "numpy and Pillow are needed for deduplication")
+class TestHashIndex(unittest.TestCase):
+    def test_search(self):
+        index = dedup.HashIndex()
+        index.add(0b1111, "a")
+        index.add(0b0111, "b")
+        index.add(2 ** 64 - 1, "c")
+        self.assertEqual(index.search(0b1111, 1), [(0, "a"), (1, "b")])
+        self.assertEqual(index.search(2 ** 64 - 2, 0), [])
+        self.assertEqual(index.search(2 ** 64 - 2, 1), [(1, "c")])
+
+    @mock.patch("redditcurl.dedup.INITIAL_CAPACITY", new=4)
+    def test_grow(self):
+        index = dedup.HashIndex()
+        for i in range(10):
+            index.add(1 << i, str(i))
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index.search(1 << 9, 0), [(0, "9")])
+
+
+@unittest.skipUnless(has_imaging, "numpy and Pillow are needed for deduplication")
+class TestDeduplicate(test_base.EnterTemp):
+    def setUp(self):
+        super().setUp()
+        save_image("original.png", 1, mtime=100)
+        # The same image, smaller and as a jpeg
+        save_image(os.path.join("sub", "copy.jpg"), 1, size=(90, 80), mtime=200)
+        save_image("other.png", 2, mtime=300)
+        with open("video.mp4", "wb") as file:
+            file.write(b"not an image")
+
+    def test_dhash(self):
+        self.assertLessEqual(bin(dedup.dhash("original.png") ^ dedup.dhash(os.path.join("sub", "copy.jpg"))).count("1"),
+                             dedup.MAX_DISTANCE)
+        self.assertGreater(bin(dedup.dhash("original.png") ^ dedup.dhash("other.png")).count("1"),
+                           dedup.MAX_DISTANCE)
+        self.assertIsNone(dedup.dhash("video.mp4"))
+
+    def test_flag(self):
+        self.assertEqual(dedup.deduplicate(".", ".phash.gz", "flag", processes=1), 1)
+        self.assertTrue(os.path.isfile(os.path.join("sub", "copy.jpg")))
+        index, known = dedup.read_index(".phash.gz")
+        self.assertEqual(known, {"original.png", os.path.join("sub", "copy.jpg"), "other.png", "video.mp4"})
+        self.assertEqual(len(index), 3)
+        # Files that were hashed before aren't hashed again
+        self.assertEqual(dedup.deduplicate(".", ".phash.gz", "flag", processes=1), 0)
+
+    def test_link(self):
+        dedup.deduplicate(".", ".phash.gz", "link", processes=1)
+        self.assertTrue(os.path.samefile("original.png", os.path.join("sub", "copy.jpg")))
+        self.assertFalse(os.path.samefile("original.png", "other.png"))
+
+    def test_remove(self):
+        dedup.deduplicate(".", ".phash.gz", "remove", processes=1)
+        self.assertFalse(os.path.exists(os.path.join("sub", "copy.jpg")))
+        self.assertTrue(os.path.isfile("original.png"))
+        # A new copy is compared with the images hashed in the earlier runs
+        save_image("again.jpg", 1, size=(120, 100), mtime=400)
+        self.assertEqual(dedup.deduplicate(".", ".phash.gz", "remove", processes=1), 1)
+        self.assertFalse(os.path.exists("again.jpg"))
+        self.assertEqual(dedup.read_resolved(".phash.gz"), {os.path.join("sub", "copy.jpg"): "original.png",
+                                                            "again.jpg": "original.png"})
+
+    def scan_after(self, action):
+        """Run deduplicate with action, then scan the save directory, returning what scan_savedir returns."""
+        # The video isn't a real one, and the scan would take it for a damaged file
+        os.remove("video.mp4")
+        # The images are in the files list as they were downloaded
+        job = manager.Job("copy", "https://example.com/copy.jpg", "sub", "copy")
+        written = tuple((path, os.path.getsize(path), "md5")
+                        for path in ("original.png", os.path.join("sub", "copy.jpg")))
+        manager.record_files([manager.Result(job, True, None, written)], manager.files_file(".downloaded.gz"))
+        dedup.deduplicate(".", dedup.index_file(".downloaded.gz"), action, processes=1)
+        conf_r = main.get_config(main.setup_parser().parse_args(["-d", "."]), "no-config-file")["redditcurl"]
+        return main.scan_savedir(conf_r, ".downloaded.gz", set(), 1)
+
+    def test_scan_link(self):
+        # The link has the size of the original, not the one in the files list
+        self.assertEqual(self.scan_after("link"), (0, 0))
+        self.assertTrue(os.path.samefile("original.png", os.path.join("sub", "copy.jpg")))
+
+    def test_scan_remove(self):
+        # The removed image isn't taken for a missing file, and downloaded again
+        self.assertEqual(self.scan_after("remove"), (0, 0))
+        self.assertFalse(os.path.exists(os.path.join("sub", "copy.jpg")))
@@ -1,8 +1,17 @@
 import os
+import io
+import time
+import stat
+import tempfile
+import configparser
+import argparse
 import unittest
 from unittest import mock
 from tests import test_base
 from redditcurl import __main__ as main
+from redditcurl import catalog, manager
+from redditcurl.manager import Job, Result
+from redditcurl.websites import layout, shared_config
 
 
 test_links = test_base.test_links
@@ -21,6 +30,11 @@ class TestArguments(unittest.TestCase):
         self.assertEqual(argdict["subfolders"], "True")
         self.assertEqual(argdict["subreddits"], "test,testing")
 
+    def test_args2dict_dashes(self):
+        args = main.setup_parser().parse_args(["--prefer-mp4", "--read-timeout", "5"])
+        argdict = main.args2dict(args)
+        self.assertEqual(argdict, {"prefer-mp4": "True", "read-timeout": "5.0"})
+
     def test_parser_empty(self):
         parser = main.setup_parser()
         args = parser.parse_args([])
@@ -73,21 +87,126 @@ class TestConfig(test_base.EnterTemp):
         self.assertTrue(conf.getboolean("notitles"))
 
 
+class TestConcurrency(unittest.TestCase):
+    def test_fixed(self):
+        conf = main.get_config(main.setup_parser().parse_args(test_args), "no-config-file")["redditcurl"]
+        self.assertEqual(main.get_concurrency(conf), (10, None))
+
+    def test_auto(self):
+        args = main.setup_parser().parse_args(["-d", "testdir", "-c", "auto", "--max-processes", "8"])
+        conf = main.get_config(args, "no-config-file")["redditcurl"]
+        processes, controller = main.get_concurrency(conf)
+        self.assertEqual(processes, 8)
+        self.assertEqual((controller.floor, controller.ceiling), (2, 8))
+
+    def test_invalid(self):
+        args = main.setup_parser().parse_args(["-d", "testdir", "-c", "many"])
+        conf = main.get_config(args, "no-config-file")["redditcurl"]
+        with self.assertRaises(main.ConfigError):
+            main.get_concurrency(conf)
+
+
+class TestShard(unittest.TestCase):
+    def test_shard(self):
+        conf = main.get_config(main.setup_parser().parse_args(["-d", "testdir", "--shard", "2/4"]),
+                               "no-config-file")["redditcurl"]
+        self.assertEqual(main.get_shard(conf), (1, 4))
+
+    def test_invalid(self):
+        for shard in ("2", "0/4", "5/4", "a/b"):
+            conf = main.get_config(main.setup_parser().parse_args(["-d", "testdir", "--shard", shard]),
+                                   "no-config-file")["redditcurl"]
+            with self.assertRaises(main.ConfigError):
+                main.get_shard(conf)
+
+
+class TestRateLimit(unittest.TestCase):
+    @mock.patch("redditcurl.websites.shared_config.MAX_RATE", new=0)
+    @mock.patch("redditcurl.websites.shared_config.RATE_SCHEDULE", new=[])
+    def test_rate_limit(self):
+        args = main.setup_parser().parse_args(["-d", "testdir", "--max-rate", "2M",
+                                               "--rate-schedule", "09:00-17:00=100K"])
+        main.set_rate_limit(main.get_config(args, "no-config-file")["redditcurl"])
+        self.assertEqual(main.shared_config.MAX_RATE, 2 * 1024 ** 2)
+        self.assertEqual(main.shared_config.RATE_SCHEDULE, [(540, 1020, 100 * 1024)])
+
+    def test_invalid(self):
+        args = main.setup_parser().parse_args(["-d", "testdir", "--max-rate", "fast"])
+        with self.assertRaises(main.ConfigError):
+            main.set_rate_limit(main.get_config(args, "no-config-file")["redditcurl"])
+
+
+class TestStorage(unittest.TestCase):
+    def test_s3_needs_bucket(self):
+        args = main.setup_parser().parse_args(["-d", "testdir", "--storage", "s3"])
+        with self.assertRaises(main.ConfigError):
+            main.set_s3(main.get_config(args, "no-config-file")["redditcurl"])
+
+
+class TestDedup(unittest.TestCase):
+    def get_conf(self, *args):
+        parsed = main.setup_parser().parse_args(["-d", "testdir"] + list(args))
+        return main.get_config(parsed, "no-config-file")["redditcurl"]
+
+    def test_storage(self):
+        with self.assertRaises(main.ConfigError):
+            main.check_dedup(self.get_conf("--dedup", "link", "--storage", "tar"))
+
+    @mock.patch("importlib.util.find_spec", return_value=None)
+    def test_missing_dependencies(self, mocked):
+        with self.assertRaises(main.ConfigError):
+            main.check_dedup(self.get_conf("--dedup", "link"))
+
+
 class TestCountSuccess(unittest.TestCase):
+    def session(self):
+        """Return a praw.Reddit session authorized with OAUTH_SCOPES, which records its requests instead."""
+        import praw
+        r = praw.Reddit(user_agent="redditcurl tests")
+        r._authentication = set(main.OAUTH_SCOPES)
+        # Record whether each request would be sent over OAuth
+        r.request_json = mock.MagicMock(side_effect=lambda url, data: r.oauth_requests.append(r._use_oauth))
+        r.oauth_requests = []
+        r.evict = mock.MagicMock()
+        return r
+
+    def unsaved(self, r):
+        return [call[1]["data"]["id"] for call in r.request_json.call_args_list]
+
     def test_count_success(self):
-        mocked_saved = mock.MagicMock()
+        r = self.session()
         # Do try removing saved images
-        scount, fcount, sdown = main.count_success(test_downloaded, True, mocked_saved)
-        # There should be only a single failed link, see test_base.mocked_saved
+        scount, fcount, sdown = main.count_success(test_downloaded, True, test_base.test_saved, r)
+        # There should be only a single failed link, see test_base.test_downloaded
         self.assertEqual(scount, len(test_links) - 1)
         self.assertEqual(fcount, 1)
         self.assertEqual(len(sdown), len(test_links) - 1)
         self.assertNotIn(test_links["fail"], sdown)
-        # Make sure everything except the failed link was deleted.
-        # The function should only access them if it is going to unsave them, so checking that is enough.
-        self.assertEqual(mocked_saved.__getitem__.call_count, len(test_links) - 1)
-        fail_index = test_downloaded.index((test_links["fail"], False))
-        self.assertNotIn(mock.call(fail_index), mocked_saved.__getitem__.call_args_list)
+        # Make sure everything except the failed link was unsaved, by their fullnames
+        self.assertEqual(sorted(self.unsaved(r)),
+                         sorted(submission.fullname for submission in test_base.test_saved
+                                if submission.id != "fail"))
+        self.assertTrue(all(r.oauth_requests))
+        r.evict.assert_called_once_with(r.config["saved"])
+
+    def test_count_success_filtered(self):
+        # Submissions filtered out before downloading must not shift the results onto other submissions
+        r = self.session()
+        skipped = test_base.create_saved("http://example.com/skipped.jpg", "skipped", "elsewhere", "skipped")
+        failed = test_base.create_saved(test_links["fail"], "fail", "testsubreddit", "failed")
+        done = test_base.create_saved(test_links["direct"], "direct", "testsubreddit", "done")
+        downloaded = {"done": Result(Job("done", done.url, "", "direct"), True),
+                      "failed": Result(Job("failed", failed.url, "", "fail"), False)}
+        main.count_success(downloaded, True, [skipped, failed, done], r)
+        self.assertEqual(self.unsaved(r), [done.fullname])
+
+    def test_slim(self):
+        comment = mock.MagicMock(spec=["id", "fullname", "body"])
+        saved = list(manager.slim([comment] + test_base.test_submissions))
+        # Saved comments are skipped, the submissions are turned into compact records
+        self.assertEqual(saved, test_base.test_saved)
+        self.assertEqual(saved[0], manager.Saved("direct", "t3_direct", test_links["direct"], "direct",
+                                                 "testsubreddit", 0.0))
 
 
 class TestMain(test_base.EnterTemp):
@@ -116,14 +235,22 @@ class TestMain(test_base.EnterTemp):
         mocked_download.return_value = test_base.test_downloaded
         mocked_count.return_value = (0, 0, [])
         main.__main__()
-        # Check if the authentication tokens were saved
-        self.assertTrue(os.path.isfile(os.path.join(os.getcwd(), "redditcurl")))
+        # Check if the authentication tokens were saved, without the command line options
+        conf = configparser.ConfigParser()
+        conf.read("redditcurl")
+        self.assertEqual(conf["oauth"]["refresh_token"], "refresh token")
+        self.assertEqual(conf["oauth"]["access_token"], "access token")
+        self.assertNotIn("redditcurl", conf)
+        if os.name == "posix":
+            # Only the owner can read the refresh token
+            self.assertEqual(stat.S_IMODE(os.stat("redditcurl").st_mode), 0o600)
         mocked_reddit.get_access_information.assert_called_once_with("auth code")
         mocked_reddit.user.get_saved.assert_called_once_with(limit=None)
-        mocked_download.assert_called_once_with(test_base.test_submissions,
-                                                "sub", 5, True, False, [])
+        mocked_download.assert_called_once_with(test_base.test_saved,
+                                                "sub", 5, True, False, [], pool=None,
+                                                controller=None)
         # We can't really check the other args
-        mdownloaded, mremove, _ = mocked_count.call_args[0]
+        mdownloaded, mremove, _, _ = mocked_count.call_args[0]
         self.assertEqual((mdownloaded, mremove), (test_base.test_downloaded, False))
 
     @mock.patch("praw.Reddit")
@@ -154,13 +281,15 @@ class TestMain(test_base.EnterTemp):
         self.assertTrue(os.path.isfile(os.path.join(os.getcwd(), "redditcurl")))
         mocked_reddit.set_access_credentials.assert_called_once_with(scope=main.OAUTH_SCOPES,
                                                                      access_token="accesstoken",
-                                                                     refresh_token="refreshtoken")
+                                                                     refresh_token="refreshtoken",
+                                                                     update_user=False)
         mocked_reddit.refresh_access_information.assert_called_once_with("refreshtoken")
         mocked_reddit.user.get_saved.assert_called_once_with(limit=None)
-        mocked_download.assert_called_once_with(test_base.test_submissions,
-                                                "sub", 5, True, False, [])
+        mocked_download.assert_called_once_with(test_base.test_saved,
+                                                "sub", 5, True, False, [], pool=None,
+                                                controller=None)
         # We can't really check the other args
-        mdownloaded, mremove, _ = mocked_count.call_args[0]
+        mdownloaded, mremove, _, _ = mocked_count.call_args[0]
         self.assertEqual((mdownloaded, mremove), (test_base.test_downloaded, False))
 
     @mock.patch("praw.Reddit")
@@ -170,6 +299,77 @@ class TestMain(test_base.EnterTemp):
     @mock.patch("redditcurl.manager.download_submissions")
     @mock.patch("redditcurl.manager.update_new")
     @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_cached_token(self, mocked_filehash, mocked_update, mocked_download,
+                               mocked_count, mocked_parser, mocked_environ,
+                               mocked_praw):
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "processes": 5,
+                                                                       "silent": True}
+        mocked_reddit = mocked_praw.return_value
+        mocked_reddit.refresh_access_information.return_value = {"access_token": "newtoken"}
+        mocked_environ.get.return_value = os.getcwd()
+        with open("redditcurl", "w") as conf_file:
+            conf_file.write(test_base.test_config_auth)
+        mocked_reddit.user.get_saved.return_value = test_base.test_submissions
+        mocked_download.return_value = test_base.test_downloaded
+        mocked_count.return_value = (0, 0, [])
+        main.__main__()
+        # The new access token is stored, without the command line options
+        conf = configparser.ConfigParser()
+        conf.read("redditcurl")
+        self.assertEqual(conf["oauth"]["access_token"], "newtoken")
+        self.assertGreater(float(conf["oauth"]["access_expires"]), time.time())
+        self.assertNotIn("redditcurl", conf)
+        # The next run uses the stored token, without refreshing it
+        main.__main__()
+        mocked_reddit.refresh_access_information.assert_called_once_with("refreshtoken")
+        mocked_reddit.set_access_credentials.assert_called_with(scope=main.OAUTH_SCOPES,
+                                                                access_token="newtoken",
+                                                                refresh_token="refreshtoken",
+                                                                update_user=True)
+
+    @unittest.skipUnless(os.name == "posix", "Windows doesn't have file permissions")
+    def test_save_tokens(self):
+        conf = configparser.ConfigParser()
+        conf.read_string(test_base.test_config_auth)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            conf_path = os.path.join(temp_dir, "redditcurl")
+            with open(conf_path, "w") as conf_file:
+                conf_file.write(test_base.test_config_auth)
+            os.chmod(conf_path, 0o640)
+            main.save_tokens(conf, conf_path, "newtoken", time.time())
+            # The file keeps its permissions, and no temporary files are left behind
+            self.assertEqual(stat.S_IMODE(os.stat(conf_path).st_mode), 0o640)
+            self.assertEqual(os.listdir(temp_dir), ["redditcurl"])
+            stored = configparser.ConfigParser()
+            stored.read(conf_path)
+            self.assertEqual(stored["oauth"]["access_token"], "newtoken")
+
+    def test_access_token(self):
+        r = mock.MagicMock()
+        r.refresh_access_information.return_value = {"access_token": "newtoken"}
+        conf = configparser.ConfigParser()
+        conf.read_string(test_base.test_config_auth)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            token = main.AccessToken(r, conf, os.path.join(temp_dir, "redditcurl"), time.time() + 60)
+            token.check()
+            r.refresh_access_information.assert_not_called()
+            # Once the token has expired, it is refreshed, and then not until the new one expires
+            token.expires = time.time()
+            token.check()
+            token.check()
+        r.refresh_access_information.assert_called_once_with("refreshtoken")
+        self.assertEqual(conf["oauth"]["access_token"], "newtoken")
+        self.assertGreater(token.expires, time.time() + main.ACCESS_TOKEN_LIFETIME - 60)
+
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.__main__.count_success")
+    @mock.patch("redditcurl.manager.download_submissions")
+    @mock.patch("redditcurl.manager.update_new")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    @mock.patch("redditcurl.websites.shared_config.PREFER_MP4", new=False)
     def test_main_subs_mp4(self, mocked_filehash, mocked_update, mocked_download,
                            mocked_count, mocked_parser, mocked_environ,
                            mocked_praw):
@@ -191,17 +391,17 @@ class TestMain(test_base.EnterTemp):
         main.__main__()
         mocked_reddit.set_access_credentials.assert_called_once_with(scope=main.OAUTH_SCOPES,
                                                                      access_token="accesstoken",
-                                                                     refresh_token="refreshtoken")
+                                                                     refresh_token="refreshtoken",
+                                                                     update_user=False)
         mocked_reddit.refresh_access_information.assert_called_once_with("refreshtoken")
         mocked_reddit.user.get_saved.assert_called_once_with(limit=None)
-        mocked_download.assert_called_once_with(test_base.test_submissions,
-                                                "sub", 5, True, False, ["testsubreddit", "test", "example"])
+        mocked_download.assert_called_once_with(test_base.test_saved,
+                                                "sub", 5, True, False, ["testsubreddit", "test", "example"],
+                                                pool=None, controller=None)
         # We can't really check the other args
-        mdownloaded, mremove, _ = mocked_count.call_args[0]
+        mdownloaded, mremove, _, _ = mocked_count.call_args[0]
         self.assertEqual((mdownloaded, mremove), (test_base.test_downloaded, False))
-        # Note that we don't check if redditcurl.websites.shared_config.FILENAME_HASH.PREFER_MP4 was set.
-        # TODO: It might be a good idea to refactor how configuration should be passed to the
-        # downloaders.
+        self.assertTrue(shared_config.PREFER_MP4)
 
     @mock.patch("praw.Reddit")
     @mock.patch("os.environ")
@@ -233,3 +433,212 @@ class TestMain(test_base.EnterTemp):
         mocked_download.assert_not_called()
         mocked_count.assert_not_called()
 
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.manager.download_jobs")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_retry_failed(self, mocked_filehash, mocked_download, mocked_parser, mocked_environ, mocked_praw):
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "processes": 1,
+                                                                       "silent": True,
+                                                                       "retry-failed": True}
+        mocked_environ.get.return_value = os.getcwd()
+        save_file = os.path.join("sub", ".downloaded.gz")
+        failed_file = manager.failed_jobs_file(save_file)
+        done = Job("done", test_links["direct"], "sub", "done")
+        failed = Job("failed", test_links["gfycat"], "sub", "failed")
+        manager.record_failed_jobs([Result(done, False, "DownloadError"), Result(failed, False, "DownloadError")],
+                                   failed_file)
+        mocked_download.return_value = {"done": Result(done, True),
+                                        "failed": Result(failed, False, "DownloadTimeout")}
+        main.__main__()
+        # Reddit isn't contacted, only the failed jobs are downloaded again
+        mocked_praw.assert_not_called()
+        self.assertEqual(set(mocked_download.call_args[0][0]), {done, failed})
+        self.assertEqual(manager.read_history(save_file), {test_links["direct"]})
+        self.assertEqual(manager.read_failed_jobs(failed_file), {"failed": Result(failed, False, "DownloadTimeout")})
+
+    @mock.patch("os.environ")
+    def test_main_catalog(self, mocked_environ):
+        mocked_environ.get.return_value = os.getcwd()
+        save_file = os.path.join("sub", ".downloaded.gz")
+        saved = test_base.create_saved(test_links["direct"], "Penguin", "pics", "penguin")
+        job = Job("penguin", test_links["direct"], "sub", "Penguin")
+        main.record_catalog(save_file, [Result(job, True, None, ((os.path.join("sub", "Penguin.jpeg"), 10, "aaaa"),))],
+                            [saved])
+        with mock.patch("sys.argv", ["redditcurl", "catalog", "-d", "sub", "query", "--subreddit", "Pics"]), \
+                mock.patch("sys.stdout", new=io.StringIO()) as output:
+            main.__main__()
+        header, row = output.getvalue().splitlines()
+        self.assertEqual(row.split("\t")[:4], ["Penguin.jpeg", "10", "aaaa", test_links["direct"]])
+
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.manager.download_jobs")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_scan(self, mocked_filehash, mocked_download, mocked_parser, mocked_environ, mocked_praw):
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "processes": 1,
+                                                                       "silent": True,
+                                                                       "scan": True,
+                                                                       "retry-failed": True}
+        mocked_environ.get.return_value = os.getcwd()
+        save_file = os.path.join("sub", ".downloaded.gz")
+        damaged = Job("damaged", test_links["direct"], "sub", "damaged")
+        whole = Job("whole", test_links["gfycat"], "sub", "whole")
+        image = b"\xff\xd8\xff\xe0" + b"x" * 100 + b"\xff\xd9"
+        for name in ("damaged.jpg", "whole.jpg"):
+            with open(os.path.join("sub", name), "wb") as file:
+                file.write(image[:-20] if name == "damaged.jpg" else image)
+        manager.update_new([damaged.url, whole.url], save_file)
+        manager.record_files([Result(damaged, True, None, ((os.path.join("sub", "damaged.jpg"), len(image), ""),)),
+                              Result(whole, True, None, ((os.path.join("sub", "whole.jpg"), len(image), ""),))],
+                             manager.files_file(save_file))
+        mocked_download.return_value = {"damaged": Result(damaged, True)}
+        main.__main__()
+        # Only the damaged file is removed and downloaded again
+        mocked_praw.assert_not_called()
+        self.assertEqual(mocked_download.call_args[0][0], [damaged])
+        self.assertFalse(os.path.exists(os.path.join("sub", "damaged.jpg")))
+        self.assertTrue(os.path.exists(os.path.join("sub", "whole.jpg")))
+        self.assertEqual(manager.read_history(save_file), {damaged.url, whole.url})
+
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.manager.download_jobs")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_migrate_scan(self, mocked_filehash, mocked_download, mocked_parser, mocked_environ, mocked_praw):
+        mocked_environ.get.return_value = os.getcwd()
+        save_file = os.path.join("sub", ".downloaded.gz")
+        whole = Job("whole", test_links["gfycat"], "sub", "whole")
+        image = b"\xff\xd8\xff\xe0" + b"x" * 100 + b"\xff\xd9"
+        with open(os.path.join("sub", "whole.jpg"), "wb") as file:
+            file.write(image)
+        manager.update_new([whole.url], save_file)
+        results = [Result(whole, True, None, ((os.path.join("sub", "whole.jpg"), len(image), ""),))]
+        manager.record_files(results, manager.files_file(save_file))
+        main.record_catalog(save_file, results)
+        for option in ("migrate-layout", "scan"):
+            mocked_parser.return_value.parse_args.return_value = argparse.Namespace(**{"savedir": "sub",
+                                                                                       "processes": 1,
+                                                                                       "silent": True,
+                                                                                       "layout": "hashed",
+                                                                                       option: True})
+            main.__main__()
+        # The moved file is found where it was moved to, and isn't downloaded again
+        moved = layout.locate("sub", "whole.jpg", "hashed")
+        self.assertTrue(os.path.isfile(moved))
+        self.assertEqual(list(manager.read_files(manager.files_file(save_file))), [moved])
+        entries = catalog.Catalog(catalog.catalog_file(save_file))
+        self.assertEqual([entry.path for entry in entries.query()], [os.path.relpath(moved, "sub")])
+        entries.close()
+        mocked_download.assert_not_called()
+        self.assertEqual(manager.read_history(save_file), {whole.url})
+
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.manager.download_jobs")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_export_from_jobs(self, mocked_filehash, mocked_download, mocked_parser, mocked_environ,
+                                   mocked_praw):
+        mocked_environ.get.return_value = os.getcwd()
+        with open("redditcurl", "w") as conf_file:
+            conf_file.write(test_base.test_config_auth)
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "silent": True,
+                                                                       "export-jobs": "jobs.jsonl"}
+        mocked_praw.return_value.user.get_saved.return_value = test_base.test_submissions
+        main.__main__()
+        mocked_download.assert_not_called()
+        # Download the second of two shards on a machine without Reddit access
+        mocked_praw.reset_mock()
+        mocked_parser.return_value.parse_args.return_value = argparse.Namespace(**{"savedir": "other",
+                                                                                   "processes": 1,
+                                                                                   "silent": True,
+                                                                                   "from-jobs": "jobs.jsonl",
+                                                                                   "shard": "2/2"})
+        mocked_download.side_effect = lambda queue, folders, processes, controller: {
+            job.id: Result(job, True) for job in queue}
+        main.__main__()
+        mocked_praw.assert_not_called()
+        queue, folders, processes = mocked_download.call_args[0]
+        self.assertEqual(sorted(job.url for job in queue),
+                         sorted(url for url in test_links.values() if manager.shard_of(url, 2) == 1))
+        self.assertEqual(folders, {"other" + os.sep})
+        self.assertEqual(manager.read_history(os.path.join("other", ".downloaded.gz")),
+                         {job.url for job in queue})
+
+    @mock.patch("time.sleep")
+    @mock.patch("redditcurl.manager.create_pool")
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.__main__.count_success")
+    @mock.patch("redditcurl.manager.download_submissions")
+    @mock.patch("redditcurl.manager.update_new")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_watch(self, mocked_filehash, mocked_update, mocked_download,
+                        mocked_count, mocked_parser, mocked_environ,
+                        mocked_praw, mocked_pool, mocked_sleep):
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "processes": 5,
+                                                                       "silent": True,
+                                                                       "watch": 60}
+        mocked_reddit = mocked_praw.return_value
+        mocked_environ.get.return_value = os.getcwd()
+        with open("redditcurl", "w") as conf_file:
+            conf_file.write(test_base.test_config_auth)
+        new_submission = test_base.create_submission("http://example.com/new.jpg", "new", "testsubreddit", "new")
+        # The second poll sees a new submission on top of the ones from the first poll
+        mocked_reddit.user.get_saved.side_effect = [iter(test_base.test_submissions),
+                                                    iter([new_submission] + test_base.test_submissions)]
+        mocked_download.return_value = test_base.test_downloaded
+        mocked_count.return_value = (0, 0, [])
+        mocked_sleep.side_effect = [None, KeyboardInterrupt]
+        main.__main__()
+        mocked_pool.assert_called_once_with(5)
+        self.assertEqual(mocked_download.call_count, 2)
+        self.assertEqual(mocked_download.call_args_list[0][0][0], test_base.test_saved)
+        # Only the new submission at the head of the listing should be downloaded on the second poll
+        self.assertEqual(mocked_download.call_args_list[1][0][0], list(manager.slim([new_submission])))
+        for call in mocked_download.call_args_list:
+            self.assertEqual(call[1], {"pool": mocked_pool.return_value, "controller": None})
+        mocked_pool.return_value.close.assert_called_once_with()
+
+    @mock.patch("time.sleep")
+    @mock.patch("redditcurl.manager.create_pool")
+    @mock.patch("praw.Reddit")
+    @mock.patch("os.environ")
+    @mock.patch("redditcurl.__main__.setup_parser")
+    @mock.patch("redditcurl.__main__.count_success")
+    @mock.patch("redditcurl.manager.download_submissions")
+    @mock.patch("redditcurl.manager.update_new")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH")
+    def test_main_watch_error(self, mocked_filehash, mocked_update, mocked_download,
+                              mocked_count, mocked_parser, mocked_environ,
+                              mocked_praw, mocked_pool, mocked_sleep):
+        import requests
+        mocked_parser.return_value.parse_args.return_value.__dict__ = {"savedir": "sub",
+                                                                       "processes": 5,
+                                                                       "silent": True,
+                                                                       "watch": 60}
+        mocked_environ.get.return_value = os.getcwd()
+        with open("redditcurl", "w") as conf_file:
+            conf_file.write(test_base.test_config_auth)
+
+        def broken_listing():
+            yield from test_base.test_submissions[:2]
+            raise requests.exceptions.ConnectionError("Connection reset.")
+        # The first poll fails partway through the listing, the second one reads all of it
+        mocked_praw.return_value.user.get_saved.side_effect = [broken_listing(), iter(test_base.test_submissions)]
+        mocked_download.return_value = test_base.test_downloaded
+        mocked_count.return_value = (0, 0, [])
+        mocked_sleep.side_effect = [None, KeyboardInterrupt]
+        main.__main__()
+        # The submissions listed before the error aren't skipped by the second poll
+        self.assertEqual(mocked_download.call_count, 1)
+        self.assertEqual(mocked_download.call_args[0][0], test_base.test_saved)
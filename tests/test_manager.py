@@ -1,18 +1,24 @@
 import os
 import gzip
 import json
+import tempfile
 import unittest
+import time
+import multiprocessing
 from unittest import mock
 from tests import test_base
 from redditcurl import manager
+from redditcurl import concurrency
+from redditcurl.websites import ratelimit, shared_config, storage
+from redditcurl.exceptions import DownloadError, DownloadTimeout, DeadLinkError
 
 
 test_links = test_base.test_links
 test_links_404 = test_base.test_links_404
-test_submissions = test_base.test_submissions
+test_submissions = test_base.test_saved
 original_urls = [submission.url for submission in test_submissions]
 original_titles = [submission.title for submission in test_submissions]
-original_subreddits = [submission.subreddit.display_name for submission in test_submissions]
+original_subreddits = [submission.subreddit for submission in test_submissions]
 
 
 class TestManageDownload(test_base.EnterTemp):
@@ -94,6 +100,36 @@ class TestUpdateNew(test_base.EnterTemp):
         manager.update_new(list(test_links.values())[3:], ".downloaded.gz")
         with gzip.open(".downloaded.gz", "rb") as file:
             self.assertEqual(list(test_links.values()), json.loads(file.read().decode("utf-8")))
+        # The file is replaced at once, and no temporary files are left behind
+        self.assertFalse(os.path.exists(".downloaded.gz.tmp"))
+
+    @mock.patch("redditcurl.websites.storage.fsync")
+    def test_write_synced(self, mocked):
+        manager.update_new(list(test_links.values())[:3], ".downloaded.gz")
+        manager.forget_history(list(test_links.values())[:1], ".downloaded.gz")
+        manager.merge_history(".downloaded.gz", [".downloaded.gz"])
+        # The folder is synced after every rename, so the new history isn't lost in a crash
+        if os.name == "posix":
+            self.assertEqual(mocked.call_args_list, [mock.call(".")] * 3)
+        self.assertEqual(manager.read_history(".downloaded.gz"), set(list(test_links.values())[1:3]))
+
+    @mock.patch("redditcurl.websites.storage.sync")
+    def test_sync_files(self, mocked):
+        job = manager.Job("album", test_links["imgur_album"], "sub", "album")
+        written = ((os.path.join("sub", "album", "1.jpg"), 10, "md5"),
+                   (os.path.join("sub", "album", "2.jpg"), 20, "md5"))
+        results = [manager.Result(job, True, None, written),
+                   manager.Result(job._replace(id="failed"), False, "DownloadError", (("failed.jpg", 5, "md5"),))]
+        manager.sync_files(results)
+        # Only the files of the successful downloads are synced, all at once
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(list(mocked.call_args[0][0]), [path for path, _, _ in written])
+        shared_config.SYNC = False
+        try:
+            manager.sync_files(results)
+        finally:
+            shared_config.SYNC = True
+        self.assertEqual(mocked.call_count, 1)
 
 
 class TestFilterNew(test_base.EnterTemp):
@@ -106,7 +142,18 @@ class TestFilterNew(test_base.EnterTemp):
         for filtered in filtered_items:
             self.assertTrue(filtered.url in original_urls)
             self.assertTrue(filtered.title in original_titles)
-            self.assertTrue(filtered.subreddit.display_name in original_subreddits)
+            self.assertTrue(filtered.subreddit in original_subreddits)
+
+    def test_filter_new_history(self):
+        # A given history is used instead of reading the file
+        filtered_items = manager.filter_new(test_submissions, "doesnt-exist.gz", {test_links["direct"]})
+        self.assertEqual(len(filtered_items), len(test_links) - 1)
+        self.assertNotIn(test_links["direct"], [filtered.url for filtered in filtered_items])
+
+    def test_read_history(self):
+        self.assertEqual(manager.read_history(".downloaded.gz"), set())
+        manager.update_new(list(test_links.values()), ".downloaded.gz")
+        self.assertEqual(manager.read_history(".downloaded.gz"), set(test_links.values()))
 
     def test_filter_new_empty(self):
         # Test filter new without a downloaded file
@@ -115,25 +162,180 @@ class TestFilterNew(test_base.EnterTemp):
         for filtered in filtered_items:
             self.assertTrue(filtered.url in original_urls)
             self.assertTrue(filtered.title in original_titles)
-            self.assertTrue(filtered.subreddit.display_name in original_subreddits)
+            self.assertTrue(filtered.subreddit in original_subreddits)
+
+
+class TestDeadLinks(test_base.EnterTemp):
+    def test_dead_links_file(self):
+        self.assertEqual(manager.dead_links_file("dir/.downloaded.gz"), "dir/.downloaded.dead.gz")
+
+    def test_read_write(self):
+        self.assertEqual(manager.read_dead_links(".downloaded.dead.gz"), {})
+        dead_links = {test_links["direct"]: [1, 1000.0]}
+        manager.write_dead_links(dead_links, ".downloaded.dead.gz")
+        self.assertEqual(manager.read_dead_links(".downloaded.dead.gz"), dead_links)
+
+    def test_backoff(self):
+        job = manager.Job("id", test_links["direct"], "", "")
+        dead_links = {}
+        self.assertTrue(manager.update_dead_links(dead_links, [manager.Result(job, False, "DeadLinkError")], 0))
+        self.assertEqual(dead_links[job.url], [1, manager.DEAD_RECHECK_BASE])
+        manager.update_dead_links(dead_links, [manager.Result(job, False, "DeadLinkError")], 100)
+        self.assertEqual(dead_links[job.url], [2, 100 + 2 * manager.DEAD_RECHECK_BASE])
+        dead_links[job.url][0] = 30
+        manager.update_dead_links(dead_links, [manager.Result(job, False, "DeadLinkError")], 0)
+        self.assertEqual(dead_links[job.url], [31, manager.DEAD_RECHECK_MAX])
+        # Other failures may be temporary, and don't change anything
+        self.assertFalse(manager.update_dead_links(dead_links, [manager.Result(job, False, "DownloadError")], 0))
+        self.assertEqual(dead_links[job.url][0], 31)
+        # Links that come back are forgotten
+        self.assertTrue(manager.update_dead_links(dead_links, [manager.Result(job, True)], 0))
+        self.assertEqual(dead_links, {})
+
+    def test_filter_dead(self):
+        now = time.time()
+        dead_links = {test_links["direct"]: [1, now + 1000], test_links["gfycat"]: [1, now - 1]}
+        filtered_urls = [sub.url for sub in manager.filter_new(test_submissions, "doesnt-exist.gz", set(), dead_links)]
+        # Dead links are skipped until it is time to check them again
+        self.assertNotIn(test_links["direct"], filtered_urls)
+        self.assertIn(test_links["gfycat"], filtered_urls)
+
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_classify(self, mocked):
+        mocked.side_effect = DeadLinkError("gone")
+        self.assertEqual(manager.attempt_download(test_links["direct"], "path", "file"), "DeadLinkError")
+        mocked.side_effect = DownloadError("failed")
+        self.assertEqual(manager.attempt_download(test_links["direct"], "path", "file"), "DownloadError")
+        self.assertEqual(manager.attempt_download("http://example.com/page.html", "path", "file"), "Unsupported")
+
+
+class TestFailedJobs(test_base.EnterTemp):
+    def test_record(self):
+        first = manager.Job("first", test_links["direct"], "sub", "first")
+        second = manager.Job("second", test_links["gfycat"], "sub", "second")
+        self.assertEqual(manager.failed_jobs_file(".downloaded.gz"), ".downloaded.failed.gz")
+        self.assertEqual(manager.read_failed_jobs(".downloaded.failed.gz"), {})
+        manager.record_failed_jobs([manager.Result(first, False, "DownloadTimeout"), manager.Result(second, True)],
+                                   ".downloaded.failed.gz")
+        self.assertEqual(manager.read_failed_jobs(".downloaded.failed.gz"),
+                         {"first": manager.Result(first, False, "DownloadTimeout")})
+        # Failures are kept between runs, until the download succeeds
+        manager.record_failed_jobs([manager.Result(second, False, "DownloadError")], ".downloaded.failed.gz")
+        self.assertEqual(set(manager.read_failed_jobs(".downloaded.failed.gz")), {"first", "second"})
+        manager.record_failed_jobs([manager.Result(first, True)], ".downloaded.failed.gz")
+        self.assertEqual(manager.read_failed_jobs(".downloaded.failed.gz"),
+                         {"second": manager.Result(second, False, "DownloadError")})
+        # Downloads that can never succeed aren't kept
+        unsupported = manager.Job("third", "http://example.com/page.html", "sub", "third")
+        manager.record_failed_jobs([manager.Result(unsupported, False, "Unsupported"),
+                                    manager.Result(second, False, "Unsupported")], ".downloaded.failed.gz")
+        self.assertEqual(manager.read_failed_jobs(".downloaded.failed.gz"), {})
+
+
+class TestFilesList(test_base.EnterTemp):
+    def test_record(self):
+        job = manager.Job("album", test_links["imgur_album"], "sub", "album")
+        files_file = manager.files_file(os.path.join("sub", ".downloaded.gz"))
+        self.assertEqual(files_file, os.path.join("sub", ".downloaded.files.gz"))
+        self.assertEqual(manager.read_files(files_file), {})
+        written = ((os.path.join("sub", "album", "1.jpg"), 10, "md5"),
+                   (os.path.join("sub", "album", "2.jpg"), 20, "md5"))
+        manager.record_files([manager.Result(job, True, None, written),
+                              manager.Result(job._replace(id="failed"), False, "DownloadError", written[:1])],
+                             files_file)
+        self.assertEqual(manager.read_files(files_file), {os.path.join("sub", "album", "1.jpg"): (10, job),
+                                                          os.path.join("sub", "album", "2.jpg"): (20, job)})
+        # Files that are downloaded again replace the earlier entries
+        manager.record_files([manager.Result(job, True, None, ((os.path.join("sub", "album", "1.jpg"), 15, "md5"),))],
+                             files_file)
+        self.assertEqual(manager.read_files(files_file)[os.path.join("sub", "album", "1.jpg")], (15, job))
+
+    def test_move_files(self):
+        job = manager.Job("album", test_links["imgur_album"], "sub", "album")
+        files_file = manager.files_file(os.path.join("sub", ".downloaded.gz"))
+        written = ((os.path.join("sub", "album.1.jpg"), 10, "md5"), (os.path.join("sub", "album.2.jpg"), 20, "md5"))
+        manager.record_files([manager.Result(job, True, None, written)], files_file)
+        moved = os.path.join("sub", "ab", "cd", "album.1.jpg")
+        manager.move_files({os.path.join("sub", "album.1.jpg"): moved}, files_file)
+        self.assertEqual(manager.read_files(files_file), {moved: (10, job),
+                                                          os.path.join("sub", "album.2.jpg"): (20, job)})
+
+    def test_forget_history(self):
+        manager.update_new([test_links["direct"], test_links["gfycat"]], ".downloaded.gz")
+        self.assertEqual(manager.forget_history([test_links["gfycat"], test_links["twitter"]], ".downloaded.gz"), 1)
+        self.assertEqual(manager.read_history(".downloaded.gz"), {test_links["direct"]})
+
+
+class TestJobsFile(test_base.EnterTemp):
+    def test_write_read(self):
+        download_queue, _ = manager.process_submissions(test_submissions, "", True, True, [])
+        manager.write_jobs(download_queue, "jobs.jsonl")
+        read_queue, used_folders = manager.read_jobs("jobs.jsonl", "saves")
+        # The folders are moved into the save directory of the machine reading the jobs
+        self.assertEqual(read_queue, [job._replace(folder=os.path.join("saves", job.folder))
+                                      for job in download_queue])
+        self.assertEqual(used_folders, {os.path.join("saves", "testsubreddit")})
+
+    def test_shards(self):
+        download_queue, _ = manager.process_submissions(test_submissions, "", True, False, [])
+        manager.write_jobs(download_queue, "jobs.jsonl")
+        shards = [manager.read_jobs("jobs.jsonl", "", shard, 3)[0] for shard in range(3)]
+        # Every job is in exactly one shard
+        self.assertEqual(sorted(job for shard in shards for job in shard), sorted(download_queue))
+        self.assertEqual(manager.shard_of(test_links["direct"], 3), manager.shard_of(test_links["direct"], 3))
+
+    def test_merge_history(self):
+        links = list(test_links.values())
+        manager.update_new(links[:3], "first.gz")
+        manager.update_new(links[2:5], "second.gz")
+        manager.update_new(links[5:], "third.gz")
+        self.assertEqual(manager.merge_history("first.gz", ["second.gz", "third.gz"]), len(links) - 3)
+        self.assertEqual(manager.read_history("first.gz"), set(links))
+
+
+class TestTakeNew(unittest.TestCase):
+    def test_take_all(self):
+        seen = set()
+        self.assertEqual(list(manager.take_new(test_submissions, seen)), test_submissions)
+        # The ids are only added once the submissions are recorded
+        self.assertEqual(seen, set())
+
+    def test_take_head(self):
+        seen = {test_submissions[2].id}
+        self.assertEqual(list(manager.take_new(test_submissions, seen)), test_submissions[:2])
+
+    def test_stops_reading(self):
+        # The listing shouldn't be read past the first seen submission
+        listing = mock.MagicMock()
+        listing.__iter__.return_value = iter(test_submissions)
+        seen = {test_submissions[0].id}
+        self.assertEqual(list(manager.take_new(listing, seen)), [])
+        self.assertEqual(len(list(listing.__iter__.return_value)), len(test_submissions) - 1)
 
 
 class TestDownloadInfo(unittest.TestCase):
     def test_title_folder(self):
         # Any submission will do, no logic tied to submission itself here
-        submission = test_base.create_submission(title="test title", subreddit="testsubreddit")
+        submission = test_base.create_saved(title="test title", subreddit="testsubreddit")
         folder, title = manager.download_info(submission, "testfolder", True, True)
         self.assertEqual(folder, os.path.join("testfolder", "testsubreddit"))
         self.assertEqual(title, "test title")
 
     def test_notitle_nofolder(self):
-        submission = test_base.create_submission(title="test title", subreddit="testsubreddit")
+        submission = test_base.create_saved(title="test title", subreddit="testsubreddit")
         folder, title = manager.download_info(submission, "testfolder", False, False)
         self.assertEqual(folder, "testfolder")
         self.assertEqual(title, "")
 
+    def test_interned_folder(self):
+        first = test_base.create_saved(title="first", subreddit="testsubreddit")
+        second = test_base.create_saved(title="second", subreddit="testsubreddit")
+        first_folder, _ = manager.download_info(first, "testfolder", True, True)
+        second_folder, _ = manager.download_info(second, "testfolder", True, True)
+        self.assertIs(first_folder, second_folder)
+
     def test_special_title(self):
-        submission = test_base.create_submission(title=".title w/ special characters", subreddit="testsubreddit")
+        submission = test_base.create_saved(title=".title w/ special characters", subreddit="testsubreddit")
         folder, title = manager.download_info(submission, "testfolder", True, True)
         self.assertEqual(title, "title w  special characters")
 
@@ -173,15 +375,19 @@ class TestProcessSubmission(unittest.TestCase):
     def test_process_all(self):
         download_queue, used_folders = manager.process_submissions(test_submissions, ".", True, True, [])
         # Checking for only_from, ensure that none got filtered
-        for url, folder, title in download_queue:
-            self.assertTrue(url in original_urls)
+        for job in download_queue:
+            self.assertTrue(job.url in original_urls)
         self.assertEqual(len(download_queue), len(test_submissions))
 
+    def test_process_ids(self):
+        download_queue, used_folders = manager.process_submissions(test_submissions, ".", True, True, [])
+        self.assertEqual([job.id for job in download_queue], [sub.id for sub in test_submissions])
+
     def test_process_only_from(self):
         download_queue, used_folders = manager.process_submissions(test_submissions, ".", True, True, ["testsubreddit"])
         # All must have passed again, all submissions are from correct subreddit
-        for url, folder, title in download_queue:
-            self.assertTrue(url in original_urls)
+        for job in download_queue:
+            self.assertTrue(job.url in original_urls)
         self.assertEqual(len(download_queue), len(test_submissions))
 
     def test_process_nowhere(self):
@@ -190,24 +396,311 @@ class TestProcessSubmission(unittest.TestCase):
         self.assertEqual(len(download_queue), 0)
 
 
+class TestDownloadJob(unittest.TestCase):
+    @mock.patch("redditcurl.manager.attempt_download")
+    def test_download_job(self, mocked_download):
+        mocked_download.return_value = None
+        job = manager.Job("id", test_links["direct"], "path", "file")
+        result = manager.download_job(job)
+        mocked_download.assert_called_once_with(test_links["direct"], "path", "file")
+        self.assertEqual(result, manager.Result(job, True))
+
+    @mock.patch("redditcurl.manager.attempt_download")
+    def test_download_job_error(self, mocked_download):
+        mocked_download.return_value = "DeadLinkError"
+        job = manager.Job("id", test_links["direct"], "path", "file")
+        self.assertEqual(manager.download_job(job), manager.Result(job, False, "DeadLinkError"))
+
+
+def store_in_worker(name):
+    """Store a file called name with the storage of the worker process it runs in."""
+    from redditcurl.websites import storage
+    storage.storage().write(os.path.join("sub", name), name.encode("utf-8"))
+
+
+class TestWorkerPool(test_base.EnterTemp):
+    @mock.patch("redditcurl.websites.shared_config.PREFER_MP4", new=False)
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=False)
+    @mock.patch("redditcurl.websites.ratelimit._bucket", new=None)
+    def test_init_worker(self):
+        bucket = multiprocessing.Array("d", [0.0, 0.0])
+        manager.init_worker({"PREFER_MP4": True, "FILENAME_HASH": True}, bucket)
+        self.assertTrue(shared_config.PREFER_MP4)
+        self.assertTrue(shared_config.FILENAME_HASH)
+        self.assertIs(ratelimit.bucket(), bucket)
+
+    @mock.patch("redditcurl.websites.shared_config.PREFER_MP4", new=True)
+    def test_spawned_worker_config(self):
+        # Spawned workers don't inherit the globals of the parent, the initializer must set them
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=1, initializer=manager.init_worker,
+                          initargs=(shared_config.snapshot(), context.Array("d", [0.0, 0.0]))) as pool:
+            self.assertTrue(pool.apply(shared_config.snapshot)["PREFER_MP4"])
+
+    def test_no_pool(self):
+        self.assertIsNone(manager.create_pool(1))
+
+    @mock.patch("redditcurl.websites.shared_config.STORAGE", new="tar")
+    @mock.patch("redditcurl.websites.shared_config.ARCHIVE_DIR", new="sub")
+    def test_close_pool(self):
+        import tarfile
+        pool = manager.create_pool(2)
+        pool.map(store_in_worker, ["first.jpg", "second.jpg"], chunksize=1)
+        manager.close_pool(pool)
+        volumes = [os.path.join("sub", name) for name in os.listdir("sub") if name.endswith(".tar")]
+        names = []
+        for volume in volumes:
+            # The volumes are finished, which pads them to whole records
+            self.assertEqual(os.path.getsize(volume) % tarfile.RECORDSIZE, 0)
+            with tarfile.open(volume) as tar:
+                names += tar.getnames()
+        self.assertEqual(sorted(names), ["first.jpg", "second.jpg"])
+
+
 class TestDownloadSubmission(test_base.EnterTemp):
-    @mock.patch("redditcurl.manager.manage_download")
+    @mock.patch("redditcurl.manager.attempt_download")
     @mock.patch("redditcurl.manager.make_folders")
     @mock.patch("redditcurl.manager.cleanup_folders")
     def test_single_thread(self, mocked_cleanup, mocked_make, mocked_download):
-        mocked_download.return_value = ("", True)
+        mocked_download.return_value = None
         results = manager.download_submissions(test_submissions, ".", 1, use_titles=True, use_folders=False)
         self.assertTrue(len(results) == len(test_submissions))
         expected_download_calls = [mock.call(sub.url, ".", sub.title) for sub in test_submissions]
         mocked_download.assert_has_calls(expected_download_calls, any_order=True)
+        for sub in test_submissions:
+            self.assertEqual(results[sub.id].job.url, sub.url)
 
-    @mock.patch("multiprocessing.pool.Pool.starmap")
+    @mock.patch("redditcurl.manager.attempt_download")
     @mock.patch("redditcurl.manager.make_folders")
     @mock.patch("redditcurl.manager.cleanup_folders")
-    def test_multi_thread(self, mocked_cleanup, mocked_make, mocked_starmap):
+    def test_only_from_keys(self, mocked_cleanup, mocked_make, mocked_download):
+        mocked_download.return_value = None
+        submissions = [test_base.create_saved("http://example.com/a.jpg", "a", "other", "a")] + test_submissions
+        results = manager.download_submissions(submissions, ".", 1, only_from=["testsubreddit"])
+        self.assertNotIn("a", results)
+        for sub in test_submissions:
+            self.assertEqual(results[sub.id].job.url, sub.url)
+
+    @mock.patch("multiprocessing.pool.Pool.imap_unordered")
+    @mock.patch("redditcurl.manager.make_folders")
+    @mock.patch("redditcurl.manager.cleanup_folders")
+    def test_multi_thread(self, mocked_cleanup, mocked_make, mocked_imap):
+        mocked_imap.return_value = FakeResults([[(sub.id, None, 0, 0, False, ())] for sub in test_submissions])
         manager.download_submissions(test_submissions, ".", 2, use_titles=True, use_folders=False)
         expected_queue, expected_folders = manager.process_submissions(test_submissions, ".",
                                                                        use_titles=True,
                                                                        use_folders=False,
                                                                        only_from=[])
-        mocked_starmap.assert_called_once_with(manager.manage_download, expected_queue)
+        mocked_imap.assert_called_once_with(manager.download_chunk,
+                                            [[job] for job in manager.schedule(expected_queue, 1)])
+
+    @mock.patch("redditcurl.manager.attempt_download")
+    @mock.patch("redditcurl.manager.make_folders")
+    @mock.patch("redditcurl.manager.cleanup_folders")
+    def test_dispatch(self, mocked_cleanup, mocked_make, mocked_download):
+        # Compact results from the workers are matched back to their jobs
+        pool = mock.MagicMock()
+        pool.imap_unordered.side_effect = lambda func, chunks: FakeResults([func(chunk) for chunk in reversed(chunks)])
+        mocked_download.side_effect = lambda url, path, file_name: "DownloadError" if url == test_links["fail"] else None
+        results = manager.download_submissions(test_submissions, ".", 2, pool=pool, chunksize=3)
+        pool.imap_unordered.assert_called_once_with(manager.download_chunk, mock.ANY)
+        self.assertTrue(all(len(chunk) <= 3 for chunk in pool.imap_unordered.call_args[0][1]))
+        for sub in test_submissions:
+            self.assertEqual(results[sub.id].job.url, sub.url)
+            self.assertEqual(results[sub.id].successful, sub.id != "fail")
+        self.assertEqual(results["fail"].error, "DownloadError")
+
+    @mock.patch("redditcurl.manager.make_folders")
+    @mock.patch("redditcurl.manager.cleanup_folders")
+    def test_watchdog(self, mocked_cleanup, mocked_make):
+        # The first download finishes, then the workers get stuck
+        pool = mock.MagicMock()
+        first = test_submissions[0]
+        pool.imap_unordered.return_value = FakeResults([[(first.id, None, 0, 0, False, ())]])
+        results = manager.download_submissions(test_submissions, ".", 2, pool=pool, chunksize=1)
+        self.assertEqual(len(results), len(test_submissions))
+        self.assertTrue(results[first.id].successful)
+        for sub in test_submissions[1:]:
+            self.assertFalse(results[sub.id].successful)
+            self.assertEqual(results[sub.id].error, "DownloadTimeout")
+        self.assertEqual(pool.imap_unordered.return_value.timeouts[-1],
+                         shared_config.DOWNLOAD_DEADLINE + manager.WATCHDOG_GRACE)
+
+
+@unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "The workers need to be forked")
+class TestDispatchPool(test_base.EnterTemp):
+    @mock.patch("redditcurl.manager.attempt_download", return_value=None)
+    def test_chunks(self, mocked_download):
+        # A real pool, whose workers inherit the replaced attempt_download
+        queue = [manager.Job(str(i), "https://i.imgur.com/{}.jpg".format(i), ".", "") for i in range(10)]
+        with multiprocessing.get_context("fork").Pool(2) as pool:
+            results = manager.dispatch(pool, queue, 3)
+        self.assertEqual(sorted(results), sorted(job.id for job in queue))
+        self.assertTrue(all(result.successful for result in results.values()))
+
+
+class FakePool:
+    """Stands in for a multiprocessing.Pool, running the jobs given to apply_async right away."""
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+
+    def apply_async(self, func, args, callback, error_callback):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        self.pending = getattr(self, "pending", []) + [(func, args, callback)]
+
+    def finish_one(self):
+        func, args, callback = self.pending.pop(0)
+        self.running -= 1
+        callback(func(*args))
+
+
+class TestDispatchAdaptive(test_base.EnterTemp):
+    def dispatch(self, pool, queue, controller):
+        finished = []
+
+        def get(timeout=None):
+            # Finish a running job whenever the manager waits for one
+            pool.finish_one()
+            return finished.pop(0)
+        with mock.patch("queue.Queue") as mocked_queue:
+            mocked_queue.return_value.put.side_effect = finished.append
+            mocked_queue.return_value.get.side_effect = get
+            return manager.dispatch_adaptive(pool, queue, controller)
+
+    @mock.patch("redditcurl.manager.attempt_download")
+    def test_dispatch_adaptive(self, mocked_download):
+        mocked_download.side_effect = lambda url, path, file_name: "DownloadError" if url == test_links["fail"] else None
+        pool = FakePool()
+        controller = concurrency.Controller(2, 4)
+        queue = [manager.Job(sub.id, sub.url, ".", sub.title) for sub in test_submissions]
+        results = self.dispatch(pool, queue, controller)
+        self.assertEqual(len(results), len(queue))
+        for job in queue:
+            self.assertEqual(results[job.id].job, job)
+            self.assertEqual(results[job.id].successful, job.id != "fail")
+        self.assertGreaterEqual(pool.most_running, controller.floor)
+        self.assertLessEqual(pool.most_running, controller.ceiling)
+        self.assertEqual(controller.running, 0)
+
+    @mock.patch("redditcurl.manager.attempt_download", return_value=None)
+    def test_single_host(self, mocked_download):
+        pool = FakePool()
+        controller = concurrency.Controller(8, 8)
+        queue = [manager.Job(str(i), "https://i.imgur.com/{}.jpg".format(i), ".", "") for i in range(40)]
+        results = self.dispatch(pool, queue, controller)
+        self.assertEqual(len(results), 40)
+        # Downloads from the same host run side by side, up to the limit
+        self.assertEqual(pool.most_running, 8)
+
+
+class FakeResults:
+    """Stands in for the iterator returned by Pool.imap_unordered.
+
+    Once the given results run out, it behaves like the workers are stuck.
+    """
+    def __init__(self, results):
+        self.results = list(results)
+        self.timeouts = []
+
+    def next(self, timeout=None):
+        self.timeouts.append(timeout)
+        if not self.results:
+            raise multiprocessing.TimeoutError
+        return self.results.pop(0)
+
+
+class TestDeadline(unittest.TestCase):
+    def test_expires(self):
+        with self.assertRaises(DownloadTimeout):
+            with manager.deadline(0.05):
+                time.sleep(1)
+
+    def test_finishes(self):
+        with manager.deadline(1):
+            pass
+        # The timer must be cleared after the block
+        time.sleep(1.1)
+
+    def test_disabled(self):
+        with manager.deadline(0):
+            time.sleep(0.05)
+
+    @mock.patch("redditcurl.websites.shared_config.MAX_RATE", new=1000)
+    @mock.patch("redditcurl.websites.ratelimit._bucket", new=None)
+    def test_throttled(self):
+        # Waiting for the bandwidth limit doesn't count towards the deadline
+        with manager.deadline(0.1):
+            ratelimit.consume(1300)
+        with self.assertRaises(DownloadTimeout):
+            with manager.deadline(0.1):
+                ratelimit.consume(1100)
+                time.sleep(1)
+
+    @mock.patch("redditcurl.websites.shared_config.DOWNLOAD_DEADLINE", new=0.05)
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_manage_download(self, mocked):
+        mocked.side_effect = lambda url, path, file_name: time.sleep(1)
+        self.assertEqual(manager.manage_download(test_links["direct"], "path", "file"),
+                         (test_links["direct"], False))
+
+    @mock.patch("redditcurl.websites.shared_config.DOWNLOAD_DEADLINE", new=0.05)
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_remove_partial(self, mocked):
+        def download(url, path, file_name):
+            with storage.temporary_file(path) as file:
+                file.write(b"partial")
+                time.sleep(1)
+        mocked.side_effect = download
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(manager.attempt_download(test_links["direct"], path, "file"), "DownloadTimeout")
+            self.assertEqual(os.listdir(path), [])
+
+
+class TestSchedule(unittest.TestCase):
+    def job(self, url):
+        return manager.Job(url, url, ".", "")
+
+    def test_host(self):
+        self.assertEqual(manager.host("https://i.imgur.com/AaLX1Wn.jpg"), "imgur.com")
+        self.assertEqual(manager.host("https://imgur.com/a/IEKXq"), "imgur.com")
+        self.assertEqual(manager.host("https://gfycat.com/QualifiedDefensiveAddax"), "gfycat.com")
+
+    def test_estimate_size(self):
+        self.assertGreater(manager.estimate_size(test_links["imgur_album"]), manager.estimate_size(test_links["direct"]))
+        self.assertEqual(manager.estimate_size(test_links["fail"]), 0)
+
+    def test_interleave_hosts(self):
+        queue = ([self.job("https://i.imgur.com/{}.jpg".format(i)) for i in range(4)] +
+                 [self.job("https://example.com/{}.jpg".format(i)) for i in range(2)])
+        scheduled = manager.schedule(queue)
+        self.assertEqual(sorted(scheduled), sorted(queue))
+        hosts = [manager.host(job.url) for job in scheduled]
+        self.assertEqual(hosts, ["imgur.com", "example.com", "imgur.com", "example.com", "imgur.com", "imgur.com"])
+
+    def test_large_first(self):
+        small = self.job("https://i.imgur.com/small.jpg")
+        large = self.job("https://imgur.com/a/album")
+        self.assertEqual(manager.schedule([small, large]), [large, small])
+
+    def test_chunks_mixed(self):
+        large = [self.job("https://imgur.com/a/{}".format(i)) for i in range(2)]
+        small = [self.job("https://i.imgur.com/{}.jpg".format(i)) for i in range(2)]
+        scheduled = manager.schedule(small + large, chunksize=2)
+        # Each chunk should get one large and one small job
+        self.assertEqual(set(scheduled[:2]) & set(large), {large[0]})
+        self.assertEqual(set(scheduled[2:]) & set(large), {large[1]})
+
+    def test_empty(self):
+        self.assertEqual(manager.schedule([], 4), [])
+
+
+class TestChunkSize(unittest.TestCase):
+    def test_short_queue(self):
+        self.assertEqual(manager.chunk_size(0, 20), 1)
+        self.assertEqual(manager.chunk_size(50, 20), 1)
+
+    def test_long_queue(self):
+        self.assertEqual(manager.chunk_size(800, 20), 10)
+        self.assertEqual(manager.chunk_size(100000, 20), manager.MAX_CHUNKSIZE)
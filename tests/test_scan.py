@@ -0,0 +1,67 @@
+import os
+import struct
+from tests import test_base
+from redditcurl import scan
+from redditcurl.manager import Job
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def ebml_element(element_id, payload):
+    return element_id + bytes([0x80 | len(payload)]) + payload
+
+
+test_files = {
+    "image.jpg": b"\xff\xd8\xff\xe0" + b"x" * 100 + b"\xff\xd9",
+    "image.png": b"\x89PNG\r\n\x1a\n" + b"x" * 100 + b"\x00\x00\x00\x00IEND\xaeB`\x82",
+    "image.gif": b"GIF89a" + b"x" * 100 + b";",
+    "video.mp4": box(b"ftyp", b"isom") + box(b"moov", b"x" * 20) + box(b"mdat", b"x" * 100),
+    "video.webm": ebml_element(b"\x1a\x45\xdf\xa3", b"x" * 10) + ebml_element(b"\x18\x53\x80\x67", b"x" * 100),
+}
+
+
+class TestCheckFile(test_base.EnterTemp):
+    def write(self, name, content):
+        with open(name, "wb") as file:
+            file.write(content)
+
+    def test_whole(self):
+        for name, content in test_files.items():
+            self.write(name, content)
+            self.assertIsNone(scan.check_file(name, len(content)), name)
+
+    def test_cut_short(self):
+        for name, content in test_files.items():
+            self.write(name, content[:-20])
+            self.assertIsNotNone(scan.check_file(name), name)
+
+    def test_no_moov(self):
+        self.write("video.mp4", box(b"ftyp", b"isom") + box(b"mdat", b"x" * 100))
+        self.assertEqual(scan.check_file("video.mp4"), "MP4 has no moov box")
+
+    def test_size(self):
+        self.write("image.jpg", test_files["image.jpg"])
+        self.assertEqual(scan.check_file("image.jpg", 1000), "size is 106 bytes instead of 1000")
+
+    def test_not_an_image(self):
+        self.write("image.jpg", b"<html>Not found</html>")
+        self.assertEqual(scan.check_file("image.jpg"), "not a JPEG file")
+        # Files of unknown types can't be checked
+        self.write("page.html", b"<html>Not found</html>")
+        self.assertIsNone(scan.check_file("page.html"))
+
+    def test_missing(self):
+        self.assertEqual(scan.check_file("image.jpg", 100), "file is missing")
+
+    def test_scan(self):
+        for name, content in test_files.items():
+            self.write(os.path.join("sub", name), content)
+        self.write(os.path.join("sub", "cut.jpg"), test_files["image.jpg"][:-20])
+        self.write(".downloaded.gz", b"")
+        recorded = {os.path.join("sub", "image.png"): (1000, Job("id", "url", "sub", "")),
+                    os.path.join("sub", "gone.jpg"): (100, Job("id", "url", "sub", ""))}
+        damaged = scan.scan(".", recorded, 2)
+        self.assertEqual(set(damaged), {os.path.join("sub", "cut.jpg"), os.path.join("sub", "image.png"),
+                                        os.path.join("sub", "gone.jpg")})
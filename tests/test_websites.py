@@ -1,8 +1,20 @@
+import io
 import os
+import sys
+import stat
+import json
+import tarfile
+import datetime
+import hashlib
+import threading
+import subprocess
 import unittest
+import zipfile
 from unittest import mock
 from tests import test_base
 from redditcurl import websites
+from redditcurl.websites import fetch, formats, layout, ratelimit, segmented, shared_config, storage
+from redditcurl.exceptions import DownloadError, DownloadTimeout, DeadLinkError
 
 
 test_links = test_base.test_links
@@ -38,6 +50,566 @@ class TestMatcher(unittest.TestCase):
             self.assertFalse(downloader.match(test_links["fail"]))
 
 
+class TestLazyDownloaders(unittest.TestCase):
+    def test_match_without_import(self):
+        # Routing a url must not import any of the downloader modules or their dependencies
+        code = ("import sys; from redditcurl import manager, websites; "
+                "[d.match('https://example.com/a.jpg') for d in websites.downloaders]; "
+                "print(any(m in sys.modules for m in ('requests', 'bs4', 'redditcurl.websites.direct')))")
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)))
+        self.assertEqual(output.strip(), b"False")
+
+    def test_cli_without_import(self):
+        # The command line, for --help in particular, starts without loading requests
+        code = "import sys; from redditcurl import __main__; print('requests' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)))
+        self.assertEqual(output.strip(), b"False")
+
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_download_imports(self, mocked):
+        downloader = websites.downloaders[0]
+        self.assertEqual(downloader.name, "direct")
+        downloader.download(test_links["direct"], "path", "file")
+        mocked.assert_called_once_with(test_links["direct"], "path", "file")
+
+    def test_module_attribute(self):
+        self.assertIs(websites.twitter, sys.modules["redditcurl.websites.twitter"])
+        with self.assertRaises(AttributeError):
+            websites.doesnt_exist
+
+
+class TestFetch(unittest.TestCase):
+    @mock.patch("redditcurl.websites.fetch.session")
+    def test_default_timeout(self, mocked):
+        mocked.return_value.get.return_value = test_base.FakeResponse()
+        fetch.get(test_links["direct"])
+        mocked.return_value.get.assert_called_once_with(
+            test_links["direct"],
+            timeout=(shared_config.CONNECT_TIMEOUT, shared_config.READ_TIMEOUT))
+
+    @mock.patch("redditcurl.websites.fetch.session")
+    def test_given_timeout(self, mocked):
+        mocked.return_value.get.return_value = test_base.FakeResponse()
+        fetch.get(test_links["direct"], timeout=1)
+        mocked.return_value.get.assert_called_once_with(test_links["direct"], timeout=1)
+
+    @mock.patch("redditcurl.websites.fetch.session")
+    def test_stats(self, mocked):
+        fetch.take_stats()
+        mocked.return_value.get.return_value = test_base.FakeResponse(200, {"Content-Length": "100"})
+        fetch.get(test_links["direct"])
+        fetch.get(test_links["direct"])
+        self.assertEqual(fetch.take_stats(), (200, False))
+        mocked.return_value.get.return_value = test_base.FakeResponse(429)
+        fetch.get(test_links["direct"])
+        self.assertEqual(fetch.take_stats(), (0, True))
+        self.assertEqual(fetch.take_stats(), (0, False))
+
+    def test_check(self):
+        fetch.check(test_base.FakeResponse(200), "ok")
+        for status in (404, 410):
+            with self.assertRaises(DeadLinkError):
+                fetch.check(test_base.FakeResponse(status), "gone")
+        with self.assertRaises(DownloadError) as context:
+            fetch.check(test_base.FakeResponse(503), "unavailable")
+        self.assertNotIsInstance(context.exception, DeadLinkError)
+
+    @mock.patch("redditcurl.websites.ratelimit.consume")
+    def test_iter_body(self, mocked):
+        response = test_base.FakeResponse(content=b"x" * (fetch.CHUNK_SIZE + 10))
+        self.assertEqual(fetch.read_body(response), response.content)
+        mocked.assert_has_calls([mock.call(fetch.CHUNK_SIZE), mock.call(10)])
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate("0"), 0)
+        self.assertEqual(ratelimit.parse_rate("1000"), 1000)
+        self.assertEqual(ratelimit.parse_rate("500K"), 500 * 1024)
+        self.assertEqual(ratelimit.parse_rate("1.5m"), 1536 * 1024)
+        with self.assertRaises(ValueError):
+            ratelimit.parse_rate("fast")
+
+    def test_parse_schedule(self):
+        self.assertEqual(ratelimit.parse_schedule(""), [])
+        self.assertEqual(ratelimit.parse_schedule("09:00-18:30=500K, 22:00-06:00=0"),
+                         [(540, 1110, 500 * 1024), (1320, 360, 0)])
+        with self.assertRaises(ValueError):
+            ratelimit.parse_schedule("9-18=500K")
+
+    @mock.patch("redditcurl.websites.shared_config.MAX_RATE", new=100)
+    @mock.patch("redditcurl.websites.shared_config.RATE_SCHEDULE", new=[(540, 1080, 10), (1320, 360, 0)])
+    def test_current_rate(self):
+        day = datetime.datetime(2020, 1, 1)
+        self.assertEqual(ratelimit.current_rate(day.replace(hour=12)), 10)
+        self.assertEqual(ratelimit.current_rate(day.replace(hour=18)), 100)
+        self.assertEqual(ratelimit.current_rate(day.replace(hour=23)), 0)
+        self.assertEqual(ratelimit.current_rate(day.replace(hour=3)), 0)
+
+    @mock.patch("redditcurl.websites.shared_config.MAX_RATE", new=0)
+    @mock.patch("redditcurl.websites.ratelimit.time")
+    def test_unlimited(self, mocked):
+        ratelimit.consume(10 ** 9)
+        mocked.sleep.assert_not_called()
+
+    @mock.patch("redditcurl.websites.shared_config.MAX_RATE", new=1000)
+    @mock.patch("redditcurl.websites.ratelimit._bucket", new=None)
+    @mock.patch("redditcurl.websites.ratelimit.time")
+    def test_consume(self, mocked):
+        mocked.monotonic.return_value = 1000.0
+        # The bucket starts full, allowing a burst
+        ratelimit.consume(1000)
+        mocked.sleep.assert_not_called()
+        # Then the bytes have to wait until the bucket refills
+        ratelimit.consume(500)
+        mocked.sleep.assert_called_once_with(0.5)
+        # Bytes reserved by others are waited for as well
+        mocked.sleep.reset_mock()
+        ratelimit.consume(500)
+        mocked.sleep.assert_called_once_with(1.0)
+        # Once time passes, the debt is paid off
+        mocked.sleep.reset_mock()
+        mocked.monotonic.return_value = 1003.0
+        ratelimit.consume(500)
+        mocked.sleep.assert_not_called()
+
+
+class TestLayout(test_base.EnterTemp):
+    def test_locate(self):
+        self.assertEqual(layout.locate("sub", "image.jpg", "flat"), os.path.join("sub", "image.jpg"))
+        hashed = layout.locate("sub", "image.jpg", "hashed")
+        name_hash = hashlib.md5(b"image.jpg").hexdigest()
+        self.assertEqual(hashed, os.path.join("sub", name_hash[:2], name_hash[2:4], "image.jpg"))
+
+    @mock.patch("redditcurl.websites.shared_config.LAYOUT", new="hashed")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=False)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_download_hashed(self, mocked):
+        mocked.side_effect = test_base.fake_server(b"image", "image/jpeg", accept_ranges=False)
+        websites.direct.download("https://example.com/image.jpg", "sub", "image")
+        with open(layout.locate("sub", "image.jpeg"), "rb") as file:
+            self.assertEqual(file.read(), b"image")
+
+    def test_migrate(self):
+        os.mkdir(os.path.join("sub", "subreddit"))
+        names = [os.path.join("sub", "first.jpg"), os.path.join("sub", "subreddit", "second.jpg")]
+        for name in names + [os.path.join("sub", ".downloaded.gz")]:
+            with open(name, "w") as file:
+                file.write(name)
+        self.assertEqual(len(layout.migrate("sub", "hashed")), 2)
+        for name in names:
+            folder, base_name = os.path.split(name)
+            self.assertTrue(os.path.isfile(layout.locate(folder, base_name, "hashed")))
+        # Hidden files, like the savefile, are left alone
+        self.assertTrue(os.path.isfile(os.path.join("sub", ".downloaded.gz")))
+        # Moving back to the flat layout removes the empty subfolders
+        self.assertEqual(len(layout.migrate("sub", "flat")), 2)
+        self.assertEqual(sorted(os.listdir("sub")), [".downloaded.gz", "first.jpg", "subreddit"])
+        self.assertEqual(os.listdir(os.path.join("sub", "subreddit")), ["second.jpg"])
+
+    def test_migrate_short_subreddit(self):
+        # r/de has a folder named like a hashed layout subfolder
+        os.mkdir(os.path.join("sub", "de"))
+        names = [os.path.join("sub", "first.jpg"), os.path.join("sub", "de", "second.jpg")]
+        for name in names:
+            with open(name, "w") as file:
+                file.write(name)
+        self.assertEqual(len(layout.migrate("sub", "hashed")), 2)
+        for name in names:
+            folder, base_name = os.path.split(name)
+            self.assertTrue(os.path.isfile(layout.locate(folder, base_name, "hashed")))
+        self.assertEqual(len(layout.migrate("sub", "flat")), 2)
+        self.assertEqual(sorted(os.listdir("sub")), ["de", "first.jpg"])
+        self.assertEqual(os.listdir(os.path.join("sub", "de")), ["second.jpg"])
+
+
+class TestStorage(test_base.EnterTemp):
+    def test_files(self):
+        storage.Files().write(os.path.join("sub", "new", "image.jpg"), b"image")
+        with open(os.path.join("sub", "new", "image.jpg"), "rb") as file:
+            self.assertEqual(file.read(), b"image")
+
+    def test_files_temporary_name(self):
+        storage.Files().write(os.path.join("sub", "image.jpg"), b"first")
+        storage.Files().write(os.path.join("sub", "image.jpg"), b"second")
+        # The file is replaced at once, and no temporary files are left behind
+        self.assertEqual(os.listdir("sub"), ["image.jpg"])
+        with open(os.path.join("sub", "image.jpg"), "rb") as file:
+            self.assertEqual(file.read(), b"second")
+
+    @unittest.skipUnless(os.name == "posix", "Windows doesn't have file permissions")
+    def test_file_mode(self):
+        umask = os.umask(0o027)
+        try:
+            with mock.patch("redditcurl.websites.storage._mode", new=None):
+                storage.Files().write(os.path.join("sub", "written.jpg"), b"image")
+                storage.Files().stream("sub", [b"image"], lambda content_hash: os.path.join("sub", "streamed.jpg"))
+        finally:
+            os.umask(umask)
+        # The files follow the umask, rather than keeping the permissions of the temporary files
+        for name in ("written.jpg", "streamed.jpg"):
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join("sub", name)).st_mode), 0o640)
+
+    def test_stream_preallocated(self):
+        # The size given may be wrong, like when the body is compressed
+        for size in (None, 4, 7, 1000):
+            storage.Files().stream("sub", [b"ima", b"ge"], lambda content_hash: os.path.join("sub", "image.jpg"), size)
+            self.assertEqual(os.listdir("sub"), ["image.jpg"])
+            with open(os.path.join("sub", "image.jpg"), "rb") as file:
+                self.assertEqual(file.read(), b"image")
+
+    def test_preallocate(self):
+        with open("image.jpg", "wb") as file:
+            storage.preallocate(file, 1000)
+        if hasattr(os, "posix_fallocate"):
+            self.assertEqual(os.path.getsize("image.jpg"), 1000)
+
+    @mock.patch("redditcurl.websites.storage.fsync", wraps=storage.fsync)
+    def test_sync(self, mocked):
+        storage.Files().write(os.path.join("sub", "first.jpg"), b"first")
+        storage.Files().write(os.path.join("sub", "album", "second.jpg"), b"second")
+        files = [os.path.join("sub", "first.jpg"), os.path.join("sub", "album", "second.jpg")]
+        # Files that were removed since they were written are skipped
+        storage.sync(files + [os.path.join("sub", "removed.jpg")])
+        synced = sorted(call[0][0] for call in mocked.call_args_list)
+        if os.name == "posix":
+            # The folders are synced too, so that the new names are kept
+            files += ["sub", os.path.join("sub", "album")]
+        self.assertEqual(synced, sorted(files + [os.path.join("sub", "removed.jpg")]))
+
+    def test_take_written(self):
+        storage.take_written()
+        storage.Files().write(os.path.join("sub", "first.jpg"), b"first")
+        with open("temp", "wb") as file:
+            file.write(b"second")
+        storage.Files().store(os.path.join("sub", "second.jpg"), "temp")
+        self.assertEqual(storage.take_written(),
+                         ((os.path.join("sub", "first.jpg"), 5, hashlib.md5(b"first").hexdigest()),
+                          (os.path.join("sub", "second.jpg"), 6, hashlib.md5(b"second").hexdigest())))
+        self.assertEqual(storage.take_written(), ())
+
+    def test_tar_volumes(self):
+        storage.take_written()
+        volumes = storage.TarVolumes("sub", 2048)
+        volumes.write(os.path.join("sub", "first.jpg"), b"first")
+        with open("temp", "wb") as file:
+            file.write(b"second" * 500)
+        volumes.store(os.path.join("sub", "subreddit", "second.jpg"), "temp")
+        self.assertFalse(os.path.exists("temp"))
+        # The first volume is full, the next file starts a new one
+        volumes.write(os.path.join("sub", "third.jpg"), b"third")
+        volumes.close()
+        names = sorted(name for name in os.listdir("sub") if name.endswith(".tar"))
+        self.assertEqual(len(names), 2)
+        first_volume, second_volume = (os.path.join("sub", name) for name in names)
+        with tarfile.open(first_volume) as tar:
+            self.assertEqual(tar.getnames(), ["first.jpg", "subreddit/second.jpg"])
+        # The files are recorded for the catalogue like with the other storages
+        self.assertEqual([(path, size) for path, size, _ in storage.take_written()],
+                         [(os.path.join("sub", "first.jpg"), 5), (os.path.join("sub", "subreddit", "second.jpg"), 3000),
+                          (os.path.join("sub", "third.jpg"), 5)])
+        # Single files can be read through the index
+        self.assertEqual(storage.read_entry(first_volume, "subreddit/second.jpg"), b"second" * 500)
+        self.assertEqual(storage.read_entry(second_volume, "third.jpg"), b"third")
+        with self.assertRaises(KeyError):
+            storage.read_entry(second_volume, "first.jpg")
+
+    def test_tar_interrupted(self):
+        def interrupted(source, destination, length=None, exception=OSError, bufsize=None):
+            destination.write(source.read(100))
+            raise DownloadTimeout("Stopped while copying.")
+        volumes = storage.TarVolumes("sub", 1024 * 1024)
+        volumes.write(os.path.join("sub", "first.jpg"), b"first")
+        with open("temp", "wb") as file:
+            file.write(b"second" * 500)
+        with mock.patch("tarfile.copyfileobj", side_effect=interrupted):
+            with self.assertRaises(DownloadTimeout):
+                volumes.store(os.path.join("sub", "second.jpg"), "temp")
+        volumes.write(os.path.join("sub", "third.jpg"), b"third")
+        volumes.close()
+        volume = [os.path.join("sub", name) for name in os.listdir("sub") if name.endswith(".tar")][0]
+        # The partly written entry is cut off
+        with tarfile.open(volume) as tar:
+            self.assertEqual(tar.getnames(), ["first.jpg", "third.jpg"])
+        self.assertEqual(storage.read_entry(volume, "third.jpg"), b"third")
+
+    @mock.patch("redditcurl.websites.shared_config.STORAGE", new="files")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=False)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_album(self, mocked):
+        album = io.BytesIO()
+        with zipfile.ZipFile(album, "w") as archive:
+            archive.writestr("first.jpg", b"first")
+            archive.writestr("second.jpg", b"second")
+        mocked.side_effect = test_base.fake_server(album.getvalue(), "application/zip", accept_ranges=False)
+        storage.reset()
+        websites.imgur_album.download("https://imgur.com/a/album", "sub", "album")
+        # The images are numbered in the order of the zip, and nothing else is left behind
+        self.assertEqual(sorted(os.listdir("sub")), ["album.1.jpg", "album.2.jpg"])
+        with open(os.path.join("sub", "album.2.jpg"), "rb") as file:
+            self.assertEqual(file.read(), b"second")
+
+    @mock.patch("redditcurl.websites.shared_config.STORAGE", new="tar")
+    @mock.patch("redditcurl.websites.shared_config.ARCHIVE_DIR", new="sub")
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=False)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_download_tar(self, mocked):
+        mocked.side_effect = test_base.fake_server(b"image", "image/jpeg", accept_ranges=False)
+        storage.reset()
+        websites.direct.download("https://example.com/image.jpg", "sub", "image")
+        storage.close()
+        volume = [name for name in os.listdir("sub") if name.endswith(".tar")][0]
+        self.assertEqual(storage.read_entry(os.path.join("sub", volume), "image.jpeg"), b"image")
+
+
+class FakeS3Error(Exception):
+    """Stands in for the errors of botocore."""
+    pass
+
+
+class FakeS3:
+    """Stands in for a boto3 S3 client, keeping the objects in memory.
+
+    While failing is True, every upload raises FakeS3Error.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.part_sizes = []
+        self.failing = False
+
+    def put_object(self, Bucket, Key, Body):
+        if self.failing:
+            raise FakeS3Error("403 Forbidden")
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.failing:
+            raise FakeS3Error("403 Forbidden")
+        self.uploads[UploadId][PartNumber] = Body
+        self.part_sizes.append(len(Body))
+        return {"ETag": "etag{}".format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.objects[(Bucket, Key)] = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[(Bucket, Key)]
+
+
+class TestS3(test_base.EnterTemp):
+    def setUp(self):
+        super().setUp()
+        self.client = FakeS3()
+        self.s3 = storage.S3("bucket", "reddit/", "saves", client=self.client, errors=(FakeS3Error,))
+
+    def test_key(self):
+        self.assertEqual(self.s3.key(os.path.join("saves", "sub", "image.jpg")), "reddit/sub/image.jpg")
+
+    def test_stream_small(self):
+        storage.take_written()
+        self.s3.stream("sub", [b"small", b"image"], lambda content_hash: os.path.join(
+            "saves", "image.{}.jpg".format(content_hash.hexdigest()[:10])))
+        content_hash = hashlib.md5(b"smallimage").hexdigest()
+        name = "reddit/image.{}.jpg".format(content_hash[:10])
+        # Only the final object is left behind
+        self.assertEqual(self.client.objects, {("bucket", name): b"smallimage"})
+        self.assertEqual(storage.take_written(),
+                         ((os.path.join("saves", "image.{}.jpg".format(content_hash[:10])), 10, content_hash),))
+
+    @mock.patch("redditcurl.websites.storage.S3.PART_SIZE", new=10)
+    def test_stream_multipart(self):
+        chunks = [bytes([i]) * 4 for i in range(10)]
+        self.s3.stream("sub", chunks, lambda content_hash: os.path.join("saves", "video.mp4"))
+        self.assertEqual(self.client.objects, {("bucket", "reddit/video.mp4"): b"".join(chunks)})
+        # Only about a part is buffered at a time
+        self.assertEqual(self.client.part_sizes, [12, 12, 12, 4])
+        self.assertEqual(self.client.uploads, {})
+
+    @mock.patch("redditcurl.websites.storage.S3.PART_SIZE", new=10)
+    def test_abort(self):
+        def chunks():
+            yield b"x" * 20
+            raise DownloadError("connection lost")
+        with self.assertRaises(DownloadError):
+            self.s3.stream("sub", chunks(), lambda content_hash: os.path.join("saves", "video.mp4"))
+        self.assertEqual(self.client.uploads, {})
+        self.assertEqual(self.client.objects, {})
+
+    @mock.patch("redditcurl.websites.storage.S3.PART_SIZE", new=10)
+    def test_client_errors(self):
+        self.client.failing = True
+        # Failed requests only fail the download, instead of the whole run
+        with self.assertRaises(DownloadError):
+            self.s3.write(os.path.join("saves", "image.jpg"), b"image")
+        with self.assertRaises(DownloadError):
+            self.s3.stream("sub", [b"x" * 20, b"x"], lambda content_hash: os.path.join("saves", "video.mp4"))
+        with open("temp", "wb") as file:
+            file.write(b"segmented")
+        with self.assertRaises(DownloadError):
+            self.s3.store(os.path.join("saves", "video.mp4"), "temp")
+        self.assertEqual(self.client.uploads, {})
+        self.assertEqual(self.client.objects, {})
+
+    def test_store(self):
+        storage.take_written()
+        with open("temp", "wb") as file:
+            file.write(b"segmented")
+        self.s3.store(os.path.join("saves", "video.mp4"), "temp")
+        self.assertEqual(self.client.objects, {("bucket", "reddit/video.mp4"): b"segmented"})
+        self.assertFalse(os.path.exists("temp"))
+        self.s3.write(os.path.join("saves", "image.jpg"), b"image")
+        self.assertEqual(storage.take_written(),
+                         ((os.path.join("saves", "video.mp4"), 9, hashlib.md5(b"segmented").hexdigest()),
+                          (os.path.join("saves", "image.jpg"), 5, hashlib.md5(b"image").hexdigest())))
+
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=False)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_download(self, mocked):
+        mocked.side_effect = test_base.fake_server(b"image", "image/jpeg", accept_ranges=False)
+        with mock.patch("redditcurl.websites.storage._storage", new=self.s3):
+            websites.direct.download("https://example.com/image.jpg", os.path.join("saves", "sub"), "image")
+        self.assertEqual(self.client.objects, {("bucket", "reddit/sub/image.jpeg"): b"image"})
+
+
+def fake_heads(files):
+    """Return a function to replace websites.fetch.head, for files mapping urls to (content type, size)."""
+    def head(url, **kwargs):
+        head.requests.append(url)
+        if url not in files:
+            return test_base.FakeResponse(404, {}, b"")
+        content_type, size = files[url]
+        return test_base.FakeResponse(200, {"Content-Type": content_type, "Content-Length": str(size)}, b"")
+    head.requests = []
+    return head
+
+
+@mock.patch("redditcurl.websites.shared_config.FORMAT_POLICY", new="smallest")
+@mock.patch("redditcurl.websites.shared_config.PREFER_MP4", new=False)
+class TestFormats(unittest.TestCase):
+    def test_choose(self):
+        with mock.patch("redditcurl.websites.fetch.head", new=fake_heads({"b": ("video/mp4", 50)})) as head:
+            self.assertEqual(formats.choose([("a", 100), ("b", None), ("c", None)]), "b")
+        self.assertEqual(head.requests, ["b", "c"])
+
+    @mock.patch("redditcurl.websites.fetch.head", new=fake_heads({}))
+    def test_choose_unknown(self):
+        self.assertEqual(formats.choose([("a", None), ("b", None)]), "a")
+
+    def test_choose_preferred(self):
+        shared_config.FORMAT_POLICY = "preferred"
+        with mock.patch("redditcurl.websites.fetch.head") as head:
+            self.assertEqual(formats.choose([("a", 100), ("b", 50)]), "a")
+        head.assert_not_called()
+
+    @mock.patch("redditcurl.websites.fetch.head")
+    @mock.patch("redditcurl.websites.direct.download")
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_gfycat(self, mocked_get, mocked_download, mocked_head):
+        api_data = {"gfyItem": {"webmUrl": "https://example.com/a.webm", "webmSize": 300,
+                                "mp4Url": "https://example.com/a.mp4", "mp4Size": 200}}
+        mocked_get.return_value = test_base.FakeResponse(200, {}, json.dumps(api_data).encode())
+        websites.gfycat.download("https://gfycat.com/SomeGfy", "", "")
+        mocked_download.assert_called_once_with("https://example.com/a.mp4", "", "")
+        mocked_head.assert_not_called()
+
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_imgur_gifv(self, mocked_download):
+        heads = fake_heads({"https://i.imgur.com/abc.webm": ("video/webm", 300),
+                            "https://i.imgur.com/abc.mp4": ("video/mp4", 200)})
+        with mock.patch("redditcurl.websites.fetch.head", new=heads):
+            websites.imgur_gifv.download("https://i.imgur.com/abc.gifv", "", "")
+        mocked_download.assert_called_once_with("https://i.imgur.com/abc.mp4", "", "")
+
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_imgur_gif(self, mocked_download):
+        heads = fake_heads({"https://i.imgur.com/abc.jpg": ("image/gif", 3000),
+                            "https://i.imgur.com/abc.mp4": ("video/mp4", 200)})
+        with mock.patch("redditcurl.websites.fetch.head", new=heads):
+            websites.imgur_link.download("https://imgur.com/abc", "", "")
+        mocked_download.assert_called_once_with("https://i.imgur.com/abc.mp4", "", "")
+
+    @mock.patch("redditcurl.websites.direct.download")
+    def test_imgur_still(self, mocked_download):
+        heads = fake_heads({"https://i.imgur.com/abc.jpg": ("image/jpeg", 3000)})
+        with mock.patch("redditcurl.websites.fetch.head", new=heads):
+            websites.imgur_link.download("https://imgur.com/abc", "", "")
+        mocked_download.assert_called_once_with("https://i.imgur.com/abc.jpg", "", "")
+        # Still images aren't available as videos, so there is no need to check
+        self.assertEqual(heads.requests, ["https://i.imgur.com/abc.jpg"])
+
+
+class TestSegmented(test_base.EnterTemp):
+    content = bytes(range(256)) * 1000
+
+    def test_ranges(self):
+        self.assertEqual(segmented.ranges(10, 3), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(segmented.ranges(8, 4), [(0, 1), (2, 3), (4, 5), (6, 7)])
+        self.assertEqual(segmented.ranges(2, 4), [(0, 0), (1, 1)])
+
+    @mock.patch("redditcurl.websites.shared_config.FILENAME_HASH", new=True)
+    @mock.patch("redditcurl.websites.shared_config.SEGMENT_THRESHOLD", new=1024)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_segmented_download(self, mocked):
+        mocked.side_effect = test_base.fake_server(self.content)
+        websites.direct.download("https://example.com/video.mp4", "sub", "video")
+        file_hash = hashlib.md5(self.content).hexdigest()[:10]
+        with open("sub/video.{}.mp4".format(file_hash), "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        ranged = [headers for url, headers in mocked.side_effect.requests if headers]
+        self.assertEqual(len(ranged), shared_config.SEGMENTS)
+        # No temporary files should be left behind
+        self.assertEqual(os.listdir("sub"), ["video.{}.mp4".format(file_hash)])
+
+    @mock.patch("redditcurl.websites.shared_config.SEGMENT_THRESHOLD", new=1024)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_no_ranges(self, mocked):
+        mocked.side_effect = test_base.fake_server(self.content, accept_ranges=False)
+        websites.direct.download("https://example.com/video.mp4", "sub", "video")
+        with open("sub/video.mp4", "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(len(mocked.side_effect.requests), 1)
+
+    @mock.patch("redditcurl.websites.shared_config.SEGMENT_THRESHOLD", new=1024)
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_failed_range(self, mocked):
+        server = test_base.fake_server(self.content)
+
+        def get(url, headers=None, **kwargs):
+            if headers and headers["Range"].startswith("bytes=0-"):
+                return test_base.FakeResponse(500)
+            return server(url, headers, **kwargs)
+        mocked.side_effect = get
+        with self.assertRaises(DownloadError):
+            websites.direct.download("https://example.com/video.mp4", "sub", "video")
+        self.assertEqual(os.listdir("sub"), [])
+
+    @mock.patch("redditcurl.websites.fetch.get")
+    def test_stopped_range(self, mocked):
+        mocked.side_effect = test_base.fake_server(self.content)
+        with open("video.mp4", "wb") as file:
+            file.write(b"\0" * 10)
+        stop = threading.Event()
+        stop.set()
+        with self.assertRaises(DownloadError):
+            segmented.download_range("https://example.com/video.mp4", "video.mp4", 0, 9, stop)
+        # Nothing is written once the download has been stopped
+        with open("video.mp4", "rb") as file:
+            self.assertEqual(file.read(), b"\0" * 10)
+
+
 class TestDownloadNamed(test_base.EnterTemp):
     def test_direct(self):
         websites.direct.download(test_links["direct"], "", "direct")
@@ -0,0 +1,89 @@
+import os
+import time
+from unittest import mock
+from tests import test_base
+from redditcurl import manager
+from redditcurl import workqueue
+from redditcurl.manager import Job, Result
+
+
+test_links = test_base.test_links
+
+
+class TestSQLiteQueue(test_base.EnterTemp):
+    def setUp(self):
+        super().setUp()
+        self.jobs = [Job(sub.id, sub.url, "testsubreddit", sub.title) for sub in test_base.test_submissions]
+        self.first = workqueue.SQLiteQueue("queue.db", owner="first")
+        self.second = workqueue.SQLiteQueue("queue.db", owner="second")
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        super().tearDown()
+
+    def test_add(self):
+        self.assertEqual(self.first.add(self.jobs), len(self.jobs))
+        # Jobs already in the queue are skipped
+        self.assertEqual(self.second.add(self.jobs[:2]), 0)
+        self.assertEqual(self.first.counts(), {"pending": len(self.jobs)})
+
+    def test_no_duplicates(self):
+        self.first.add(self.jobs)
+        leased = self.first.lease(3) + self.second.lease(100)
+        self.assertEqual(sorted(leased), sorted(self.jobs))
+        self.assertEqual(self.first.lease(1), [])
+
+    def test_complete(self):
+        self.first.add(self.jobs[:2])
+        done, failed = self.first.lease(2)
+        self.first.complete([Result(done, True), Result(failed, False, "DownloadError")])
+        self.assertEqual(self.first.counts(), {"done": 1, "failed": 1})
+        self.assertEqual(self.second.lease(2), [])
+
+    def test_expired_lease(self):
+        # The jobs of an instance that stopped renewing its leases go to the others
+        crashed = workqueue.SQLiteQueue("queue.db", lease_time=-1, owner="crashed")
+        crashed.add(self.jobs[:1])
+        self.assertEqual(crashed.lease(1), self.jobs[:1])
+        self.assertEqual(self.second.lease(1), self.jobs[:1])
+        # The crashed instance can't complete a job that was leased again
+        crashed.complete([Result(self.jobs[0], False, "DownloadError")])
+        self.assertEqual(self.first.counts(), {"leased": 1})
+        crashed.close()
+
+    @mock.patch("redditcurl.workqueue.MAX_ATTEMPTS", new=2)
+    def test_max_attempts(self):
+        crashed = workqueue.SQLiteQueue("queue.db", lease_time=-1, owner="crashed")
+        crashed.add(self.jobs[:1])
+        crashed.lease(1)
+        crashed.lease(1)
+        self.assertEqual(self.first.lease(1), [])
+        self.assertEqual(self.first.counts(), {"failed": 1})
+        crashed.close()
+
+    def test_heartbeat(self):
+        beating = workqueue.SQLiteQueue("queue.db", lease_time=0.3, owner="beating")
+        beating.add(self.jobs[:1])
+        with beating.heartbeat():
+            beating.lease(1)
+            time.sleep(0.6)
+            # The lease was renewed, so the job stays with the instance
+            self.assertEqual(self.second.lease(1), [])
+        beating.close()
+
+
+class TestDownloadFromQueue(test_base.EnterTemp):
+    @mock.patch("redditcurl.manager.download_jobs")
+    def test_download_from_queue(self, mocked_download):
+        jobs = [Job(sub.id, sub.url, "testsubreddit", sub.title) for sub in test_base.test_submissions]
+        work_queue = workqueue.SQLiteQueue("queue.db")
+        work_queue.add(jobs)
+        mocked_download.side_effect = lambda queue, folders, processes, pool, controller: {
+            job.id: Result(job, job.id != "fail", None if job.id != "fail" else "DownloadError") for job in queue}
+        results = manager.download_from_queue(work_queue, "saves", 1)
+        self.assertEqual(set(results), {job.id for job in jobs})
+        for result in results.values():
+            self.assertEqual(result.job.folder, os.path.join("saves", "testsubreddit"))
+        self.assertEqual(work_queue.counts(), {"done": len(jobs) - 1, "failed": 1})
+        work_queue.close()